@@ -1,24 +1,18 @@
-import boto3
-from botocore.exceptions import ClientError
+import IoTPolicies
+
 def lambda_handler(event, context):
-    # Create IoT client
-    iot_client = boto3.client('iot')
+    # Process the payload variables, a batch of policy/identity pairs or a single pair
+    policy_identity_pairs = IoTPolicies.get_policy_identity_pairs(event)
 
-    # Process the payload variables
-    policy_name = event.get("policy_name", "")
-    user_identity = event.get("user_identity", "")
+    # Attach the policies to the principals in parallel
+    failed = IoTPolicies.attach_policies(policy_identity_pairs)
 
-    try:
-        # Attach the policy to the principal
-        iot_client.attach_principal_policy(
-            policyName=policy_name,
-            principal=user_identity
-        )
-    except ClientError as e:
-        error_message = f"Error attaching policy to principal: {e.response['Error']['Message']}"
+    if failed:
+        error_message = f"Error attaching policy to principal: {'; '.join(f['error'] for f in failed)}"
         return {
             'statusCode': 500,
-            'body': error_message
+            'body': error_message,
+            'failed': failed
         }
 
     return {
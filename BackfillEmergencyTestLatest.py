@@ -0,0 +1,109 @@
+import boto3
+import json
+from datetime import datetime
+import mysql.connector
+import os
+import base64
+import logging
+import traceback
+import re
+import random
+import string
+import zanolambdashelper
+
+database_details = zanolambdashelper.helpers.get_db_details()
+
+rds_host = database_details['rds_host']
+rds_port = database_details['rds_port']
+rds_db = database_details['rds_db']
+rds_user = database_details['rds_user']
+rds_region = database_details['rds_region']
+
+database_dict = zanolambdashelper.helpers.get_database_dict()
+
+rds_client = zanolambdashelper.helpers.create_client('rds')
+
+zanolambdashelper.helpers.set_logging('INFO')
+
+emergency_test_latest_table = 'emergency_test_latest'
+
+# test type id -> (result table, result column)
+result_tables = {
+    1: ('emergency_functional_test_result_table', 'result'),
+    2: ('emergency_discharge_test_result_table', 'discharge_time'),
+}
+
+
+def backfill_latest_results(cursor, test_type_id, results_table, result_column):
+    logging.info(f"Backfilling latest results for test type {test_type_id}...")
+
+    # one off full history scan, from here on SubmitTestResults keeps the table current. results of removed devices
+    # are left out, the table only holds rows for devices that still exist
+    sql = f"""
+        INSERT INTO {database_dict['schema']}.{emergency_test_latest_table}
+        (deviceUUID, test_type_id, organisationUUID, last_result, last_timestamp)
+        SELECT r.deviceUUID, %s, r.organisationUUID, r.{result_column}, r.result_timestamp
+        FROM (
+            SELECT
+                organisationUUID,
+                deviceUUID,
+                {result_column},
+                result_timestamp,
+                ROW_NUMBER() OVER (
+                    PARTITION BY deviceUUID
+                    ORDER BY result_timestamp DESC
+                ) AS rn
+            FROM {database_dict['schema']}.{database_dict[results_table]}
+        ) r
+        JOIN {database_dict['schema']}.{database_dict['devices_table']} d ON d.deviceUUID = r.deviceUUID
+        WHERE r.rn = 1
+        ON DUPLICATE KEY UPDATE
+            organisationUUID = IF(VALUES(last_timestamp) >= last_timestamp, VALUES(organisationUUID), organisationUUID),
+            last_result = IF(VALUES(last_timestamp) >= last_timestamp, VALUES(last_result), last_result),
+            last_timestamp = GREATEST(last_timestamp, VALUES(last_timestamp))
+    """
+    cursor.execute(sql, (test_type_id,))
+    logging.info(f"Backfilled {cursor.rowcount} rows for test type {test_type_id}.")
+
+
+def lambda_handler(event, context):
+    try:
+        database_token = zanolambdashelper.helpers.generate_database_token(rds_client, rds_user, rds_host, rds_port,
+                                                                           rds_region)
+
+        conn = zanolambdashelper.helpers.initialise_connection(rds_user, database_token, rds_db, rds_host, rds_port)
+        conn.autocommit = False
+
+        with conn.cursor() as cursor:
+
+            for test_type_id, (results_table, result_column) in result_tables.items():
+                backfill_latest_results(cursor, test_type_id, results_table, result_column)
+
+            conn.commit()
+
+    except Exception as e:
+        logging.error(f"Internal Server Error: {e}")
+        traceback.print_exc()
+        status_value = 500
+        body_value = 'Unable to backfill latest test results'
+        if len(e.args) >= 2 and isinstance(e.args[0], int):
+            status_value = e.args[0]
+            if status_value == 422:  # if 422 then validation error
+                body_value = e.args[1]
+        error_response = {
+            'statusCode': status_value,
+            'body': body_value,
+        }
+        return error_response
+
+    finally:
+        try:
+            cursor.close()
+            conn.close()
+        except NameError:  # catch potential error before cursor or conn is defined
+            pass
+
+    return {
+        'statusCode': 200,
+        'body': 'Latest Test Results Backfilled Successfully'
+    }
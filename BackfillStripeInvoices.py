@@ -0,0 +1,106 @@
+import boto3
+import json
+from datetime import datetime
+import mysql.connector
+import os
+import base64
+import logging
+import traceback
+import re
+import random
+import string
+import stripe
+import zanolambdashelper
+import StripeInvoices
+
+database_details = zanolambdashelper.helpers.get_db_details()
+
+rds_host = database_details['rds_host']
+rds_port = database_details['rds_port']
+rds_db = database_details['rds_db']
+rds_user = database_details['rds_user']
+rds_region = database_details['rds_region']
+
+stripe_secrets = zanolambdashelper.helpers.get_stripe_api_secrets()
+
+STRIPE_API_SECRET = stripe_secrets['api_key']
+
+stripe.api_key = STRIPE_API_SECRET
+
+database_dict = zanolambdashelper.helpers.get_database_dict()
+
+rds_client = zanolambdashelper.helpers.create_client('rds')
+
+zanolambdashelper.helpers.set_logging('INFO')
+
+
+def get_org_stripe_sub_ids(cursor):
+    logging.info("Getting org subscriptions...")
+
+    sql = f"""
+        SELECT stripe_sub_id
+        FROM {database_dict['schema']}.{database_dict['organisations_table']}
+        WHERE stripe_sub_id IS NOT NULL
+    """
+    cursor.execute(sql)
+    return [stripe_sub_id for stripe_sub_id, in cursor.fetchall()]
+
+
+def backfill_subscription_invoices(cursor, stripe_sub_id):
+    logging.info(f"Backfilling invoices for subscription {stripe_sub_id}...")
+
+    # one off full history, from here on the Stripe webhook keeps the index current
+    invoice_count = 0
+    for invoice in stripe.Invoice.list(subscription=stripe_sub_id, limit=100).auto_paging_iter():
+        StripeInvoices.set_invoice(cursor, database_dict['schema'], invoice)
+        invoice_count += 1
+
+    logging.info(f"Indexed {invoice_count} invoices for subscription {stripe_sub_id}.")
+
+
+def lambda_handler(event, context):
+    try:
+        database_token = zanolambdashelper.helpers.generate_database_token(rds_client, rds_user, rds_host, rds_port,
+                                                                           rds_region)
+
+        conn = zanolambdashelper.helpers.initialise_connection(rds_user, database_token, rds_db, rds_host, rds_port)
+        conn.autocommit = False
+
+        with conn.cursor() as cursor:
+
+            # a single subscription can be backfilled by passing its id
+            if event.get("stripe_sub_id"):
+                stripe_sub_ids = [event["stripe_sub_id"]]
+            else:
+                stripe_sub_ids = get_org_stripe_sub_ids(cursor)
+
+            for stripe_sub_id in stripe_sub_ids:
+                backfill_subscription_invoices(cursor, stripe_sub_id)
+                conn.commit()
+
+    except Exception as e:
+        logging.error(f"Internal Server Error: {e}")
+        traceback.print_exc()
+        status_value = 500
+        body_value = 'Unable to backfill invoices'
+        if len(e.args) >= 2 and isinstance(e.args[0], int):
+            status_value = e.args[0]
+            if status_value == 422:  # if 422 then validation error
+                body_value = e.args[1]
+        error_response = {
+            'statusCode': status_value,
+            'body': body_value,
+        }
+        return error_response
+
+    finally:
+        try:
+            cursor.close()
+            conn.close()
+        except NameError:  # catch potential error before cursor or conn is defined
+            pass
+
+    return {
+        'statusCode': 200,
+        'body': 'Invoices Backfilled Successfully'
+    }
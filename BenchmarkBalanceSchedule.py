@@ -0,0 +1,137 @@
+import argparse
+import copy
+import logging
+import math
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+# Times the yearly scheduler's balance_schedule on a synthetic fleet and checks it against the previous linear scan
+# balancer, which is kept here as the reference. Devices are bunched onto a few install days per org so most days
+# overflow, the worst case for the balancer.
+#
+#   python BenchmarkBalanceSchedule.py --devices 100000 --orgs 1000
+
+import fake_helper
+fake_helper.install_helpers_stand_in()
+
+import ScheduleYearlyTests
+
+run_at = datetime(2025, 1, 15, 12, 0)
+
+
+def balance_schedule_reference(rows):
+    # balance_schedule before the free day heap, re-sorting the candidate days for every overflowing device
+    now = ScheduleYearlyTests.now
+    org_groups = {}
+
+    for row in rows:
+        org_groups.setdefault(row["organisationUUID"], []).append(row)
+
+    for org, devices in org_groups.items():
+        max_per_day = math.ceil(len(devices) / 365)
+
+        day_map = {}
+        for d in devices:
+            day_map.setdefault(d["test_time"].date(), []).append(d)
+
+        for i in range(365):
+            day_map.setdefault(now.date() + timedelta(days=i), [])
+
+        for day, day_devices in day_map.items():
+            if len(day_devices) <= max_per_day:
+                continue
+
+            overflow = len(day_devices) - max_per_day
+            movable = [d for d in day_devices if d["result_timestamp"] is not None]
+            movable.sort(key=lambda x: x["result_timestamp"])
+
+            for device in movable[:overflow]:
+                max_date = device["result_timestamp"] + timedelta(days=364)
+
+                for candidate_day, candidate_devices in [(day, devices) for day, devices in sorted(day_map.items())
+                                                         if len(devices) < max_per_day]:
+                    if candidate_day > max_date.date():
+                        continue
+
+                    device["test_time"] = datetime.combine(candidate_day, device["test_time"].time())
+                    candidate_devices.append(device)
+                    day_devices.remove(device)
+                    break
+
+    return rows
+
+
+def generate_rows(device_count, org_count, seed):
+    rng = random.Random(seed)
+    rows = []
+
+    for i in range(device_count):
+        org = i % org_count
+        preferred_time = timedelta(hours=20 + org % 4)
+        # each org was installed over a handful of days, so its tests bunch up on those days a year later
+        install_day = run_at.date() + timedelta(days=(org * 7 + rng.randint(0, 4)) % 365)
+        test_time = datetime.combine(install_day, datetime.min.time()) + preferred_time
+        result = None if rng.random() < 0.05 else test_time - timedelta(days=365 - rng.randint(0, 30))
+
+        rows.append({
+            "deviceUUID": f"device-{i}",
+            "organisationUUID": f"org-{org}",
+            "test_type_id": 2,
+            "test_time": test_time,
+            "previous_test_time": test_time,
+            "associated_hub": f"hub-{org}-{i % 3}",
+            "previous_associated_hub": f"hub-{org}-{i % 3}",
+            "pref_test_time": preferred_time,
+            "result_timestamp": result
+        })
+
+    return rows
+
+
+def time_balancer(balancer, rows, repeat):
+    best = None
+    balanced = None
+    for _ in range(repeat):
+        run_rows = copy.deepcopy(rows)
+        started = time.perf_counter()
+        balanced = balancer(run_rows)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, balanced
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the yearly test balancer")
+    parser.add_argument("--devices", type=int, default=100000)
+    parser.add_argument("--orgs", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--skip-reference", action="store_true", help="only time the current balancer")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    ScheduleYearlyTests.now = run_at
+
+    rows = generate_rows(args.devices, args.orgs, args.seed)
+    print(f"{len(rows)} devices across {args.orgs} orgs, best of {args.repeat}")
+
+    seconds, balanced = time_balancer(ScheduleYearlyTests.balance_schedule, rows, args.repeat)
+    moved = sum(1 for row in balanced if row["test_time"] != row["previous_test_time"])
+    print(f"  balance_schedule  {seconds:.2f}s  ({moved} tests moved)")
+
+    if args.skip_reference:
+        return
+
+    reference_seconds, reference = time_balancer(balance_schedule_reference, rows, args.repeat)
+    print(f"  reference         {reference_seconds:.2f}s")
+
+    mismatches = sum(1 for row, reference_row in zip(balanced, reference)
+                     if row["test_time"] != reference_row["test_time"])
+    print(f"  {mismatches} test times differ from the reference")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
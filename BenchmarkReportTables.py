@@ -0,0 +1,116 @@
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+from datetime import date, timedelta
+
+# Times rendering the report's device result tables with the compact one table per device layout against the
+# original wrapped mini table per result layout, for orgs of several sizes, and records each render's peak memory.
+# Icons are generated locally so nothing is fetched from S3. Peak memory is the process's peak resident set, each
+# layout is rendered in its own process, and render is how much the render added over the generated devices.
+#
+#   python BenchmarkReportTables.py --devices 50 500 2000
+
+# the report module creates its s3 client at import time, no requests are made
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-2")
+
+import fake_helper
+fake_helper.install_helpers_stand_in()
+
+import GenerateOrgTestResultPDF as report_pdf
+from PIL import Image as PILImage
+
+
+def load_local_icons():
+    for index, icon_key in enumerate(report_pdf.RESULT_ICON_KEYS):
+        icon = io.BytesIO()
+        PILImage.new("RGB", (32, 32), ((80, 200, 120), (240, 180, 40), (220, 60, 60))[index]).save(icon, "PNG")
+        report_pdf.image_cache[icon_key] = icon
+
+
+def generate_devices(count, seed):
+    # a year of results per device, monthly functional tests and a yearly discharge test, as a full report has
+    rng = random.Random(seed)
+    year_start = date(date.today().year, 1, 1)
+    devices = []
+
+    for i in range(count):
+        functional = {
+            (year_start + timedelta(days=30 * month + rng.randint(0, 5))).isoformat(): rng.random() > 0.05
+            for month in range(12)
+        }
+        discharge = {
+            (year_start + timedelta(days=rng.randint(0, 360))).isoformat(): rng.randint(9000, 16000)
+        }
+        devices.append({
+            "device_long_address": f"{rng.getrandbits(64):016X}",
+            "device_name": f"Emergency Light {i:05d}",
+            "group_name": f"Floor {i % 12}",
+            "1": functional,
+            "2": discharge
+        })
+
+    return devices
+
+
+def time_render(devices, compact_tables, repeat):
+    best = None
+    size = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        tables_buffer = report_pdf.render_device_tables(devices, report_pdf.FIRST_PAGE_HEADER_SPACE, compact_tables)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+        size = len(tables_buffer.getvalue())
+    return best, size
+
+
+def measure_render(count, compact_tables, seed, repeat):
+    # run in a fresh process per layout so the peak resident memory is that layout's alone, ru_maxrss is in KB on linux
+    load_local_icons()
+    devices = generate_devices(count, seed)
+
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    seconds, size = time_render(devices, compact_tables, repeat)
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return {"seconds": seconds, "size": size, "peak_kb": peak_kb, "render_kb": peak_kb - baseline_kb}
+
+
+def run_measurement(count, layout, seed, repeat):
+    result = subprocess.run([sys.executable, __file__, "--measure", layout, "--devices", str(count),
+                             "--seed", str(seed), "--repeat", str(repeat)],
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark compact and wrapped report result tables")
+    parser.add_argument("--devices", type=int, nargs="+", default=[50, 500, 2000])
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--measure", choices=["compact", "wrapped"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.measure:
+        print(json.dumps(measure_render(args.devices[0], args.measure == "compact", args.seed, args.repeat)))
+        return
+
+    print(f"{'devices':>8} {'layout':>8} {'time':>9} {'peak rss':>10} {'render':>9} {'size':>8}")
+    for count in args.devices:
+        for layout in ("compact", "wrapped"):
+            measured = run_measurement(count, layout, args.seed, args.repeat)
+            print(f"{count:>8} {layout:>8} {measured['seconds']:>8.2f}s {measured['peak_kb'] / 1024:>8.0f}MB "
+                  f"{measured['render_kb'] / 1024:>+7.0f}MB {measured['size'] / 1024:>6.0f}KB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import argparse
+import os
+import sys
+import threading
+
+from botocore.exceptions import ClientError
+import check_helper
+
+# Runs DeleteThingFromIoTCore against an in-memory stand in for the IoT registry. Orphaned things have certificates
+# with policies attached, and one delete is made to fail. Checks every orphaned thing is deleted, or reported failed,
+# and nothing active is touched. The stand in pages list_things by offset into the live registry, so deleting while
+# the listing is still going makes it skip things, which the lambda has to avoid.
+#
+#   python CheckIoTThingCleanup.py --things 1000 --active 250
+
+# the lambda creates its iot client at import time, no requests are made through it
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-2")
+
+import DeleteThingFromIoTCore
+
+list_things_page_size = 100
+
+
+class InMemoryIoT:
+    """Stands in for the IoT client calls the cleanup lambda makes"""
+
+    def __init__(self, thing_names, failing_thing):
+        self.things = list(thing_names)
+        self.principals = {name: [f"arn:aws:iot:eu-west-2:000000000000:cert/{name}"] for name in thing_names}
+        self.policies = {principal: [{"policyName": f"policy-{name}"}]
+                         for name, principals in self.principals.items() for principal in principals}
+        self.failing_thing = failing_thing
+        self.lock = threading.Lock()
+        self.deleted = []
+
+    def get_paginator(self, operation):
+        assert operation == 'list_things'
+        return self
+
+    def paginate(self):
+        offset = 0
+        while True:
+            with self.lock:
+                page = self.things[offset:offset + list_things_page_size]
+            if not page:
+                return
+            yield {'things': [{'thingName': name} for name in page]}
+            offset += list_things_page_size
+
+    def list_thing_principals(self, thingName):
+        with self.lock:
+            return {'principals': list(self.principals[thingName])}
+
+    def list_attached_policies(self, target):
+        with self.lock:
+            return {'policies': list(self.policies[target])}
+
+    def detach_policy(self, policyName, target):
+        with self.lock:
+            self.policies[target] = [policy for policy in self.policies[target] if policy['policyName'] != policyName]
+
+    def detach_thing_principal(self, thingName, principal):
+        with self.lock:
+            self.principals[thingName].remove(principal)
+
+    def delete_thing(self, thingName):
+        with self.lock:
+            if thingName == self.failing_thing:
+                raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}},
+                                  'DeleteThing')
+            if self.principals[thingName]:
+                raise ClientError({'Error': {'Code': 'InvalidRequestException',
+                                             'Message': 'Thing still has principals attached'}}, 'DeleteThing')
+            self.things.remove(thingName)
+            self.deleted.append(thingName)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the IoT thing cleanup against an in-memory registry")
+    parser.add_argument("--things", type=int, default=1000)
+    parser.add_argument("--active", type=int, default=250)
+    args = parser.parse_args()
+
+    thing_names = [f"hub-{i:05d}" for i in range(args.things)]
+    # active hubs are spread through the registry so orphans sit on every page
+    active = thing_names[::max(1, args.things // args.active)][:args.active]
+    orphaned = sorted(set(thing_names) - set(active))
+    failing_thing = orphaned[len(orphaned) // 2]
+
+    iot = InMemoryIoT(thing_names, failing_thing)
+    DeleteThingFromIoTCore.iot = iot
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        response = DeleteThingFromIoTCore.lambda_handler({"things": active}, None)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    print(f"{args.things} things, {len(active)} active, {len(orphaned)} orphaned")
+    check_helper.exit_with_results([
+        check_helper.check(sorted(iot.deleted) == sorted(set(orphaned) - {failing_thing}),
+                           f"every orphaned thing deleted, {len(iot.deleted)} of {len(orphaned) - 1}"),
+        check_helper.check(sorted(iot.things) == sorted(active + [failing_thing]), "active things left in place"),
+        check_helper.check(response['statusCode'] == 500 and list(response['failed']) == [failing_thing]
+                           and sorted(response['deleted']) == sorted(iot.deleted),
+                           "the failed delete was reported and the rest carried on"),
+        check_helper.check(not any(iot.principals[name] or iot.policies[principal]
+                                   for name in iot.deleted
+                                   for principal in [f"arn:aws:iot:eu-west-2:000000000000:cert/{name}"]),
+                           "principals and policies detached before each delete"),
+    ])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import argparse
+import logging
+import random
+import sys
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+import numpy as np
+
+# Checks the NumPy schedule path against the scalar rules it replaces for large fleets. Both monthly and yearly
+# schedulers are run over randomised rows, weighted towards month ends and leap days, at several scheduler run times.
+# Exits non zero on the first mismatch.
+#
+#   python CheckScheduleParity.py --rows 20000 --seed 1
+
+import fake_helper
+fake_helper.install_helpers_stand_in()
+
+import EmergencyTestScheduling
+import ScheduleMonthlyTests
+import ScheduleYearlyTests
+
+run_times = [
+    datetime(2025, 1, 31, 12, 0),
+    datetime(2025, 2, 28, 23, 45),
+    datetime(2024, 2, 29, 12, 0),
+    datetime(2024, 12, 31, 21, 30),
+    datetime(2025, 6, 15, 0, 0),
+]
+
+edge_days = [(1, 28), (1, 29), (1, 30), (1, 31), (2, 28), (2, 29), (3, 31), (4, 30), (12, 31)]
+
+
+def random_timestamp(rng, around, days):
+    if rng.random() < 0.3:
+        # month end days are where calendar month addition clamps
+        month, day = rng.choice(edge_days)
+        year = around.year + rng.choice([-1, 0])
+        if month == 2 and day == 29 and year % 4:
+            day = 28
+        return datetime(year, month, day, rng.randint(0, 23), rng.choice([0, 15, 30, 45]), rng.randint(0, 59))
+
+    return around + timedelta(days=rng.uniform(-days, days))
+
+
+def generate_rows(rng, count, now):
+    rows = []
+    for i in range(count):
+        preferred_time = timedelta(hours=rng.randint(0, 23), minutes=rng.choice([0, 15, 30, 45]))
+        result = None if rng.random() < 0.1 else random_timestamp(rng, now, 500)
+        test_time = None if rng.random() < 0.1 else random_timestamp(rng, now, 500)
+        rows.append((f"device-{i}", f"org-{i % 50}", preferred_time, test_time, result, f"hub-{i % 200}",
+                     f"hub-{i % 200}"))
+    return rows
+
+
+def check_add_months(rng, count):
+    timestamps = [random_timestamp(rng, datetime(2024, 6, 1), 800) for _ in range(count)]
+    values = np.array(timestamps, dtype='datetime64[us]')
+
+    for months in (1, 12):
+        expected = [timestamp + relativedelta(months=months) for timestamp in timestamps]
+        actual = EmergencyTestScheduling.add_months_vectorised(values, months).tolist()
+        for timestamp, expected_value, actual_value in zip(timestamps, expected, actual):
+            if expected_value != actual_value:
+                print(f"add_months_vectorised({timestamp}, {months}) = {actual_value}, expected {expected_value}")
+                return False
+
+    print(f"add_months_vectorised matches relativedelta for {count} timestamps")
+    return True
+
+
+def check_scheduler(module, rng, count):
+    for now in run_times:
+        module.now = now
+        rows = generate_rows(rng, count, now)
+
+        expected = module.calculate_test_times_scalar(rows)
+        actual = module.calculate_test_times_vectorised(rows)
+
+        for row, expected_row, actual_row in zip(rows, expected, actual):
+            if expected_row != actual_row:
+                print(f"{module.__name__} at {now} differs for {row}:\n  scalar     {expected_row}\n"
+                      f"  vectorised {actual_row}")
+                return False
+
+    print(f"{module.__name__} vectorised rows match the scalar rules for {count} rows at {len(run_times)} run times")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the vectorised schedulers against the scalar rules")
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    rng = random.Random(args.seed)
+
+    passed = check_add_months(rng, args.rows)
+    for module in (ScheduleMonthlyTests, ScheduleYearlyTests):
+        passed = check_scheduler(module, rng, args.rows) and passed
+
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import check_helper
+import fake_helper
+
+# Runs UpdateStripeSubscriptions against a local fake Stripe server that answers with 429s, and checks that rate
+# limited calls are backed off and retried, that a subscription which still fails is retried on its own in the next
+# round, and that no meter event is sent twice.
+#
+#   python CheckStripeRateLimits.py --subscriptions 40
+
+# every subscription below this many rate limited meter events gets through within call_with_backoff's attempts
+transient_rate_limits = 2
+
+
+class FakeStripe:
+    """Serves the subscription retrieve and meter event endpoints, rate limiting chosen subscriptions"""
+
+    def __init__(self):
+        self.price_ids = []  # prices each subscription has an item for, set once the lambda is loaded
+        self.rate_limits = {}  # sub id -> number of meter events still to reject with a 429
+        self.lock = threading.Lock()
+        self.retrieved = Counter()  # sub id -> subscription retrieves
+        self.meter_events = Counter()  # identifier -> accepted meter events
+        self.rejected = Counter()  # sub id -> 429 responses
+        self.rounds = []  # sub ids seen per retry round, appended to by the check
+
+    def subscription(self, sub_id):
+        return {
+            "id": sub_id,
+            "object": "subscription",
+            "customer": f"cus_{sub_id}",
+            "items": {
+                "object": "list",
+                "data": [{"id": f"si_{sub_id}_{price_index}", "object": "subscription_item",
+                          "price": {"id": price_id, "object": "price"}}
+                         for price_index, price_id in enumerate(self.price_ids)]
+            }
+        }
+
+    def handle(self, method, path, form):
+        match = re.fullmatch(r"/v1/subscriptions/([\w-]+)", path)
+        if method == "GET" and match:
+            with self.lock:
+                self.retrieved[match.group(1)] += 1
+            return 200, self.subscription(match.group(1))
+
+        if method == "POST" and path == "/v1/billing/meter_events":
+            identifier = form["identifier"][0]
+            sub_id = re.fullmatch(r"si_([\w-]+)_\d+_.+", identifier).group(1)
+            with self.lock:
+                if self.rate_limits.get(sub_id, 0) > 0:
+                    self.rate_limits[sub_id] -= 1
+                    self.rejected[sub_id] += 1
+                    return 429, {"error": {"type": "invalid_request_error", "code": "rate_limit",
+                                           "message": "Too many requests"}}
+                self.meter_events[identifier] += 1
+            return 200, {"object": "billing.meter_event", "identifier": identifier,
+                         "event_name": form["event_name"][0]}
+
+        return 404, {"error": {"type": "invalid_request_error", "message": f"No such route {method} {path}"}}
+
+
+def start_server(fake):
+    class Handler(BaseHTTPRequestHandler):
+        def respond(self, method):
+            length = int(self.headers.get("Content-Length") or 0)
+            form = parse_qs(self.rfile.read(length).decode("utf-8")) if length else {}
+            status, body = fake.handle(method, self.path.split("?")[0], form)
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            self.respond("GET")
+
+        def do_POST(self):
+            self.respond("POST")
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def load_update_lambda(api_base):
+    # the lambda reads its Stripe key and api base at import time
+    os.environ["STRIPE_API_BASE"] = api_base
+
+    fake_helper.install_helpers_stand_in(get_stripe_api_secrets=lambda: {"api_key": "sk_test_local"})
+
+    import stripe
+    import UpdateStripeSubscriptions
+
+    # the client's own retries would hide the 429s from call_with_backoff
+    stripe.max_network_retries = 0
+    UpdateStripeSubscriptions.rate_limit_base_delay = 0.01
+    return UpdateStripeSubscriptions
+
+
+def build_event(update_lambda, price_ids, count):
+    subscriptions = {}
+    for i in range(count):
+        sub_id = f"sub_{i:04d}"
+        org_data = {"organisationUUID": f"org-{i:04d}", "stripe_sub_id": sub_id}
+        org_data.update({field_name: 1 + i % 3 for field_name, _ in update_lambda.prices.values()})
+        if i % 2:
+            # half come with cached items like a daily billing shard, the rest are retrieved from Stripe
+            org_data["subscription_items"] = {
+                "customer": f"cus_{sub_id}",
+                "items": [[f"si_{sub_id}_{price_index}", price_id] for price_index, price_id in enumerate(price_ids)]
+            }
+        subscriptions[sub_id] = org_data
+    return {"run_id": "1735689600", "subscriptions": subscriptions}
+
+
+def track_rounds(update_lambda, fake):
+    # records which subscriptions each retry round submits
+    submit = update_lambda.submit_subscription_usage
+    round_ids = {}
+
+    def tracked(run_id, sub_id, org_data, submitted_items, refreshed):
+        with fake.lock:
+            round_number = round_ids.get(sub_id, -1) + 1
+            round_ids[sub_id] = round_number
+            while len(fake.rounds) <= round_number:
+                fake.rounds.append(set())
+            fake.rounds[round_number].add(sub_id)
+        return submit(run_id, sub_id, org_data, submitted_items, refreshed)
+
+    update_lambda.submit_subscription_usage = tracked
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check UpdateStripeSubscriptions against a rate limiting fake Stripe")
+    parser.add_argument("--subscriptions", type=int, default=40)
+    args = parser.parse_args()
+
+    fake = FakeStripe()
+    server = start_server(fake)
+    update_lambda = load_update_lambda(f"http://127.0.0.1:{server.server_address[1]}")
+
+    # the 429s are logged as errors by the lambda, only the check results are of interest here
+    logging.getLogger().setLevel(logging.CRITICAL)
+    logging.getLogger("stripe").setLevel(logging.CRITICAL)
+
+    fake.price_ids = list(update_lambda.prices)
+    event = build_event(update_lambda, fake.price_ids, args.subscriptions)
+    sub_ids = list(event["subscriptions"])
+
+    # a few subscriptions are briefly rate limited, one stays rate limited past a whole round of backoff
+    transient = sub_ids[1::7]
+    persistent = sub_ids[4]
+    fake.rate_limits = {sub_id: transient_rate_limits for sub_id in transient}
+    fake.rate_limits[persistent] = update_lambda.max_rate_limit_attempts + 1
+    track_rounds(update_lambda, fake)
+
+    response = update_lambda.lambda_handler(event, None)
+    server.shutdown()
+
+    expected_events = {f"si_{sub_id}_{price_index}_{event['run_id']}"
+                       for sub_id in sub_ids for price_index in range(len(fake.price_ids))}
+    cached = [sub_id for sub_id in sub_ids if "subscription_items" in event["subscriptions"][sub_id]]
+
+    print(f"{len(sub_ids)} subscriptions, {sum(fake.rejected.values())} requests rate limited")
+    check_helper.exit_with_results([
+        check_helper.check(response["statusCode"] == 200 and sorted(response["succeeded"]) == sorted(sub_ids),
+                           f"every subscription billed, status {response['statusCode']}"),
+        check_helper.check(all(fake.rejected[sub_id] == transient_rate_limits for sub_id in transient),
+                           "briefly rate limited subscriptions retried inside call_with_backoff"),
+        check_helper.check(fake.rejected[persistent] == update_lambda.max_rate_limit_attempts + 1,
+                           "persistently limited subscription gave up after its attempts, retried next round"),
+        check_helper.check(fake.rounds[1:] == [{persistent}],
+                           f"only the failed subscription resubmitted, rounds {[len(r) for r in fake.rounds]}"),
+        check_helper.check(set(fake.meter_events) == expected_events and max(fake.meter_events.values()) == 1,
+                           f"each of {len(expected_events)} meter events accepted exactly once"),
+        check_helper.check(not any(fake.retrieved[sub_id] for sub_id in cached)
+                           and set(response["refreshed_subscriptions"]) == set(sub_ids) - set(cached),
+                           "cached subscriptions skipped the retrieve, the rest were refreshed"),
+    ])
+
+
+if __name__ == "__main__":
+    main()
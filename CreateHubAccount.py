@@ -10,6 +10,7 @@ import re
 import random
 import string
 import zanolambdashelper
+import OrganisationDeviceCounts
 
 database_details = zanolambdashelper.helpers.get_db_details()
 
@@ -97,6 +98,8 @@ def create_hub(cursor, serial, registrant, hub_name, org_uuid, user_uuid):
     sql = f"INSERT INTO {database_dict['schema']}.{database_dict['hubs_table']} (hubUUID, serial, registrant, hub_name, organisationUUID, device_type_id, current_firmware) \
             VALUES (%s,%s, %s, %s, %s, %s, %s)"
     cursor.execute(sql, (hub_uuid, serial, registrant, hub_name, org_uuid, 1, '1.0.0'))
+    OrganisationDeviceCounts.adjust_org_device_counts(cursor, database_dict['schema'], org_uuid,
+                                                      {OrganisationDeviceCounts.hub_device_type_id: 1})
 
     return hub_uuid
 
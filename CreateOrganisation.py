@@ -10,6 +10,7 @@ import re
 import random
 import string
 import zanolambdashelper
+import IoTPolicies
 
 database_details = zanolambdashelper.helpers.get_db_details()
 
@@ -22,13 +23,9 @@ rds_region = database_details['rds_region']
 database_dict = zanolambdashelper.helpers.get_database_dict()
 
 rds_client = zanolambdashelper.helpers.create_client('rds')
-lambda_client = zanolambdashelper.helpers.create_client('lambda')
 
 zanolambdashelper.helpers.set_logging('INFO')
 
-policy_creation_lambda = "CreatePolicy"
-policy_attach_lambda = "AttachPolicy"
-
 
 def is_in_org(cursor, login_user_uuid):
     logging.info("Checking user permissions...")
@@ -109,8 +106,7 @@ def update_user_identity_pool(cursor, user_identity, org_uuid, user_uuid):
     cursor.execute(sql, (user_identity, user_uuid))
 
 
-def create_and_attach_policy(cursor, org_uuid, policy_creation_lambda, policy_attach_lambda,
-                             user_identity):
+def create_and_attach_policy(cursor, org_uuid, user_identity):
     logging.info("Creating and Attatching IoT policy to organisation...")
     # Fetch associated policy and organisation UUID
     sql = f"SELECT associated_policy FROM {database_dict['organisations_table']} WHERE organisationUUID = %s;"
@@ -119,38 +115,16 @@ def create_and_attach_policy(cursor, org_uuid, policy_creation_lambda, policy_at
     policy_name = result[0]
     organisation_uuid = org_uuid
 
-    # Run policy creation lambda
-    response = lambda_client.invoke(
-        FunctionName=policy_creation_lambda,
-        InvocationType='RequestResponse',
-        LogType='Tail',
-        Payload=json.dumps({"policy_name": policy_name, "organisation_UUID": organisation_uuid})
-    )
+    # Create and attach the policy in process rather than invoking the policy lambdas
+    IoTPolicies.create_policy(policy_name, organisation_uuid)
     logging.info("Policy created")
 
-    response_payload = response['Payload'].read().decode('utf-8')
-    logging.info(response_payload)
-
-    if response['StatusCode'] != 200 or 'errorMessage' in response_payload:
-        logging.error(f"Lambda invocation failed, ResponsePayload: {response_payload}")
-        raise Exception(response_payload)
-
-    # Run policy attach lambda
-    response = lambda_client.invoke(
-        FunctionName=policy_attach_lambda,
-        InvocationType='RequestResponse',
-        LogType='Tail',
-        Payload=json.dumps({"policy_name": policy_name, "user_identity": user_identity})
-    )
+    failed = IoTPolicies.attach_policies([(policy_name, user_identity)])
+    if failed:
+        logging.error(f"Policy attach failed: {failed}")
+        raise Exception(failed[0]['error'])
     logging.info("Policy attached")
 
-    response_payload = response['Payload'].read().decode('utf-8')
-    logging.info(response_payload)
-
-    if response['StatusCode'] != 200 or 'errorMessage' in response_payload:
-        logging.error(f"Lambda invocation failed, ResponsePayload: {response_payload}")
-        raise Exception(response_payload)
-
 
 def lambda_handler(event, context):
     try:
@@ -227,8 +201,7 @@ def lambda_handler(event, context):
             update_user_identity_pool(cursor, user_identity, org_uuid, user_uuid)
 
             # Create and attach policy
-            create_and_attach_policy(cursor, org_uuid, policy_creation_lambda,
-                                     policy_attach_lambda, user_identity)
+            create_and_attach_policy(cursor, org_uuid, user_identity)
 
             conn.commit()
 
@@ -164,7 +164,15 @@ def lambda_handler(event, context):
                 device_status_log,
                 emergency_test_schedule,
                 emergency_discharge_test_result,
-                emergency_functional_test_result
+                emergency_functional_test_result,
+                emergency_schedule_watermark,
+                emergency_test_latest,
+                stripe_subscription_items,
+                stripe_billing_run_subscriptions,
+                organisation_device_counts,
+                stripe_invoices,
+                stripe_webhook_events,
+                hub_cleanup_tasks
             """
             cursor.execute(drop_tables)
 
@@ -231,7 +239,8 @@ def lambda_handler(event, context):
                 phone_no VARCHAR(15) NOT NULL,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 stripe_sub_id VARCHAR(50),
-                preferred_test_time TIME DEFAULT '22:00:00';
+                preferred_test_time TIME DEFAULT '22:00:00',
+                preferred_test_time_updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 PRIMARY KEY (organisationUUID)
             );
             """
@@ -516,8 +525,10 @@ def lambda_handler(event, context):
                     deviceUUID VARCHAR(36) NOT NULL,
                     test_type_id INT,
                     test_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    associated_hub VARCHAR(36),
                     PRIMARY KEY (deviceUUID, test_type_id),
                     INDEX (organisationUUID),
+                    INDEX (associated_hub, test_time),
                     FOREIGN KEY (organisationUUID) REFERENCES organisations(organisationUUID) ON DELETE CASCADE,
                     FOREIGN KEY (deviceUUID) REFERENCES devices(deviceUUID) ON DELETE CASCADE
                 );
@@ -550,6 +561,125 @@ def lambda_handler(event, context):
             """
             cursor.execute(emergency_discharge_test_result_table)
 
+            # Last processed result and run time per test type for incremental scheduling
+            emergency_schedule_watermark_table = """
+                CREATE TABLE emergency_schedule_watermark (
+                    test_type_id INT NOT NULL,
+                    last_result_id INT NOT NULL DEFAULT 0,
+                    last_run TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (test_type_id)
+                );
+            """
+            cursor.execute(emergency_schedule_watermark_table)
+
+            # Most recent result per device and test type, maintained by SubmitTestResults. removed with the device
+            emergency_test_latest_table = """
+                CREATE TABLE emergency_test_latest (
+                    deviceUUID VARCHAR(36) NOT NULL,
+                    test_type_id INT NOT NULL,
+                    organisationUUID VARCHAR(36) NOT NULL,
+                    last_result INT NOT NULL,
+                    last_timestamp TIMESTAMP NOT NULL,
+                    PRIMARY KEY (deviceUUID, test_type_id),
+                    INDEX (organisationUUID),
+                    FOREIGN KEY (organisationUUID) REFERENCES organisations(organisationUUID) ON DELETE CASCADE,
+                    FOREIGN KEY (deviceUUID) REFERENCES devices(deviceUUID) ON DELETE CASCADE
+                );
+            """
+            cursor.execute(emergency_test_latest_table)
+
+            # Stripe subscription items per subscription so daily billing doesn't retrieve every subscription
+            stripe_subscription_items_table = """
+                CREATE TABLE stripe_subscription_items (
+                    stripe_sub_id VARCHAR(50) NOT NULL,
+                    stripe_item_id VARCHAR(50) NOT NULL,
+                    stripe_customer_id VARCHAR(50) NOT NULL,
+                    price_id VARCHAR(50) NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (stripe_sub_id, stripe_item_id)
+                );
+            """
+            cursor.execute(stripe_subscription_items_table)
+
+            # Subscriptions already billed per daily billing run, lets a rerun skip them
+            stripe_billing_run_subscriptions_table = """
+                CREATE TABLE stripe_billing_run_subscriptions (
+                    run_id VARCHAR(36) NOT NULL,
+                    stripe_sub_id VARCHAR(50) NOT NULL,
+                    billed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (run_id, stripe_sub_id)
+                );
+            """
+            cursor.execute(stripe_billing_run_subscriptions_table)
+
+            # Hub and device counts per organisation, maintained by the register and remove lambdas
+            organisation_device_counts_table = """
+                CREATE TABLE organisation_device_counts (
+                    organisationUUID VARCHAR(36) NOT NULL,
+                    hub_count INT NOT NULL DEFAULT 0,
+                    dimmable_light_count INT NOT NULL DEFAULT 0,
+                    encoder_count INT NOT NULL DEFAULT 0,
+                    pir_count INT NOT NULL DEFAULT 0,
+                    emergency_light_count INT NOT NULL DEFAULT 0,
+                    device_count INT NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    PRIMARY KEY (organisationUUID),
+                    FOREIGN KEY (organisationUUID) REFERENCES organisations(organisationUUID) ON DELETE CASCADE
+                );
+            """
+            cursor.execute(organisation_device_counts_table)
+
+            # Local index of subscription invoices, kept current by the Stripe webhook
+            stripe_invoices_table = """
+                CREATE TABLE stripe_invoices (
+                    stripe_invoice_id VARCHAR(50) NOT NULL,
+                    stripe_sub_id VARCHAR(50) NOT NULL,
+                    status VARCHAR(20) NOT NULL,
+                    invoice_number VARCHAR(50),
+                    amount_paid INT,
+                    currency VARCHAR(3),
+                    invoice_created TIMESTAMP NOT NULL,
+                    pdf_s3_key VARCHAR(255),
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    PRIMARY KEY (stripe_invoice_id),
+                    INDEX (stripe_sub_id, invoice_created)
+                );
+            """
+            cursor.execute(stripe_invoices_table)
+
+            # Raw Stripe webhook events, stored once per event id and applied in order by the processor
+            stripe_webhook_events_table = """
+                CREATE TABLE stripe_webhook_events (
+                    event_id VARCHAR(255) NOT NULL,
+                    event_type VARCHAR(100) NOT NULL,
+                    event_created TIMESTAMP NOT NULL,
+                    payload MEDIUMTEXT NOT NULL,
+                    received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    processed_at TIMESTAMP NULL DEFAULT NULL,
+                    attempts INT NOT NULL DEFAULT 0,
+                    last_error VARCHAR(1000),
+                    PRIMARY KEY (event_id),
+                    INDEX (processed_at, event_created)
+                );
+            """
+            cursor.execute(stripe_webhook_events_table)
+
+            # Remote cleanups owed by HubCleanup after its db deletes, retried until they complete
+            hub_cleanup_tasks_table = """
+                CREATE TABLE hub_cleanup_tasks (
+                    run_id VARCHAR(36) NOT NULL,
+                    task VARCHAR(255) NOT NULL,
+                    payload MEDIUMTEXT NOT NULL,
+                    attempts INT NOT NULL DEFAULT 0,
+                    last_error VARCHAR(1000),
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    completed_at TIMESTAMP NULL DEFAULT NULL,
+                    PRIMARY KEY (run_id, task),
+                    INDEX (completed_at, created_at)
+                );
+            """
+            cursor.execute(hub_cleanup_tasks_table)
+
             cursor.execute("SHOW TABLES;")
             result = cursor.fetchall()
             print(result)
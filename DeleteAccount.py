@@ -10,6 +10,7 @@ import re
 import random
 import string
 import zanolambdashelper
+import IoTPolicies
 
 database_details = zanolambdashelper.helpers.get_db_details()
 
@@ -26,7 +27,6 @@ lambda_client = zanolambdashelper.helpers.create_client('lambda')
 
 zanolambdashelper.helpers.set_logging('INFO')
 
-policy_detatch_lambda = "DetachPolicy"
 remove_user_from_cognito_lambda = "DeleteAccountFromCognito"
 
 
@@ -94,21 +94,15 @@ def delete_user(cursor, org_uuid, user_uuid):
     cursor.execute(sql, (user_uuid,))
 
 
-def detach_users_from_policy(lambda_client, policy_detatch_lambda, policy_name, user_identities):
-    for user_identity in user_identities:
+def detach_users_from_policy(policy_name, user_identities):
+    logging.info(f"Detaching {len(user_identities)} users from policy '{policy_name}'...")
 
-        response = lambda_client.invoke(
-            FunctionName=policy_detatch_lambda,
-            InvocationType='RequestResponse',
-            LogType='Tail',
-            Payload=json.dumps({"policy_name": policy_name, "user_identity": user_identity})
-        )
+    # detached in process and in parallel rather than invoking DetachPolicy per identity
+    failed = IoTPolicies.detach_policies([(policy_name, user_identity) for user_identity in user_identities])
 
-        response_payload = response['Payload'].read().decode('utf-8')
-
-        if response['StatusCode'] != 200 or 'errorMessage' in response_payload:
-            logging.error(f"Lambda invocation failed, ResponsePayload: {response_payload}")
-            raise Exception(response_payload)
+    if failed:
+        logging.error(f"Policy detach failed for {len(failed)} identities: {failed}")
+        raise Exception(f"Unable to detach policy from {len(failed)} identities")
 
 
 def lambda_handler(event, context):
@@ -138,7 +132,7 @@ def lambda_handler(event, context):
                 policy_name, = get_associated_policy(cursor, org_uuid)
 
                 delete_user(cursor, org_uuid, user_uuid)
-                detach_users_from_policy(lambda_client, policy_detatch_lambda, policy_name, user_identities)
+                detach_users_from_policy(policy_name, user_identities)
 
             remove_user_from_cognito_pool(user_email)
 
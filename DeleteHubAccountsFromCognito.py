@@ -1,51 +1,94 @@
 import json
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 
-cognito = boto3.client('cognito-idp')
+# adaptive retries back off when Cognito throttles the parallel calls
+cognito = boto3.client('cognito-idp', config=Config(retries={'max_attempts': 10, 'mode': 'adaptive'}))
 USER_POOL_ID = 'eu-west-2_TUhwdis6d'
 
+# up to this many emails are looked up individually with a filter, more than that and scanning the pool is cheaper
+filter_lookup_threshold = 500
+# kept well under the Cognito admin API request rate quotas
+max_delete_workers = 5
+
 
 def get_all_cognito_users():
-    users = []
+    # yields a user at a time so the pool is never held in memory
+    paginator = cognito.get_paginator('list_users')
+    for page in paginator.paginate(UserPoolId=USER_POOL_ID, AttributesToGet=['email']):
+        yield from page['Users']
+
+
+def get_cognito_users_by_email(email):
+    escaped_email = email.replace('\\', '\\\\').replace('"', '\\"')
     paginator = cognito.get_paginator('list_users')
-    for page in paginator.paginate(UserPoolId=USER_POOL_ID):
-        users.extend(page['Users'])
-    return users
+    for page in paginator.paginate(UserPoolId=USER_POOL_ID, AttributesToGet=['email'],
+                                   Filter=f'email = "{escaped_email}"'):
+        yield from page['Users']
+
+
+def get_user_email(user):
+    return next((attr['Value'] for attr in user['Attributes'] if attr['Name'] == 'email'), None)
 
 
-def delete_unused_cognito_users(cognito_users, inactive_emails):
+def delete_cognito_user(username, email):
+    print(f"Deleting {email}")
+    cognito.admin_delete_user(UserPoolId=USER_POOL_ID, Username=username)
+    return True
+
+
+def delete_cognito_users_for_email(email):
+    deleted = False
+    for user in get_cognito_users_by_email(email):
+        delete_cognito_user(user['Username'], email)
+        deleted = True
+    return deleted
+
+
+def delete_unused_cognito_users(inactive_emails):
     deleted_emails = []
+    failed = {}
+
+    inactive_emails = set(inactive_emails)
+    print(f"Inactive Hub Users : {len(inactive_emails)}")
 
-    print(f"Cognito Users : {cognito_users}")
-    print(f"Inactive Hub Users : {inactive_emails}")
+    with ThreadPoolExecutor(max_workers=max_delete_workers) as executor:
+        if len(inactive_emails) <= filter_lookup_threshold:
+            futures = [(email, email, executor.submit(delete_cognito_users_for_email, email))
+                       for email in inactive_emails]
+        else:
+            futures = []
+            for user in get_all_cognito_users():
+                email = get_user_email(user)
+                if email in inactive_emails:
+                    futures.append((email, user['Username'],
+                                    executor.submit(delete_cognito_user, user['Username'], email)))
 
-    for user in cognito_users:
-        email = next((attr['Value'] for attr in user['Attributes'] if attr['Name'] == 'email'), None)
-        username = user['Username']
+        for email, username, future in futures:
+            error = future.exception()
+            if error is None:
+                # emails with no user left in the pool aren't reported as deleted
+                if future.result():
+                    deleted_emails.append(email)
+                continue
 
-        if email and email in inactive_emails:
-            try:
-                print(f"Deleting {email}")
-                cognito.admin_delete_user(UserPoolId=USER_POOL_ID, Username=username)
-                deleted_emails.append(email)
-            except ClientError as e:
-                # Log error but continue with other deletions
-                print(f"Failed to delete user {username}: {e.response['Error']['Message']}")
+            # Log error but continue with other deletions
+            message = error.response['Error']['Message'] if isinstance(error, ClientError) else str(error)
+            print(f"Failed to delete user {username}: {message}")
+            failed[email] = message
 
-    return deleted_emails
+    return deleted_emails, failed
 
 
 def lambda_handler(event, context):
     try:
-        # Get the list of valid emails from the event
-        active_users = event.get("users", [])
-
-        # Get all users in Cognito
-        users = get_all_cognito_users()
+        # Get the list of hub user emails to remove from the event
+        inactive_users = event.get("users", [])
 
-        # Delete users not in the active list and get deleted emails
-        deleted_emails = delete_unused_cognito_users(users, active_users)
+        # Delete the matching Cognito users and get deleted emails
+        deleted_emails, failed = delete_unused_cognito_users(inactive_users)
 
     except ClientError as e:
         error_message = f"Error deleting users from cognito pool: {e.response['Error']['Message']}"
@@ -56,5 +99,5 @@ def lambda_handler(event, context):
 
     return {
         'statusCode': 200,
-        'body': json.dumps({'deleted_emails': deleted_emails})
+        'body': json.dumps({'deleted_emails': deleted_emails, 'failed': failed})
     }
@@ -1,15 +1,20 @@
 import json
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 
-iot = boto3.client('iot')
+# adaptive retries back off when IoT throttles the parallel deletes
+iot = boto3.client('iot', config=Config(retries={'max_attempts': 10, 'mode': 'adaptive'}))
+
+# orphaned things are cleaned up in parallel, bounded to stay within IoT control plane rate limits
+max_delete_workers = 8
 
 def get_all_things():
-    things = []
+    # yields a page at a time, only the names of orphaned things are kept
     paginator = iot.get_paginator('list_things')
     for page in paginator.paginate():
-        things.extend(page['things'])
-    return things
+        yield page['things']
 
 def detach_policies_and_principals(thing_name):
     try:
@@ -31,35 +36,54 @@ def detach_policies_and_principals(thing_name):
         print(f"Failed to detach policies/principals from {thing_name}: {e}")
         raise
 
-def clean_iot_things(iot_things, db_hub_uuids):
-    batch = []
-    for thing in iot_things:
-        if thing['thingName'] not in db_hub_uuids:
-            batch.append(thing['thingName'])
+def delete_thing(thing_name):
+    print(f"Cleaning up thing: {thing_name}")
+    detach_policies_and_principals(thing_name)
+
+    # Now delete the thing
+    print(f"Deleting thing {thing_name}")
+    iot.delete_thing(thingName=thing_name)
+
+def get_orphaned_things(iot_thing_pages, db_hub_uuids):
+    # every page is listed before anything is deleted, deleting mid listing can make the paginator skip things
+    active_things = set(db_hub_uuids)
+    return [
+        thing['thingName']
+        for things in iot_thing_pages
+        for thing in things
+        if thing['thingName'] not in active_things
+    ]
+
+def clean_iot_things(iot_thing_pages, db_hub_uuids):
+    orphaned_things = get_orphaned_things(iot_thing_pages, db_hub_uuids)
+    print(f"{len(orphaned_things)} orphaned things")
+
+    deleted = []
+    errors = {}
 
-    for thing_name in batch:
-        print(f"Cleaning up thing: {thing_name}")
-        try:
-            detach_policies_and_principals(thing_name)
+    with ThreadPoolExecutor(max_workers=max_delete_workers) as executor:
+        futures = {thing_name: executor.submit(delete_thing, thing_name) for thing_name in orphaned_things}
 
-            # Now delete the thing
-            print(f"Deleting thing {thing_name}")
-            iot.delete_thing(thingName=thing_name)
+        # one bad thing is recorded and the sweep carries on with the rest
+        for thing_name, future in futures.items():
+            error = future.exception()
+            if error is not None:
+                print(f"Failed to delete {thing_name}: {error}")
+                errors[thing_name] = str(error)
+            else:
+                deleted.append(thing_name)
 
-        except Exception as e:
-            print(f"Failed to delete {thing_name}: {e}")
-            raise  # re-raise or handle accordingly
+    return deleted, errors
 
 def lambda_handler(event, context):
     try:
         # Process the payload variables
         active_things = event.get("things", [])
 
-        things = get_all_things()
-        print(things)
-        print(active_things)
+        print(f"{len(active_things)} active things")
 
-        clean_iot_things(things, active_things)
+        deleted, errors = clean_iot_things(get_all_things(), active_things)
+        print(f"Deleted {len(deleted)} things, {len(errors)} failed")
 
     except Exception as e:
         error_message = f"Error deleting things from IoT Core: {e}"
@@ -69,7 +93,16 @@ def lambda_handler(event, context):
             'body': error_message
         }
 
+    if errors:
+        return {
+            'statusCode': 500,
+            'body': f"Failed to delete {len(errors)} things from IoT Core",
+            'deleted': deleted,
+            'failed': errors
+        }
+
     return {
         'statusCode': 200,
-        'body': 'Things deleted successfully'
+        'body': 'Things deleted successfully',
+        'deleted': deleted
     }
@@ -1,28 +1,22 @@
-import boto3
-from botocore.exceptions import ClientError
+import IoTPolicies
 
 def lambda_handler(event, context):
-    # Create IoT client
-    iot_client = boto3.client('iot')
-    
-    # Process the payload variables
-    policy_name = event.get("policy_name", "")
-    user_identity = event.get("user_identity", "")
-    
+    # Process the payload variables, a batch of policy/identity pairs, one policy with
+    # several identities or a single pair
+    policy_identity_pairs = IoTPolicies.get_policy_identity_pairs(event)
 
-    try:
-        # Attach the policy to the principal
-        iot_client.detach_principal_policy(
-            policyName=policy_name,
-            principal=user_identity
-        )
-        return {
-            'statusCode': 200,
-            'body': 'Policy detached successfully.'
-        }
-    except ClientError as e:
-        error_message = f"Error attaching policy to principal: {e.response['Error']['Message']}"
+    # Detach the policies from the principals in parallel
+    failed = IoTPolicies.detach_policies(policy_identity_pairs)
+
+    if failed:
+        error_message = f"Error detaching policy from principal: {'; '.join(f['error'] for f in failed)}"
         return {
             'statusCode': 500,
-            'body': error_message
+            'body': error_message,
+            'failed': failed
         }
+
+    return {
+        'statusCode': 200,
+        'body': 'Policy detached successfully.'
+    }
@@ -0,0 +1,92 @@
+import logging
+import numpy as np
+from dateutil.relativedelta import relativedelta
+
+# scheduling logic shared by the monthly and yearly test schedulers, deployed in the same package
+
+# tests due on the same hub at the same time are staggered into later slots of the nightly test window
+hub_max_concurrent_tests = 10
+
+
+def spread_hub_load(rows, test_slot_length, test_window_slots):
+    logging.info("Staggering test times per hub...")
+
+    slot_counts = {}
+
+    # deterministic order so an unchanged hub gets the same slots on every run and isn't rewritten
+    for row in sorted(rows, key=lambda x: (x["associated_hub"], x["test_time"], x["deviceUUID"])):
+        hub = row["associated_hub"]
+        requested_time = row["test_time"]
+
+        chosen_time = None
+        least_loaded_time = None
+
+        for slot in range(test_window_slots): #take the earliest slot in the window the hub still has capacity in
+            slot_time = requested_time + slot * test_slot_length
+            slot_count = slot_counts.get((hub, slot_time), 0)
+
+            if slot_count < hub_max_concurrent_tests:
+                chosen_time = slot_time
+                break
+
+            if least_loaded_time is None or slot_count < slot_counts[(hub, least_loaded_time)]:
+                least_loaded_time = slot_time
+
+        if chosen_time is None: #window is full so share the least loaded slot
+            chosen_time = least_loaded_time
+
+        slot_counts[(hub, chosen_time)] = slot_counts.get((hub, chosen_time), 0) + 1
+        row["test_time"] = chosen_time
+
+    return rows
+
+
+def add_months_vectorised(timestamps, months):
+    # calendar aware month addition matching relativedelta, the day is clamped to the end of the target month
+    days = timestamps.astype('datetime64[D]')
+    month_start = timestamps.astype('datetime64[M]')
+    day_offset = days - month_start.astype('datetime64[D]')
+    time_of_day = timestamps - days
+
+    target_month = month_start + np.timedelta64(months, 'M')
+    target_month_start = target_month.astype('datetime64[D]')
+    target_month_days = (target_month + np.timedelta64(1, 'M')).astype('datetime64[D]') - target_month_start
+
+    return target_month_start + np.minimum(day_offset, target_month_days - np.timedelta64(1, 'D')) + time_of_day
+
+
+def has_timezone_aware_times(test_data):
+    # timezone aware values can't be held in datetime64, callers use their scalar rules for these
+    return any(getattr(row[3], 'tzinfo', None) or getattr(row[4], 'tzinfo', None) for row in test_data)
+
+
+def calculate_test_times_vectorised(test_data, now, interval_months):
+    """Next test time for each get_emergency_devices row, the schedulers' scalar rules applied to the whole fleet
+    at once with a test due interval_months after the last result"""
+
+    preferred_times = np.array([row[2] for row in test_data], dtype='timedelta64[us]')
+    test_times = np.array([row[3] for row in test_data], dtype='datetime64[us]')  # None becomes NaT
+    results = np.array([row[4] for row in test_data], dtype='datetime64[us]')
+
+    now_us = np.datetime64(now, 'us')
+
+    tonight = np.datetime64(now.date(), 'D') + preferred_times
+    tonight = np.where(tonight < now_us, tonight + np.timedelta64(1, 'D'), tonight)
+
+    due_after_result = add_months_vectorised(results, interval_months)
+
+    # comparisons against NaT are always False so each rule only applies where its inputs exist, same order as the scalar rules
+    new_test_times = np.select(
+        [
+            np.isnat(results),
+            results < np.datetime64(now - relativedelta(months=interval_months), 'us'),
+            np.isnat(test_times) | (test_times < results),
+            test_times < now_us,
+            test_times > due_after_result,
+        ],
+        [tonight, tonight, due_after_result, due_after_result, due_after_result],
+        default=test_times - preferred_times
+    )
+
+    # at_preferred_time for every row
+    return (new_test_times.astype('datetime64[D]') + preferred_times).astype('datetime64[us]').tolist()
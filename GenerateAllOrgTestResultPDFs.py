@@ -0,0 +1,375 @@
+import io
+import itertools
+import multiprocessing
+import boto3
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import mysql.connector
+import os
+import base64
+import logging
+import traceback
+import re
+import random
+import string
+import zanolambdashelper
+
+# report rendering is shared with the on demand lambda, both files are deployed in the same package
+import GenerateOrgTestResultPDF as report_pdf
+
+database_details = zanolambdashelper.helpers.get_db_details()
+
+rds_host = database_details['rds_host']
+rds_port = database_details['rds_port']
+rds_db = database_details['rds_db']
+rds_user = database_details['rds_user']
+rds_region = database_details['rds_region']
+
+database_dict = zanolambdashelper.helpers.get_database_dict()
+
+rds_client = zanolambdashelper.helpers.create_client('rds')
+lambda_client = zanolambdashelper.helpers.create_client('lambda')
+cloudwatch_client = zanolambdashelper.helpers.create_client('cloudwatch')
+
+zanolambdashelper.helpers.set_logging('INFO')
+
+emergency_device_type_id = 5
+
+CHECKPOINT_PREFIX = "batch-checkpoints"
+METRICS_NAMESPACE = "EmergencyTestReports"
+
+# orgs are fetched and rendered in batches to bound memory use
+ORG_BATCH_SIZE = 50
+MAX_UPLOAD_WORKERS = 8
+
+# stop taking new batches when less than this is left and hand over to a fresh invocation
+MIN_REMAINING_TIME_MS = 120 * 1000
+
+
+def get_orgs_with_emergency_devices(cursor):
+    logging.info("Getting organisations with emergency devices...")
+
+    sql = f"""
+        SELECT DISTINCT a.organisationUUID, a.organisation_name
+        FROM {database_dict['schema']}.{database_dict['organisations_table']} a
+        INNER JOIN {database_dict['schema']}.{database_dict['devices_table']} b
+            ON a.organisationUUID = b.organisationUUID
+        WHERE b.device_type_ID = %s
+        ORDER BY a.organisationUUID
+    """
+
+    cursor.execute(sql, (emergency_device_type_id,))
+    return cursor.fetchall()
+
+
+def get_batch_devices(cursor, org_uuids, device_type_id):
+    logging.info("Getting emergency devices for organisation batch...")
+
+    placeholders = ','.join(['%s'] * len(org_uuids))
+    sql = f"""
+        WITH RECURSIVE pool_hierarchy AS (
+            SELECT
+                d.organisationUUID,
+                d.deviceUUID,
+                d.device_name,
+                d.long_address,
+                p.poolUUID,
+                p.pool_name,
+                p.parentUUID,
+                1 AS depth
+            FROM devices d
+            JOIN pools_devices pd ON d.deviceUUID = pd.deviceUUID
+            JOIN pools p ON pd.poolUUID = p.poolUUID
+            WHERE d.organisationUUID IN ({placeholders})
+              AND d.device_type_id = %s
+
+            UNION ALL
+
+            SELECT
+                ph.organisationUUID,
+                ph.deviceUUID,
+                ph.device_name,
+                ph.long_address,
+                parent.poolUUID,
+                parent.pool_name,
+                parent.parentUUID,
+                ph.depth + 1
+            FROM pool_hierarchy ph
+            JOIN pools parent ON ph.parentUUID = parent.poolUUID
+        )
+        SELECT ph.organisationUUID, ph.deviceUUID, ph.long_address, ph.device_name, ph.pool_name
+        FROM pool_hierarchy ph
+        JOIN (
+            SELECT deviceUUID, MAX(depth) AS max_depth
+            FROM pool_hierarchy
+            GROUP BY deviceUUID
+        ) deepest
+        ON ph.deviceUUID = deepest.deviceUUID AND ph.depth = deepest.max_depth
+        ORDER BY ph.organisationUUID, ph.device_name, ph.deviceUUID;
+    """
+
+    cursor.execute(sql, (*org_uuids, device_type_id))
+
+    devices = []
+    for org_uuid, device_uuid, long_address, device_name, device_group in cursor.fetchall():
+        devices.append({
+            "organisation_uuid": org_uuid,
+            "device_uuid": device_uuid,
+            "long_address": long_address,
+            "device_name": device_name,
+            "device_group": device_group
+        })
+
+    return devices
+
+
+def get_batch_test_results(cursor, org_uuids):
+    logging.info("Getting emergency device results for organisation batch...")
+
+    # grouped by the organisation the result was recorded against, as the single org report filters them
+    placeholders = ','.join(['%s'] * len(org_uuids))
+    sql = f"""
+        SELECT
+            r.organisationUUID,
+            r.deviceUUID,
+            r.test_type_id,
+            DATE_FORMAT(r.result_timestamp, '%Y-%m-%d') AS result_date,
+            r.result_value
+        FROM (
+            SELECT organisationUUID, deviceUUID, 1 AS test_type_id, result AS result_value, result_timestamp
+            FROM {database_dict['schema']}.{database_dict['emergency_functional_test_result_table']}
+            WHERE organisationUUID IN ({placeholders})
+              AND result_timestamp >= DATE_FORMAT(CURDATE(), '%Y-01-01')
+
+            UNION ALL
+
+            SELECT organisationUUID, deviceUUID, 2 AS test_type_id, discharge_time AS result_value, result_timestamp
+            FROM {database_dict['schema']}.{database_dict['emergency_discharge_test_result_table']}
+            WHERE organisationUUID IN ({placeholders})
+              AND result_timestamp >= DATE_FORMAT(CURDATE(), '%Y-01-01')
+        ) r
+        INNER JOIN {database_dict['schema']}.{database_dict['devices_table']} d ON r.deviceUUID = d.deviceUUID
+        ORDER BY r.organisationUUID, d.device_name, d.deviceUUID, r.test_type_id, r.result_timestamp
+    """
+
+    cursor.execute(sql, (*org_uuids, *org_uuids))
+
+    # fetched in full so rows for unlisted devices never leave the cursor with unread results for the next batch
+    org_results = {}
+    for org_uuid, rows in itertools.groupby(cursor.fetchall(), key=lambda row: row[0]):
+        org_results[org_uuid] = [row[1:] for row in rows]
+
+    return org_results
+
+
+def read_checkpoint(run_id):
+    try:
+        obj = report_pdf.s3.get_object(Bucket=report_pdf.OUTPUT_BUCKET, Key=f"{CHECKPOINT_PREFIX}/{run_id}.json")
+    except report_pdf.s3.exceptions.NoSuchKey:
+        return set()
+
+    return set(json.loads(obj["Body"].read())["completed"])
+
+
+def write_checkpoint(run_id, completed_orgs):
+    report_pdf.s3.put_object(
+        Bucket=report_pdf.OUTPUT_BUCKET,
+        Key=f"{CHECKPOINT_PREFIX}/{run_id}.json",
+        Body=json.dumps({"completed": sorted(completed_orgs)}),
+        ContentType="application/json"
+    )
+
+
+def publish_org_metrics(org_timings):
+    if not org_timings:
+        return
+
+    metric_data = []
+    for org_uuid, render_seconds, device_count in org_timings:
+        dimensions = [{"Name": "OrganisationUUID", "Value": org_uuid}]
+        metric_data.append({"MetricName": "ReportRenderTime", "Dimensions": dimensions,
+                            "Value": render_seconds, "Unit": "Seconds"})
+        metric_data.append({"MetricName": "ReportDeviceCount", "Dimensions": dimensions,
+                            "Value": device_count, "Unit": "Count"})
+
+    for i in range(0, len(metric_data), 1000):
+        cloudwatch_client.put_metric_data(Namespace=METRICS_NAMESPACE, MetricData=metric_data[i:i + 1000])
+
+
+def render_report_worker(device_data, org_name, template_bytes, send_conn):
+    try:
+        final_buffer = report_pdf.generate_final_pdf_buffer(device_data, org_name, io.BytesIO(template_bytes))
+        send_conn.send_bytes(final_buffer.getvalue())
+    finally:
+        send_conn.close()
+
+
+def upload_report(org_uuid, report_bytes, report_fingerprint, timestamp):
+    output_key = f"{org_uuid}/{datetime.now().year}/{timestamp}_report.pdf"
+
+    report_pdf.s3.put_object(
+        Bucket=report_pdf.OUTPUT_BUCKET,
+        Key=output_key,
+        Body=report_bytes,
+        ContentType="application/pdf",
+        Metadata={report_pdf.REPORT_FINGERPRINT_METADATA_KEY: report_fingerprint}
+    )
+
+    return org_uuid
+
+
+def render_batch_reports(org_reports, template_bytes):
+    # renders are collected a wave at a time, failures are recorded per org and the rest carry on
+    max_workers = os.cpu_count() or 1
+    rendered = []
+    failures = {}
+    org_timings = []
+
+    for i in range(0, len(org_reports), max_workers):
+        running = []
+        for org_uuid, org_name, device_data, fingerprint in org_reports[i:i + max_workers]:
+            # Lambda has no /dev/shm so reports are rendered in plain processes reporting back over pipes
+            recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=render_report_worker,
+                                              args=(device_data, org_name, template_bytes, send_conn))
+            process.start()
+            send_conn.close()
+            running.append((org_uuid, process, recv_conn, time.monotonic(), fingerprint, len(device_data)))
+
+        for org_uuid, process, recv_conn, started, fingerprint, device_count in running:
+            try:
+                report_bytes = recv_conn.recv_bytes()
+            except EOFError:
+                logging.error(f"Rendering failed for organisation {org_uuid}")
+                failures[org_uuid] = "Rendering failed"
+                continue
+            finally:
+                recv_conn.close()
+                process.join()
+
+            org_timings.append((org_uuid, time.monotonic() - started, device_count))
+            rendered.append((org_uuid, report_bytes, fingerprint))
+
+    return rendered, failures, org_timings
+
+
+def generate_batch_reports(cursor, orgs, template_bytes, template_etag):
+    org_uuids = [org_uuid for org_uuid, _ in orgs]
+
+    devices = get_batch_devices(cursor, org_uuids, emergency_device_type_id)
+    org_results = get_batch_test_results(cursor, org_uuids)
+
+    org_devices = {}
+    for device in devices:
+        org_devices.setdefault(device["organisation_uuid"], []).append(device)
+
+    org_reports = []
+    for org_uuid, org_name in orgs:
+        # merged per org exactly as the single org report does
+        device_data = list(report_pdf.iter_device_sections(org_devices.get(org_uuid, []),
+                                                           org_results.get(org_uuid, [])))
+        fingerprint = report_pdf.calculate_report_fingerprint(org_name, device_data, template_etag)
+
+        if report_pdf.get_cached_report_key(org_uuid, datetime.now().year, fingerprint):
+            logging.info(f"Report for {org_uuid} unchanged, skipping...")
+            continue
+
+        org_reports.append((org_uuid, org_name, device_data, fingerprint))
+
+    # every render process has exited before any upload thread starts, forking with threads running can deadlock
+    rendered, failures, org_timings = render_batch_reports(org_reports, template_bytes)
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    with ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as upload_executor:
+        uploads = [(org_uuid, upload_executor.submit(upload_report, org_uuid, report_bytes, fingerprint, timestamp))
+                   for org_uuid, report_bytes, fingerprint in rendered]
+
+        for org_uuid, upload in uploads:
+            error = upload.exception()
+            if error is not None:
+                logging.error(f"Upload failed for organisation {org_uuid}: {error}")
+                failures[org_uuid] = f"Upload failed: {error}"
+
+    publish_org_metrics(org_timings)
+
+    return failures
+
+
+def lambda_handler(event, context):
+    try:
+        run_id = event.get("run_id") or datetime.now().strftime("%Y%m%d")
+
+        database_token = zanolambdashelper.helpers.generate_database_token(rds_client, rds_user, rds_host, rds_port,
+                                                                           rds_region)
+
+        conn = zanolambdashelper.helpers.initialise_connection(rds_user, database_token, rds_db, rds_host, rds_port)
+        conn.autocommit = False
+
+        with conn.cursor() as cursor:
+
+            completed_orgs = read_checkpoint(run_id)
+            orgs = [org for org in get_orgs_with_emergency_devices(cursor) if org[0] not in completed_orgs]
+            logging.info(f"{len(orgs)} organisation reports remaining for run {run_id}...")
+
+            report_pdf.preload_result_icons()
+            template_bytes = report_pdf.fetch_s3_file(report_pdf.RESOURCES_BUCKET,
+                                                      report_pdf.PDF_TEMPLATE_KEY).getvalue()
+            template_etag = report_pdf.get_s3_etag(report_pdf.RESOURCES_BUCKET, report_pdf.PDF_TEMPLATE_KEY)
+
+            failures = {}
+            for i in range(0, len(orgs), ORG_BATCH_SIZE):
+
+                # a manual run without a lambda context does every org in one pass, there's nothing to continue in
+                if context is not None and context.get_remaining_time_in_millis() < MIN_REMAINING_TIME_MS:
+                    logging.info("Running out of time, continuing in a new invocation...")
+                    lambda_client.invoke(
+                        FunctionName=context.function_name,
+                        InvocationType='Event',
+                        Payload=json.dumps({"run_id": run_id})
+                    )
+                    break
+
+                org_batch = orgs[i:i + ORG_BATCH_SIZE]
+                batch_failures = generate_batch_reports(cursor, org_batch, template_bytes, template_etag)
+                failures.update(batch_failures)
+
+                # failed orgs are left out of the checkpoint so a rerun of the same run id picks them up
+                completed_orgs.update(org_uuid for org_uuid, _ in org_batch if org_uuid not in batch_failures)
+                write_checkpoint(run_id, completed_orgs)
+
+    except Exception as e:
+        logging.error(f"Internal Server Error: {e}")
+        traceback.print_exc()
+        status_value = 500
+        body_value = 'Unable to generate organisation reports'
+        if len(e.args) >= 2 and isinstance(e.args[0], int):
+            status_value = e.args[0]
+            if status_value == 422:  # if 422 then validation error
+                body_value = e.args[1]
+        error_response = {
+            'statusCode': status_value,
+            'body': body_value,
+        }
+        return error_response
+
+    finally:
+        try:
+            cursor.close()
+            conn.close()
+        except NameError:  # catch potential error before cursor or conn is defined
+            pass
+
+    if failures:
+        logging.error(f"Reports failed for {len(failures)} organisations: {failures}")
+        return {
+            'statusCode': 500,
+            'body': f"Unable to generate reports for {len(failures)} organisations",
+            'failed': failures
+        }
+
+    return {
+        'statusCode': 200,
+        'body': 'Organisation reports generated successfully'
+    }
@@ -1,4 +1,9 @@
 import io
+import functools
+import hashlib
+import multiprocessing
+import shutil
+import tempfile
 import boto3
 from datetime import datetime
 from PyPDF2 import PdfReader, PdfWriter
@@ -56,6 +61,52 @@ image_cache = {}
 lower_threshold = 3600 * 3
 upper_threshold = 3600 * 4
 
+# ----------------------------
+# PRECOMPILED STYLES (built once per container rather than per result)
+# ----------------------------
+FUNCTIONAL_RESULTS_PER_ROW = 6
+
+DISCHARGE_HEADER_ROW = ["Test Date", "Battery Health", "Discharge Time", "Result"]
+
+_results_style_commands = [
+    ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+    ("ALIGN", (0, 0), (-1, -1), "CENTER"),
+    ("GRID", (0, 0), (-1, -1), 0.3, colors.black),
+    ("BOTTOMPADDING", (0, 0), (-1, -1), 2),
+    ("TOPPADDING", (0, 0), (-1, -1), 2),
+    ("LEFTPADDING", (0, 0), (-1, -1), 4),
+    ("RIGHTPADDING", (0, 0), (-1, -1), 4),
+]
+
+FUNCTIONAL_RESULTS_STYLE = TableStyle(_results_style_commands)
+DISCHARGE_RESULTS_STYLE = TableStyle(
+    _results_style_commands + [("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#CBEDF4"))]
+)
+WRAPPED_ROW_STYLE = TableStyle([("VALIGN", (0, 0), (-1, -1), "TOP")])
+DEVICE_TABLE_STYLE = TableStyle([
+    ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#CBEDF4")),
+    ("GRID", (0, 0), (-1, -1), 1, colors.black),
+    ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+])
+
+styles = getSampleStyleSheet()
+
+RESULT_ICON_KEYS = ["BatteryReport-114.png", "BatteryReport-115.png", "BatteryReport-116.png"]
+
+# space left at the top of the first page for the template header
+FIRST_PAGE_HEADER_SPACE = 175
+
+# large orgs are split into chunks of devices rendered in separate processes
+PARALLEL_RENDER_THRESHOLD = 200
+PARALLEL_RENDER_CHUNK_SIZE = 100
+
+# reports are streamed to s3 in parts of this size and spooled to disk above REPORT_SPOOL_MAX_SIZE
+S3_MULTIPART_PART_SIZE = 8 * 1024 * 1024
+REPORT_SPOOL_MAX_SIZE = 5 * 1024 * 1024
+
+# stored reports carry a fingerprint of their inputs so unchanged reports aren't re-rendered
+REPORT_FINGERPRINT_METADATA_KEY = "report-fingerprint"
+
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
 from email.mime.text import MIMEText
@@ -69,8 +120,9 @@ def send_pdf_via_ses(sender_email, recipient_email, pdf_buffer, file_name, subje
     # Empty body
     msg.attach(MIMEText('', 'plain'))
 
-    # Attach PDF
-    pdf_part = MIMEApplication(pdf_buffer.getvalue(), _subtype='pdf')
+    # Attach PDF (accepts any readable file object, e.g. a spooled temp file)
+    pdf_buffer.seek(0)
+    pdf_part = MIMEApplication(pdf_buffer.read(), _subtype='pdf')
     pdf_part.add_header('Content-Disposition', 'attachment', filename=file_name)
     msg.attach(pdf_part)
 
@@ -102,108 +154,78 @@ def get_org_name(cursor, org_uuid):
     return name
 
 
-def get_org_functional_test_results(cursor, org_uuid):
-    logging.info("Getting organisations monthly emergency device results...")
+def get_org_test_results(cursor, org_uuid):
+    logging.info("Getting organisations emergency device results...")
 
+    # functional (1) and discharge (2) results in one pass, ordered the same way as get_org_devices
     sql = f"""
-        SELECT 
-            deviceUUID,
-            result,
-            result_timestamp
-        FROM {database_dict['schema']}.{database_dict['emergency_functional_test_result_table']}
-        WHERE organisationUUID = %s
-          AND result_timestamp >= DATE_FORMAT(CURDATE(), '%Y-01-01');
-    """
+        SELECT
+            r.deviceUUID,
+            r.test_type_id,
+            DATE_FORMAT(r.result_timestamp, '%Y-%m-%d') AS result_date,
+            r.result_value
+        FROM (
+            SELECT deviceUUID, 1 AS test_type_id, result AS result_value, result_timestamp
+            FROM {database_dict['schema']}.{database_dict['emergency_functional_test_result_table']}
+            WHERE organisationUUID = %s
+              AND result_timestamp >= DATE_FORMAT(CURDATE(), '%Y-01-01')
 
-    cursor.execute(sql, (org_uuid,))
-    results = cursor.fetchall()
-
-    mapped_results = {}
-
-    if results:
-
-        for row in results:
-            device_uuid, result_value, result_time = row
-
-            # Initialise dicts if needed
-            if device_uuid not in mapped_results:
-                mapped_results[device_uuid] = {}
-            if 1 not in mapped_results[device_uuid]:
-                mapped_results[device_uuid][1] = {}
-
-            # Map timestamp to result
-            mapped_results[device_uuid][1][int(result_time.timestamp())] = result_value
-
-    return mapped_results
-
-
-def get_org_discharge_test_results(cursor, org_uuid):
-    logging.info("Getting organisations yearly emergency device results...")
+            UNION ALL
 
-    sql = f"""
-        SELECT 
-            deviceUUID,
-            discharge_time AS result,
-            result_timestamp
-        FROM {database_dict['schema']}.{database_dict['emergency_discharge_test_result_table']}
-        WHERE organisationUUID = %s
-          AND result_timestamp >= DATE_FORMAT(CURDATE(), '%Y-01-01');
+            SELECT deviceUUID, 2 AS test_type_id, discharge_time AS result_value, result_timestamp
+            FROM {database_dict['schema']}.{database_dict['emergency_discharge_test_result_table']}
+            WHERE organisationUUID = %s
+              AND result_timestamp >= DATE_FORMAT(CURDATE(), '%Y-01-01')
+        ) r
+        INNER JOIN {database_dict['schema']}.{database_dict['devices_table']} d ON r.deviceUUID = d.deviceUUID
+        ORDER BY d.device_name, d.deviceUUID, r.test_type_id, r.result_timestamp
     """
 
-    cursor.execute(sql, (org_uuid,))
-    results = cursor.fetchall()
+    cursor.execute(sql, (org_uuid, org_uuid))
 
-    mapped_results = {}
+    # rows are streamed from the cursor rather than fetched into a list
+    return cursor
 
-    if results:
-        for row in results:
-            device_uuid, result_value, result_time = row
 
-            # Initialise dicts if needed
-            if device_uuid not in mapped_results:
-                mapped_results[device_uuid] = {}
-            if 2 not in mapped_results[device_uuid]:
-                mapped_results[device_uuid][2] = {}
+def iter_device_sections(devices, result_rows):
+    """Yield a report section per device from result rows of (deviceUUID, test_type_id, result_date, result_value),
+    both ordered by device name then device UUID"""
 
-            # Map timestamp to result
-            mapped_results[device_uuid][2][int(result_time.timestamp())] = result_value
+    logging.info("Building device report sections...")
 
-    return mapped_results
+    device_uuids = {device["device_uuid"] for device in devices}
+    result_rows = iter(result_rows)
+    row = next(result_rows, None)
+    previous_uuid = None
+    previous_results = None
 
-def merge_device_data(devices, functional_results, discharge_results):
+    for device in devices:
+        device_uuid = device["device_uuid"]
 
-    logging.info("Merging all datasets...")
+        if device_uuid == previous_uuid:
+            # device listed twice (e.g. pools at equal depth), its results were already consumed
+            device_results = previous_results
+        else:
+            device_results = {"1": {}, "2": {}}
 
-    merged = []
+            while row is not None and (row[0] == device_uuid or row[0] not in device_uuids):
+                result_device_uuid, test_type_id, result_date, result_value = row
+                if result_device_uuid == device_uuid:
+                    # later results on the same day replace earlier ones
+                    device_results[str(test_type_id)][result_date] = result_value
+                row = next(result_rows, None)
 
-    for device in devices:
-        device_uuid = device["device_uuid"]
+        previous_uuid = device_uuid
+        previous_results = device_results
 
-        # Base structure
-        device_entry = {
+        yield {
             "device_long_address": device["long_address"],
             "device_name": device["device_name"],
             "group_name": device["device_group"],
-            "1": {},
-            "2": {}
+            "1": device_results["1"],
+            "2": device_results["2"]
         }
 
-        # Functional results
-        if device_uuid in functional_results and 1 in functional_results[device_uuid]:
-            for ts, value in functional_results[device_uuid][1].items():
-                date_str = datetime.fromtimestamp(ts).strftime("%Y-%m-%d")
-                device_entry["1"][date_str] = value
-
-        # Discharge results
-        if device_uuid in discharge_results and 2 in discharge_results[device_uuid]:
-            for ts, value in discharge_results[device_uuid][2].items():
-                date_str = datetime.fromtimestamp(ts).strftime("%Y-%m-%d")
-                device_entry["2"][date_str] = value
-
-        merged.append(device_entry)
-
-    return merged
-
 
 def get_org_devices(cursor, org_uuid, device_type_id):
     import logging
@@ -250,7 +272,7 @@ def get_org_devices(cursor, org_uuid, device_type_id):
             GROUP BY deviceUUID
         ) deepest 
         ON ph.deviceUUID = deepest.deviceUUID AND ph.depth = deepest.max_depth
-        ORDER BY ph.device_name;
+        ORDER BY ph.device_name, ph.deviceUUID;
     """
 
     # Execute with both org_uuid and device_type_id
@@ -283,6 +305,50 @@ def fetch_s3_file(bucket, key):
     return io.BytesIO(obj["Body"].read())
 
 
+def get_s3_etag(bucket, key):
+    return s3.head_object(Bucket=bucket, Key=key)["ETag"]
+
+
+def calculate_report_fingerprint(org_name, device_data, template_etag):
+    # the report date is part of the rendered template so a cached report is only reused on the same day
+    fingerprint_source = json.dumps({
+        "org_name": org_name,
+        "report_date": datetime.today().strftime('%d/%m/%Y'),
+        "template_etag": template_etag,
+        "devices": device_data,
+    }, sort_keys=True, default=str)
+
+    return hashlib.sha256(fingerprint_source.encode("utf-8")).hexdigest()
+
+
+def get_cached_report_key(org_uuid, year, report_fingerprint):
+    logging.info("Checking for an unchanged stored report...")
+
+    latest_key = None
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=OUTPUT_BUCKET, Prefix=f"{org_uuid}/{year}/"):
+        for obj in page.get("Contents", []):
+            # keys are timestamp prefixed so the greatest key is the most recent report
+            if latest_key is None or obj["Key"] > latest_key:
+                latest_key = obj["Key"]
+
+    if latest_key is None:
+        return None
+
+    metadata = s3.head_object(Bucket=OUTPUT_BUCKET, Key=latest_key).get("Metadata", {})
+    if metadata.get(REPORT_FINGERPRINT_METADATA_KEY) == report_fingerprint:
+        return latest_key
+
+    return None
+
+
+def download_s3_file_to(bucket, key, file_obj):
+    obj = s3.get_object(Bucket=bucket, Key=key)
+    shutil.copyfileobj(obj["Body"], file_obj)
+    file_obj.seek(0)
+    return file_obj
+
+
 
 
 def s3_image_to_rl_image(image_key, width=12, height=12):
@@ -304,6 +370,7 @@ def calculate_health_percentage(seconds):
         return round((seconds - lower_threshold) / (upper_threshold - lower_threshold) * 100)
 
 
+@functools.lru_cache(maxsize=512)
 def format_date(date_str):
     try:
         return datetime.strptime(date_str, "%Y-%m-%d").strftime("%d-%b")
@@ -311,6 +378,25 @@ def format_date(date_str):
         return date_str
 
 
+def get_result_icon_key(value, is_functional=True):
+    if is_functional:
+        return "BatteryReport-114.png" if value else "BatteryReport-116.png"
+
+    if value <= lower_threshold:
+        return "BatteryReport-116.png"
+    elif value >= upper_threshold:
+        return "BatteryReport-114.png"
+    else:
+        return "BatteryReport-115.png"
+
+
+def format_discharge_result(value):
+    hours, mins = value // 3600, (value % 3600) // 60
+    time_str = f"{hours} Hours {mins} Mins"
+    health_percent = max(0, min(100, int((value - 10800) / 3600 * 100)))
+    return f"{health_percent}%", time_str
+
+
 def build_horizontal_wrapped_tables(test_data, is_functional=True, page_width=A4[0]):
     logging.info("Adding wrapped mini tables...")
 
@@ -324,47 +410,28 @@ def build_horizontal_wrapped_tables(test_data, is_functional=True, page_width=A4
     max_width = page_width - 40
 
     for timestamp, value in sorted_items:
+        icon_key = get_result_icon_key(value, is_functional)
+
         if is_functional:
-            icon_key = "BatteryReport-114.png" if value else "BatteryReport-116.png"
             mini_table_data = [[format_date(timestamp), s3_image_to_rl_image(icon_key)]]
             mini_table_width = 60
         else:
-            if value <= lower_threshold:
-                icon_key = "BatteryReport-116.png"
-            elif value >= upper_threshold:
-                icon_key = "BatteryReport-114.png"
-            else:
-                icon_key = "BatteryReport-115.png"
-
-            hours, mins = value // 3600, (value % 3600) // 60
-            time_str = f"{hours} Hours {mins} Mins"
-            health_percent = max(0, min(100, int((value - 10800) / 3600 * 100)))
+            health_str, time_str = format_discharge_result(value)
 
             mini_table_data = [
-                ["Test Date", "Battery Health", "Discharge Time", "Result"],
-                [format_date(timestamp), f"{health_percent}%", time_str,
+                DISCHARGE_HEADER_ROW,
+                [format_date(timestamp), health_str, time_str,
                  s3_image_to_rl_image(icon_key)]
             ]
             mini_table_width = 100
 
         mini_table = Table(mini_table_data)
-        style_list = [
-            ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
-            ("ALIGN", (0, 0), (-1, -1), "CENTER"),
-            ("GRID", (0, 0), (-1, -1), 0.3, colors.black),
-            ("BOTTOMPADDING", (0, 0), (-1, -1), 2),
-            ("TOPPADDING", (0, 0), (-1, -1), 2),
-            ("LEFTPADDING", (0, 0), (-1, -1), 4),
-            ("RIGHTPADDING", (0, 0), (-1, -1), 4),
-        ]
-        if not is_functional:
-            style_list.append(("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#CBEDF4")))
-        mini_table.setStyle(style_list)
+        mini_table.setStyle(FUNCTIONAL_RESULTS_STYLE if is_functional else DISCHARGE_RESULTS_STYLE)
 
         if current_width + mini_table_width > max_width:
             if current_row:
                 row_table = Table([current_row], hAlign="LEFT")
-                row_table.setStyle(TableStyle([("VALIGN", (0, 0), (-1, -1), "TOP")]))
+                row_table.setStyle(WRAPPED_ROW_STYLE)
                 rows_tables.append(row_table)
             current_row = []
             current_width = LEFT_MARGIN
@@ -374,14 +441,111 @@ def build_horizontal_wrapped_tables(test_data, is_functional=True, page_width=A4
 
     if current_row:
         row_table = Table([current_row], hAlign="LEFT")
-        row_table.setStyle(TableStyle([("VALIGN", (0, 0), (-1, -1), "TOP")]))
+        row_table.setStyle(WRAPPED_ROW_STYLE)
         rows_tables.append(row_table)
 
     return rows_tables
 
-def generate_final_pdf_buffer(example_data, org_name, template_pdf_buffer):
 
-    logging.info("Generating pdf to buffer...")
+def build_compact_results_table(test_data, is_functional=True):
+    # One table per device and test type instead of a table per result wrapped in row tables
+    sorted_items = sorted(test_data.items())
+
+    if is_functional:
+        cells = []
+        for timestamp, value in sorted_items:
+            cells.append(format_date(timestamp))
+            cells.append(s3_image_to_rl_image(get_result_icon_key(value, True)))
+
+        row_length = FUNCTIONAL_RESULTS_PER_ROW * 2
+        table_data = [cells[i:i + row_length] for i in range(0, len(cells), row_length)]
+
+        # pad the last row so the table stays rectangular
+        table_data[-1] = table_data[-1] + [""] * (row_length - len(table_data[-1]))
+        style = FUNCTIONAL_RESULTS_STYLE
+    else:
+        table_data = [DISCHARGE_HEADER_ROW]
+        for timestamp, value in sorted_items:
+            health_str, time_str = format_discharge_result(value)
+            table_data.append([format_date(timestamp), health_str, time_str,
+                               s3_image_to_rl_image(get_result_icon_key(value, False))])
+        style = DISCHARGE_RESULTS_STYLE
+
+    results_table = Table(table_data, hAlign="LEFT", repeatRows=0 if is_functional else 1)
+    results_table.setStyle(style)
+
+    return results_table
+
+class S3MultipartWriter:
+    """Write only file object streaming its contents into an S3 multipart upload,
+    optionally mirroring every write into a second file (e.g. for the email attachment)"""
+
+    def __init__(self, bucket, key, content_type="application/pdf", part_size=S3_MULTIPART_PART_SIZE, mirror=None,
+                 metadata=None):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.mirror = mirror
+        self.parts = []
+        self.pending = bytearray()
+        self.position = 0
+
+        response = s3.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type,
+                                              Metadata=metadata or {})
+        self.upload_id = response["UploadId"]
+
+    def write(self, data):
+        self.pending += data
+        self.position += len(data)
+
+        if self.mirror is not None:
+            self.mirror.write(data)
+
+        if len(self.pending) >= self.part_size:
+            self.upload_pending_part()
+
+        return len(data)
+
+    def tell(self):
+        # PdfWriter records object offsets using tell()
+        return self.position
+
+    def flush(self):
+        pass
+
+    def upload_pending_part(self):
+        part_number = len(self.parts) + 1
+        response = s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=bytes(self.pending)
+        )
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self.pending = bytearray()
+
+    def close(self):
+        logging.info("Completing s3 multipart upload...")
+
+        # the final part may be smaller than the 5MB multipart minimum
+        if self.pending or not self.parts:
+            self.upload_pending_part()
+
+        s3.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts}
+        )
+
+    def abort(self):
+        logging.error("Aborting s3 multipart upload...")
+        s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+def fill_template_pdf(template_pdf_buffer, org_name):
+    logging.info("Filling pdf template...")
 
     reader = PdfReader(template_pdf_buffer)
     writer = PdfWriter()
@@ -407,14 +571,18 @@ def generate_final_pdf_buffer(example_data, org_name, template_pdf_buffer):
     writer.write(filled_pdf_buffer)
     filled_pdf_buffer.seek(0)
 
+    return filled_pdf_buffer
+
+
+def render_device_tables(devices, leading_space=0, compact_tables=True):
     tables_buffer = io.BytesIO()
     doc = SimpleDocTemplate(tables_buffer, pagesize=A4)
     elements = []
-    styles = getSampleStyleSheet()
 
-    elements.append(Spacer(1, 175))
+    if leading_space:
+        elements.append(Spacer(1, leading_space))
 
-    for device in example_data:
+    for device in devices:
         # Device Table
         device_table_data = [
             ["Device ID", "Device Name", "Group Name"],
@@ -425,17 +593,15 @@ def generate_final_pdf_buffer(example_data, org_name, template_pdf_buffer):
             ]
         ]
         device_table = Table(device_table_data, colWidths=[150, 150, 150], hAlign='LEFT')
-        device_table.setStyle(TableStyle([
-            ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#CBEDF4")),
-            ("GRID", (0, 0), (-1, -1), 1, colors.black),
-            ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-        ]))
+        device_table.setStyle(DEVICE_TABLE_STYLE)
         elements.append(device_table)
         elements.append(Spacer(1, 8))
 
         # Functional Tests
         elements.append(Paragraph("Functional Tests", styles["Heading4"]))
-        if device.get("1"):
+        if device.get("1") and compact_tables:
+            elements.append(build_compact_results_table(device["1"], True))
+        elif device.get("1"):
             func_rows = build_horizontal_wrapped_tables(device["1"], True)
             for row in func_rows:
                 elements.append(row)
@@ -446,7 +612,9 @@ def generate_final_pdf_buffer(example_data, org_name, template_pdf_buffer):
 
         # Discharge Tests
         elements.append(Paragraph("Discharge Tests", styles["Heading4"]))
-        if device.get("2"):
+        if device.get("2") and compact_tables:
+            elements.append(build_compact_results_table(device["2"], False))
+        elif device.get("2"):
             discharge_rows = build_horizontal_wrapped_tables(device["2"], False)
             for row in discharge_rows:
                 elements.append(row)
@@ -461,27 +629,113 @@ def generate_final_pdf_buffer(example_data, org_name, template_pdf_buffer):
     doc.build(elements)
     tables_buffer.seek(0)
 
-    # 3️⃣ Merge PDFs
+    return tables_buffer
+
+
+def preload_result_icons():
+    # warm the image cache before forking so workers don't each fetch the icons from s3
+    for icon_key in RESULT_ICON_KEYS:
+        if icon_key not in image_cache:
+            image_cache[icon_key] = fetch_s3_file(RESOURCES_BUCKET, icon_key)
+
+
+def render_chunk_worker(devices, leading_space, compact_tables, send_conn):
+    try:
+        tables_buffer = render_device_tables(devices, leading_space, compact_tables)
+        send_conn.send_bytes(tables_buffer.getvalue())
+    finally:
+        send_conn.close()
+
+
+def render_device_tables_in_parallel(devices, chunk_size=PARALLEL_RENDER_CHUNK_SIZE, max_workers=None,
+                                     compact_tables=True):
+    logging.info("Rendering device tables in parallel chunks...")
+
+    preload_result_icons()
+
+    max_workers = max_workers or os.cpu_count() or 1
+    chunks = [devices[i:i + chunk_size] for i in range(0, len(devices), chunk_size)]
+    fragments = [None] * len(chunks)
+
+    # Lambda has no /dev/shm so multiprocessing.Pool and ProcessPoolExecutor are unavailable,
+    # run the chunks as plain processes reporting back over pipes instead
+    for wave_start in range(0, len(chunks), max_workers):
+        running = []
+
+        try:
+            for index in range(wave_start, min(wave_start + max_workers, len(chunks))):
+                recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+                leading_space = FIRST_PAGE_HEADER_SPACE if index == 0 else 0
+                process = multiprocessing.Process(
+                    target=render_chunk_worker,
+                    args=(chunks[index], leading_space, compact_tables, send_conn)
+                )
+                process.start()
+                send_conn.close()
+                running.append((index, process, recv_conn))
+
+            for index, process, recv_conn in running:
+                try:
+                    fragments[index] = io.BytesIO(recv_conn.recv_bytes())
+                except EOFError:
+                    raise Exception(f"Rendering failed for device chunk {index}")
+        finally:
+            # on a failure the rest of the wave is stopped rather than left running
+            for index, process, recv_conn in running:
+                recv_conn.close()
+                if process.is_alive() and fragments[index] is None:
+                    process.terminate()
+                process.join()
+
+    return fragments
+
+
+def merge_report_pages(filled_pdf_buffer, table_fragments, output_stream=None):
+    logging.info("Merging pdf pages...")
+
     form_pdf = PdfReader(filled_pdf_buffer)
-    tables_pdf = PdfReader(tables_buffer)
+    fragment_pdfs = [PdfReader(fragment) for fragment in table_fragments]
     final_writer = PdfWriter()
 
     first_page_form = form_pdf.pages[0]
-    first_page_table = tables_pdf.pages[0]
+    first_page_table = fragment_pdfs[0].pages[0]
     first_page_form.merge_page(first_page_table)
     final_writer.add_page(first_page_form)
 
-    for page in tables_pdf.pages[1:]:
+    for page in fragment_pdfs[0].pages[1:]:
         final_writer.add_page(page)
+    for fragment_pdf in fragment_pdfs[1:]:
+        for page in fragment_pdf.pages:
+            final_writer.add_page(page)
     for page in form_pdf.pages[1:]:
         final_writer.add_page(page)
 
+    if output_stream is not None:
+        final_writer.write(output_stream)
+        return output_stream
+
     final_buffer = io.BytesIO()
     final_writer.write(final_buffer)
     final_buffer.seek(0)
 
     return final_buffer
 
+
+def generate_final_pdf_buffer(example_data, org_name, template_pdf_buffer, compact_tables=True, parallel=False,
+                              output_stream=None):
+
+    logging.info("Generating pdf to buffer...")
+
+    filled_pdf_buffer = fill_template_pdf(template_pdf_buffer, org_name)
+
+    if parallel and len(example_data) > PARALLEL_RENDER_CHUNK_SIZE:
+        # chunks keep the incoming order, already sorted by the results query the same as the serial path
+        table_fragments = render_device_tables_in_parallel(example_data, compact_tables=compact_tables)
+    else:
+        table_fragments = [render_device_tables(example_data, FIRST_PAGE_HEADER_SPACE, compact_tables)]
+
+    return merge_report_pages(filled_pdf_buffer, table_fragments, output_stream)
+
 def lambda_handler(event, context):
     try:
         database_token = zanolambdashelper.helpers.generate_database_token(rds_client, rds_user, rds_host, rds_port,
@@ -514,17 +768,10 @@ def lambda_handler(event, context):
             org_name, = get_org_name(cursor, org_uuid)
 
             org_emergency_devices = get_org_devices(cursor,org_uuid,emergency_device_type_id)
-            functional_results = get_org_functional_test_results(cursor, org_uuid)
-            discharge_results = get_org_discharge_test_results(cursor, org_uuid)
-            device_data_merged = merge_device_data(org_emergency_devices,functional_results,discharge_results)
-
-            template_pdf_buffer = fetch_s3_file(RESOURCES_BUCKET, PDF_TEMPLATE_KEY)
+            org_test_results = get_org_test_results(cursor, org_uuid)
 
-            final_buffer = generate_final_pdf_buffer(
-                device_data_merged,
-                org_name,
-                template_pdf_buffer
-            )
+            # materialised once as the fingerprint needs every section before deciding whether to render
+            device_data_merged = list(iter_device_sections(org_emergency_devices, org_test_results))
 
             # Timestamped filename
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -532,16 +779,36 @@ def lambda_handler(event, context):
 
             output_key = f"{org_uuid}/{current_year}/{timestamp}_report.pdf"
 
-            logging.info("Upload to s3...")
-            # Upload to S3
-            s3.put_object(
-                Bucket=OUTPUT_BUCKET,
-                Key=output_key,
-                Body=final_buffer.getvalue(),
-                ContentType="application/pdf"
-            )
-            logging.info("Send to user email...")
-            send_pdf_via_ses(sender_email, user_email, final_buffer, f"{timestamp}_emergency_lighting_report.pdf")
+            template_etag = get_s3_etag(RESOURCES_BUCKET, PDF_TEMPLATE_KEY)
+            report_fingerprint = calculate_report_fingerprint(org_name, device_data_merged, template_etag)
+            cached_report_key = get_cached_report_key(org_uuid, current_year, report_fingerprint)
+
+            with tempfile.SpooledTemporaryFile(max_size=REPORT_SPOOL_MAX_SIZE) as report_file:
+                if cached_report_key:
+                    logging.info("Report unchanged, sending stored report...")
+                    download_s3_file_to(OUTPUT_BUCKET, cached_report_key, report_file)
+                    timestamp = cached_report_key.split("/")[-1].replace("_report.pdf", "")
+                else:
+                    template_pdf_buffer = fetch_s3_file(RESOURCES_BUCKET, PDF_TEMPLATE_KEY)
+
+                    logging.info("Streaming pdf to s3...")
+                    s3_writer = S3MultipartWriter(OUTPUT_BUCKET, output_key, mirror=report_file,
+                                                  metadata={REPORT_FINGERPRINT_METADATA_KEY: report_fingerprint})
+                    try:
+                        generate_final_pdf_buffer(
+                            device_data_merged,
+                            org_name,
+                            template_pdf_buffer,
+                            parallel=len(device_data_merged) > PARALLEL_RENDER_THRESHOLD,
+                            output_stream=s3_writer
+                        )
+                        s3_writer.close()
+                    except Exception:
+                        s3_writer.abort()
+                        raise
+
+                logging.info("Send to user email...")
+                send_pdf_via_ses(sender_email, user_email, report_file, f"{timestamp}_emergency_lighting_report.pdf")
 
     except Exception as e:
         logging.error(f"Internal Server Error: {e}")
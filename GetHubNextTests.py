@@ -0,0 +1,147 @@
+import boto3
+import json
+from datetime import datetime, timedelta
+import mysql.connector
+import os
+import base64
+import logging
+import traceback
+import re
+import random
+import string
+import zanolambdashelper
+
+database_details = zanolambdashelper.helpers.get_db_details()
+
+rds_host = database_details['rds_host']
+rds_port = database_details['rds_port']
+rds_db = database_details['rds_db']
+rds_user = database_details['rds_user']
+rds_region = database_details['rds_region']
+
+database_dict = zanolambdashelper.helpers.get_database_dict()
+
+rds_client = zanolambdashelper.helpers.create_client('rds')
+
+zanolambdashelper.helpers.set_logging('INFO')
+
+default_window_hours = 24
+max_window_hours = 7 * 24
+
+
+def get_user_hub(cursor, user_uuid):
+    logging.info("Getting hub for hub user...")
+
+    sql = f"""
+        SELECT hubUUID
+        FROM {database_dict['schema']}.{database_dict['users_table']}
+        WHERE userUUID = %s AND hub_user = 1
+        LIMIT 1
+    """
+    cursor.execute(sql, (user_uuid,))
+    result = cursor.fetchone()
+
+    if result is None or result[0] is None:
+        raise Exception(403, "User is not a hub")
+
+    return result[0]
+
+
+def get_hub_next_tests(cursor, org_uuid, hub_uuid, window_start, window_end):
+    logging.info("Getting upcoming emergency tests for hub...")
+
+    # served from the (associated_hub, test_time) index on the schedule table
+    sql = f"""
+        SELECT deviceUUID, test_type_id, UNIX_TIMESTAMP(test_time) AS test_time
+        FROM {database_dict['schema']}.{database_dict['emergency_test_schedule_table']}
+        WHERE associated_hub = %s
+          AND test_time >= %s AND test_time < %s
+          AND organisationUUID = %s
+        ORDER BY test_time
+    """
+    cursor.execute(sql, (hub_uuid, window_start, window_end, org_uuid))
+
+    # compact rows of [deviceUUID, test_type_id, test_time] so hubs can poll cheaply
+    return [[device_uuid, test_type_id, int(test_time)] for device_uuid, test_type_id, test_time in cursor.fetchall()]
+
+
+def lambda_handler(event, context):
+    try:
+        database_token = zanolambdashelper.helpers.generate_database_token(rds_client, rds_user, rds_host, rds_port,
+                                                                           rds_region)
+
+        conn = zanolambdashelper.helpers.initialise_connection(rds_user, database_token, rds_db, rds_host, rds_port)
+        conn.autocommit = False
+
+        auth_token = event['params']['header']['Authorization']
+        body_json = event.get('body-json') or {}
+        user_email = zanolambdashelper.helpers.decode_cognito_id_token(auth_token)
+
+        window_hours_raw = body_json.get('window_hours')
+        window_hours = default_window_hours
+
+        if window_hours_raw:  # optional, the default window is used without it
+            if not isinstance(window_hours_raw, dict) or 'value' not in window_hours_raw:
+                raise Exception(422, "window_hours must be given as a value")
+
+            variables = {
+                'window_hours': {'value': window_hours_raw['value'], 'value_type': 'id'},
+            }
+
+            logging.info("Validating and cleansing user inputs...")
+            variables = zanolambdashelper.helpers.validate_and_cleanse_values(variables)
+
+            try:
+                window_hours = int(variables['window_hours']['value'])
+            except (TypeError, ValueError):
+                raise Exception(422, "window_hours must be a whole number of hours")
+
+        if not 0 < window_hours <= max_window_hours:
+            raise Exception(422, f"window_hours must be between 1 and {max_window_hours}")
+
+        window_start = datetime.now()
+        window_end = window_start + timedelta(hours=window_hours)
+
+        with conn.cursor() as cursor:
+            user_uuid = zanolambdashelper.helpers.get_user_details_by_email(cursor,
+                                                                            database_dict['schema'],
+                                                                            database_dict['users_table'],
+                                                                            user_email)
+            org_uuid = zanolambdashelper.helpers.get_user_organisation_details(cursor,
+                                                                               database_dict['schema'],
+                                                                               database_dict[
+                                                                                   'users_organisations_table'],
+                                                                               user_uuid)
+
+            hub_uuid = get_user_hub(cursor, user_uuid)
+
+            next_tests = get_hub_next_tests(cursor, org_uuid, hub_uuid, window_start, window_end)
+
+    except Exception as e:
+        logging.error(f"Internal Server Error: {e}")
+        traceback.print_exc()
+        status_value = 500
+        body_value = 'Unable to get hub test schedule'
+        if len(e.args) >= 2 and isinstance(e.args[0], int):
+            status_value = e.args[0]
+            if status_value == 422 or status_value == 403:  # if 422 then validation error
+                body_value = e.args[1]
+        error_response = {
+            'statusCode': status_value,
+            'body': body_value,
+        }
+        return error_response
+
+    finally:
+        try:
+            cursor.close()
+            conn.close()
+        except NameError:  # catch potential error before cursor or conn is defined
+            pass
+
+    return {
+        'statusCode': 200,
+        'body': 'Obtained Hub Next Tests Successfully',
+        'to': int(window_end.timestamp()),
+        'tests': next_tests,
+    }
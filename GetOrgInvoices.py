@@ -10,6 +10,7 @@ import re
 import random
 import string
 import zanolambdashelper
+import StripeInvoices
 
 database_details = zanolambdashelper.helpers.get_db_details()
 
@@ -22,32 +23,43 @@ rds_region = database_details['rds_region']
 database_dict = zanolambdashelper.helpers.get_database_dict()
 
 rds_client = zanolambdashelper.helpers.create_client('rds')
-lambda_client = zanolambdashelper.helpers.create_client('lambda')
 
 zanolambdashelper.helpers.set_logging('INFO')
 
-stripe_org_invoices_lambda = "GetStripeOrgInvoices"
+# months of invoices returned per page, older months are fetched by passing back next_cursor
+default_invoice_months = 12
+max_invoice_months = 36
 
 
-def get_stripe_org_invoices(stripe_sub_id):
-    logging.info("Creating stripe org invoices...")
+def get_org_invoices(cursor, stripe_sub_id, before_month, months):
+    logging.info("Getting org invoices...")
 
-    # Run policy creation lambda
-    response = lambda_client.invoke(
-        FunctionName=stripe_org_invoices_lambda,
-        InvocationType='RequestResponse',
-        LogType='Tail',
-        Payload=json.dumps({'stripe_sub_id': stripe_sub_id})
-    )
+    # one invoice per month, the latest paid one, newest month first. the first page has no before_month bound
+    sql = f"""
+        SELECT YEAR(invoice_created) AS invoice_year, MONTH(invoice_created) AS invoice_month,
+        SUBSTRING_INDEX(GROUP_CONCAT(stripe_invoice_id ORDER BY invoice_created DESC), ',', 1) AS stripe_invoice_id
+        FROM {database_dict['schema']}.{StripeInvoices.stripe_invoices_table}
+        WHERE stripe_sub_id = %s AND status = 'paid' {'AND invoice_created < %s' if before_month else ''}
+        GROUP BY invoice_year, invoice_month
+        ORDER BY invoice_year DESC, invoice_month DESC
+        LIMIT %s
+    """
+    params = (stripe_sub_id, before_month, months + 1) if before_month else (stripe_sub_id, months + 1)
+    cursor.execute(sql, params)
+    rows = cursor.fetchall()
 
-    response_payload = json.loads(response['Payload'].read().decode('utf-8'))
-    logging.info(response_payload)
+    result = {}
+    for invoice_year, invoice_month, stripe_invoice_id in rows[:months]:
+        month = datetime(invoice_year, invoice_month, 1).strftime("%b")
+        result.setdefault(str(invoice_year), {})[month] = stripe_invoice_id
 
-    if response['StatusCode'] != 200 or response_payload['statusCode'] != 200:
-        logging.error(f"Lambda invocation failed, ResponsePayload: {response_payload}")
-        raise Exception(response_payload)
+    # the next page starts before the oldest month returned
+    next_cursor = None
+    if len(rows) > months:
+        invoice_year, invoice_month, _ = rows[months - 1]
+        next_cursor = f"{invoice_year:04d}-{invoice_month:02d}"
 
-    return response_payload['invoices']
+    return result, next_cursor
 
 
 def get_org_stripe_sub_id(cursor, org_uuid):
@@ -74,6 +86,46 @@ def lambda_handler(event, context):
         body_json = event['body-json']
         user_email = zanolambdashelper.helpers.decode_cognito_id_token(auth_token)
 
+        # cursor is a "YYYY-MM" month, only invoices from before that month are returned
+        cursor_raw = body_json.get('cursor')
+        months_raw = body_json.get('months')
+
+        variables = {}
+
+        if cursor_raw:  # add optionals if exists
+            if not isinstance(cursor_raw, dict) or 'value' not in cursor_raw:
+                raise Exception(422, "Invalid invoice cursor")
+            if cursor_raw['value']:  # an empty cursor is the first page
+                variables['cursor'] = {'value': cursor_raw['value'], 'value_type': 'string_input'}
+
+        if months_raw:
+            if not isinstance(months_raw, dict) or 'value' not in months_raw:
+                raise Exception(422, "Invalid number of months")
+            if months_raw['value']:
+                variables['months'] = {'value': months_raw['value'], 'value_type': 'id'}
+
+        if variables:
+            logging.info("Validating and cleansing user inputs...")
+            variables = zanolambdashelper.helpers.validate_and_cleanse_values(variables)
+
+        before_month = None
+        if 'cursor' in variables:
+            if not re.fullmatch(r"\d{4}-\d{2}", str(variables['cursor']['value'])):
+                raise Exception(422, "Invalid invoice cursor")
+            try:
+                before_month = datetime.strptime(variables['cursor']['value'], "%Y-%m")
+            except ValueError:
+                raise Exception(422, "Invalid invoice cursor")
+
+        months = default_invoice_months
+        if 'months' in variables:
+            try:
+                months = int(variables['months']['value'])
+            except (TypeError, ValueError):
+                raise Exception(422, "Invalid number of months")
+            if not 0 < months <= max_invoice_months:
+                raise Exception(422, f"Number of months must be between 1 and {max_invoice_months}")
+
         with conn.cursor() as cursor:
             user_uuid = zanolambdashelper.helpers.get_user_details_by_email(cursor,
                                                                             database_dict['schema'],
@@ -90,9 +142,11 @@ def lambda_handler(event, context):
                                                         database_dict['users_organisations_table'], user_uuid,
                                                         org_uuid)
 
+            invoices = {}
+            next_cursor = None
             stripe_sub_id, = get_org_stripe_sub_id(cursor, org_uuid)
             if stripe_sub_id:
-                invoices = get_stripe_org_invoices(stripe_sub_id)
+                invoices, next_cursor = get_org_invoices(cursor, stripe_sub_id, before_month, months)
 
     except Exception as e:
         logging.error(f"Internal Server Error: {e}")
@@ -120,4 +174,5 @@ def lambda_handler(event, context):
         'statusCode': 200,
         'body': 'Org Invoices Returned Successfully',
         'invoices': invoices,
+        'next_cursor': next_cursor,
     }
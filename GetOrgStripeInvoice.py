@@ -10,6 +10,7 @@ import re
 import random
 import string
 import zanolambdashelper
+import StripeInvoices
 
 database_details = zanolambdashelper.helpers.get_db_details()
 
@@ -28,26 +29,65 @@ zanolambdashelper.helpers.set_logging('INFO')
 
 stripe_org_invoice_lambda = "GetStripeInvoice"
 
+s3 = zanolambdashelper.helpers.create_client('s3')
 
-def get_stripe_org_invoice(invoice_id):
+
+def get_stripe_org_invoice(invoice_id, stripe_sub_id):
     logging.info("Getting stripe invoice url...")
 
-    # Run policy creation lambda
+    # the subscription is checked by GetStripeInvoice before it copies anything to S3
     response = lambda_client.invoke(
         FunctionName=stripe_org_invoice_lambda,
         InvocationType='RequestResponse',
         LogType='Tail',
-        Payload=json.dumps({'stripe_invoice_id': invoice_id})
+        Payload=json.dumps({'stripe_invoice_id': invoice_id, 'stripe_sub_id': stripe_sub_id})
     )
 
     response_payload = json.loads(response['Payload'].read().decode('utf-8'))
     logging.info(response_payload)
 
+    if response['StatusCode'] == 200 and response_payload.get('statusCode') == 404:
+        raise Exception(404, "Invoice not found")
+
     if response['StatusCode'] != 200 or response_payload['statusCode'] != 200:
         logging.error(f"Lambda invocation failed, ResponsePayload: {response_payload}")
         raise Exception(response_payload)
 
-    return response_payload['url']
+    return response_payload
+
+
+def get_org_stripe_sub_id(cursor, org_uuid):
+    logging.info("Getting stripe sub id...")
+    sql = f"SELECT stripe_sub_id FROM {database_dict['schema']}.{database_dict['organisations_table']} WHERE organisationUUID = %s"
+
+    cursor.execute(sql, (org_uuid,))
+    result = cursor.fetchone()
+    if result and result[0]:
+        return result[0]
+    else:
+        raise Exception(404, "No subscription for organisation")
+
+
+def get_cached_invoice_key(cursor, invoice_id, stripe_sub_id):
+    logging.info("Checking invoice cache...")
+
+    sql = f"""
+        SELECT stripe_sub_id, pdf_s3_key
+        FROM {database_dict['schema']}.{StripeInvoices.stripe_invoices_table}
+        WHERE stripe_invoice_id = %s
+    """
+    cursor.execute(sql, (invoice_id,))
+    result = cursor.fetchone()
+
+    if not result:
+        return None
+
+    invoice_sub_id, pdf_s3_key = result
+    if invoice_sub_id != stripe_sub_id:
+        # indexed against another subscription, refused without going to Stripe
+        raise Exception(404, "Invoice not found")
+
+    return pdf_s3_key
 
 
 def lambda_handler(event, context):
@@ -79,7 +119,22 @@ def lambda_handler(event, context):
                                                         database_dict['users_organisations_table'], user_uuid,
                                                         org_uuid)
 
-            invoice_url = get_stripe_org_invoice(stripe_invoice_id)
+            stripe_sub_id = get_org_stripe_sub_id(cursor, org_uuid)
+
+            # paid invoices already copied to S3 are served without going to Stripe
+            pdf_s3_key = get_cached_invoice_key(cursor, stripe_invoice_id, stripe_sub_id)
+            if pdf_s3_key:
+                invoice_url = StripeInvoices.get_invoice_pdf_url(s3, pdf_s3_key)
+            else:
+                response_payload = get_stripe_org_invoice(stripe_invoice_id, stripe_sub_id)
+                invoice = response_payload['invoice']
+
+                if invoice['subscription'] != stripe_sub_id:
+                    raise Exception(404, "Invoice not found")
+
+                invoice_url = response_payload['url']
+                StripeInvoices.set_invoice(cursor, database_dict['schema'], invoice, invoice['pdf_s3_key'])
+                conn.commit()
 
     except Exception as e:
         logging.error(f"Internal Server Error: {e}")
@@ -88,7 +143,7 @@ def lambda_handler(event, context):
         body_value = 'Unable to get org invoice'
         if len(e.args) >= 2 and isinstance(e.args[0], int):
             status_value = e.args[0]
-            if status_value == 422:  # if 422 then validation error
+            if status_value == 422 or status_value == 404:  # if 422 then validation error
                 body_value = e.args[1]
         error_response = {
             'statusCode': status_value,
@@ -10,7 +10,10 @@ import traceback
 import re
 import random
 import string
+import urllib.request
+from botocore.exceptions import ClientError
 import zanolambdashelper
+import StripeInvoices
 
 stripe_secrets = zanolambdashelper.helpers.get_stripe_api_secrets()
 
@@ -18,6 +21,34 @@ STRIPE_API_SECRET = stripe_secrets['api_key']
 
 stripe.api_key = STRIPE_API_SECRET
 
+zanolambdashelper.helpers.set_logging('INFO')
+
+s3 = zanolambdashelper.helpers.create_client('s3')
+
+
+def is_invoice_pdf_in_s3(key):
+    try:
+        s3.head_object(Bucket=StripeInvoices.invoice_bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+
+def copy_invoice_pdf_to_s3(invoice_id, pdf_url):
+    # paid invoices don't change so their PDF is copied to S3 once and served from there
+    key = StripeInvoices.get_invoice_pdf_key(invoice_id)
+    if is_invoice_pdf_in_s3(key):
+        return key
+
+    logging.info(f"Copying invoice {invoice_id} PDF to S3...")
+
+    with urllib.request.urlopen(pdf_url, timeout=20) as response:
+        s3.upload_fileobj(response, StripeInvoices.invoice_bucket, key, ExtraArgs={"ContentType": "application/pdf"})
+
+    return key
+
 
 def lambda_handler(event, context):
     try:
@@ -42,11 +73,33 @@ def lambda_handler(event, context):
                 "body": "Invoice URL not available"
             }
 
+        # callers pass the subscription they're allowed to see, nothing is copied for anyone else's invoice
+        stripe_sub_id = event.get("stripe_sub_id")
+        if stripe_sub_id and StripeInvoices.get_invoice_subscription_id(invoice) != stripe_sub_id:
+            return {
+                "statusCode": 404,
+                "body": "Invoice not found"
+            }
+
+        pdf_s3_key = None
+        if invoice.status == "paid":
+            pdf_s3_key = copy_invoice_pdf_to_s3(invoice.id, pdf_url)
+            pdf_url = StripeInvoices.get_invoice_pdf_url(s3, pdf_s3_key)
+
         return {
             "statusCode": 200,
             "body": "Invoice URL retrieved",
-            "url": pdf_url
-
+            "url": pdf_url,
+            "invoice": {
+                "id": invoice.id,
+                "subscription": StripeInvoices.get_invoice_subscription_id(invoice),
+                "status": invoice.status,
+                "number": invoice.get("number"),
+                "amount_paid": invoice.get("amount_paid"),
+                "currency": invoice.get("currency"),
+                "created": invoice.created,
+                "pdf_s3_key": pdf_s3_key
+            }
         }
 
     except Exception as e:
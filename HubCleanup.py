@@ -9,7 +9,10 @@ import traceback
 import re
 import random
 import string
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 import zanolambdashelper
+import IoTPolicies
 
 database_details = zanolambdashelper.helpers.get_db_details()
 
@@ -28,7 +31,14 @@ zanolambdashelper.helpers.set_logging('INFO')
 
 delete_account_from_cognito_lambda = "DeleteHubAccountsFromCognito"
 delete_thing_from_iot_core_lambda = "DeleteThingFromIOTCore"
-policy_detatch_lambda = "DetachPolicy"
+hub_cleanup_tasks_table = 'hub_cleanup_tasks'
+
+# the cognito, iot and per policy cleanups run in parallel
+max_cleanup_workers = 8
+# a task still failing after this many runs is set aside with its last error so it doesn't fail every later run
+max_task_attempts = 5
+# finished and set aside tasks are purged once older than this
+cleanup_task_retention_days = 30
 
 
 def get_hub_uuids(cursor):
@@ -108,6 +118,16 @@ def delete_users_from_cognito(lambda_client, emails):
         logging.error(f"Lambda invocation failed, ResponsePayload: {response_payload}")
         raise Exception(response_payload)
 
+    payload_dict = json.loads(response_payload)
+    if payload_dict.get("statusCode") != 200:
+        logging.error(f"Lambda invocation failed, ResponsePayload: {response_payload}")
+        raise Exception(response_payload)
+
+    # users that failed to delete are left for the retry
+    failed = json.loads(payload_dict.get('body', '{}')).get('failed')
+    if failed:
+        raise Exception(f"Failed to delete cognito users: {failed}")
+
 
 def delete_users_from_iotcore(lambda_client, hub_uuids):
     response = lambda_client.invoke(
@@ -127,27 +147,107 @@ def delete_users_from_iotcore(lambda_client, hub_uuids):
         raise Exception(response_payload)
 
 
-def detach_users_from_policy(lambda_client, user_identities):
-    logging.info("Detaching hub users from their policies...")
+def detach_users_from_policy(policy_name, user_identities):
+    logging.info(f"Detaching {len(user_identities)} hub users from policy '{policy_name}'...")
 
-    for identity_pool_id, policy_name in user_identities:
-        logging.info(f"Detaching identity '{identity_pool_id}' from policy '{policy_name}'")
+    # detached in process, the shared iot client's adaptive retries pace the calls across policy tasks
+    failed = IoTPolicies.detach_policies([(policy_name, user_identity) for user_identity in user_identities])
 
-        response = lambda_client.invoke(
-            FunctionName=policy_detatch_lambda,
-            InvocationType='RequestResponse',
-            LogType='Tail',
-            Payload=json.dumps({
-                "policy_name": policy_name,
-                "user_identity": identity_pool_id
-            })
-        )
+    if failed:
+        logging.error(f"Policy detach failed for policy {policy_name}: {failed}")
+        raise Exception(f"Unable to detach policy {policy_name} from {len(failed)} identities")
 
-        response_payload = response['Payload'].read().decode('utf-8')
 
-        if response['StatusCode'] != 200 or 'errorMessage' in response_payload:
-            logging.error(f"Lambda invocation failed for identity {identity_pool_id}. Response: {response_payload}")
-            raise Exception(response_payload)
+def build_cleanup_tasks(emails, identity_policy_tuples):
+    identities_by_policy = {}
+    for identity_pool_id, policy_name in identity_policy_tuples:
+        identities_by_policy.setdefault(policy_name, []).append(identity_pool_id)
+
+    # the iot sweep reads the hubs still in the db when it runs, so a retry never removes a newer hub's thing
+    tasks = {'cognito': {'users': emails}, 'iot': {}}
+    for policy_name, identities in identities_by_policy.items():
+        tasks[f"policy:{policy_name}"] = {'policy_name': policy_name, 'user_identities': identities}
+
+    return tasks
+
+
+def record_cleanup_tasks(cursor, run_id, tasks):
+    logging.info("Recording hub cleanup tasks...")
+
+    sql = f"""
+        INSERT INTO {database_dict['schema']}.{hub_cleanup_tasks_table} (run_id, task, payload)
+        VALUES {','.join(['(%s, %s, %s)'] * len(tasks))}
+    """
+    cursor.execute(sql, tuple(value for task, payload in tasks.items() for value in (run_id, task, json.dumps(payload))))
+
+
+def get_pending_cleanup_tasks(cursor):
+    logging.info("Fetching pending hub cleanup tasks...")
+
+    # includes tasks left over from earlier runs that failed
+    sql = f"""
+        SELECT run_id, task, payload, attempts
+        FROM {database_dict['schema']}.{hub_cleanup_tasks_table}
+        WHERE completed_at IS NULL
+        ORDER BY created_at
+    """
+    cursor.execute(sql)
+    return [(run_id, task, json.loads(payload), attempts) for run_id, task, payload, attempts in cursor.fetchall()]
+
+
+def set_cleanup_task_result(cursor, run_id, task, attempts, error):
+    # after the last attempt the task is marked completed with its error kept for investigation
+    sql = f"""
+        UPDATE {database_dict['schema']}.{hub_cleanup_tasks_table}
+        SET attempts = %s, last_error = %s,
+            completed_at = IF(%s IS NULL OR %s >= %s, CURRENT_TIMESTAMP, NULL)
+        WHERE run_id = %s AND task = %s
+    """
+    message = str(error)[:1000] if error is not None else None
+    cursor.execute(sql, (attempts, message, message, attempts, max_task_attempts, run_id, task))
+
+    if error is not None and attempts >= max_task_attempts:
+        logging.error(f"Hub cleanup task {task} for run {run_id} set aside after {attempts} attempts: {message}")
+
+
+def purge_completed_cleanup_tasks(cursor):
+    logging.info("Purging completed hub cleanup tasks...")
+
+    sql = f"""
+        DELETE FROM {database_dict['schema']}.{hub_cleanup_tasks_table}
+        WHERE completed_at < NOW() - INTERVAL %s DAY
+    """
+    cursor.execute(sql, (cleanup_task_retention_days,))
+
+
+def run_cleanup_task(task, payload, hub_uuids):
+    if task == 'cognito':
+        delete_users_from_cognito(lambda_client, payload['users'])
+    elif task == 'iot':
+        delete_users_from_iotcore(lambda_client, hub_uuids)
+    else:
+        detach_users_from_policy(payload['policy_name'], payload['user_identities'])
+
+
+def run_cleanup_tasks(cursor, tasks):
+    hub_uuids = get_hub_uuids(cursor)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max_cleanup_workers) as executor:
+        # the iot sweep covers every orphaned thing so runs once however many runs left it pending
+        futures = {}
+        for run_id, task, payload, attempts in tasks:
+            key = task if task == 'iot' else (run_id, task)
+            if key not in futures:
+                futures[key] = executor.submit(run_cleanup_task, task, payload, hub_uuids)
+
+        for run_id, task, payload, attempts in tasks:
+            error = futures[task if task == 'iot' else (run_id, task)].exception()
+            if error is not None:
+                logging.error(f"Hub cleanup task {task} for run {run_id} failed: {error}")
+            results.append((run_id, task, attempts + 1, error))
+
+    return results
 
 
 def lambda_handler(event, context):
@@ -160,24 +260,33 @@ def lambda_handler(event, context):
 
         with conn.cursor() as cursor:
 
-            hub_uuids = get_hub_uuids(cursor)
             hub_emails, hub_policy_identity_pairs = get_hub_accounts(cursor)
 
-            if not hub_emails:
+            # the db side is committed on its own first, the remote cleanups are recorded with it for retry
+            if hub_emails:
+                delete_hub_entries_from_db(cursor, hub_emails)
+                record_cleanup_tasks(cursor, str(uuid.uuid4()),
+                                     build_cleanup_tasks(hub_emails, hub_policy_identity_pairs))
+            purge_completed_cleanup_tasks(cursor)
+            conn.commit()
+
+            tasks = get_pending_cleanup_tasks(cursor)
+            if not tasks:
                 logging.info("No hub accounts found. Exiting script.")
                 return {
                     'statusCode': 200,
                     'body': 'No hub accounts to delete.'
                 }
 
-            delete_hub_entries_from_db(cursor, hub_emails)
-            delete_users_from_cognito(lambda_client, hub_emails)
-            delete_users_from_iotcore(lambda_client, hub_uuids)
-
-            detach_users_from_policy(lambda_client, hub_policy_identity_pairs)
-
+            results = run_cleanup_tasks(cursor, tasks)
+            for run_id, task, attempts, error in results:
+                set_cleanup_task_result(cursor, run_id, task, attempts, error)
             conn.commit()
 
+            failed_tasks = [task for _, task, _, error in results if error is not None]
+            if failed_tasks:
+                raise Exception(f"Hub cleanup tasks failed: {failed_tasks}")
+
     except Exception as e:
         logging.error(f"Internal Server Error: {e}")
         traceback.print_exc()
@@ -0,0 +1,105 @@
+import json
+import logging
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+# IoT policy operations shared by the policy lambdas and the lambdas that used to invoke them, deployed in the
+# same package so callers can run them in process instead of going through another lambda
+
+# adaptive retries back off when IoT throttles the parallel calls
+iot_client = boto3.client('iot', config=Config(retries={'max_attempts': 10, 'mode': 'adaptive'}))
+
+# kept well under the IoT control plane request rate quotas
+max_policy_workers = 8
+
+
+def build_policy_document(organisation_uuid):
+    pub_resource = f"arn:aws:iot:eu-west-2:252856254277:topic/{organisation_uuid}/*"
+    sub_resource = f"arn:aws:iot:eu-west-2:252856254277:topicfilter/{organisation_uuid}/*"
+
+    return {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Effect": "Allow",
+                "Action": "iot:Connect",
+                "Resource": "*"
+            },
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "iot:Publish",
+                    "iot:Receive",
+                    "iot:RetainPublish",
+                    "iot:ListRetainedMessages",
+                    "iot:GetRetainedMessage"
+
+                ],
+                "Resource": [
+                    pub_resource
+                ]
+            },
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "iot:Subscribe"
+                ],
+                "Resource": [
+                    sub_resource
+                ]
+            }
+        ]
+    }
+
+
+def create_policy(policy_name, organisation_uuid):
+    logging.info(f"Creating IoT policy {policy_name}...")
+
+    iot_client.create_policy(
+        policyName=policy_name,
+        policyDocument=json.dumps(build_policy_document(organisation_uuid))
+    )
+
+
+def run_policy_pairs(operation, policy_identity_pairs):
+    # returns the pairs that failed with their error, one bad identity doesn't stop the rest
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=max_policy_workers) as executor:
+        futures = [
+            (policy_name, user_identity, executor.submit(operation, policyName=policy_name, principal=user_identity))
+            for policy_name, user_identity in policy_identity_pairs
+        ]
+
+        for policy_name, user_identity, future in futures:
+            error = future.exception()
+            if error is None:
+                continue
+
+            message = error.response['Error']['Message'] if isinstance(error, ClientError) else str(error)
+            logging.error(f"Policy {policy_name} failed for {user_identity}: {message}")
+            failed.append({"policy_name": policy_name, "user_identity": user_identity, "error": message})
+
+    return failed
+
+
+def attach_policies(policy_identity_pairs):
+    logging.info(f"Attaching {len(policy_identity_pairs)} policy identity pairs...")
+    return run_policy_pairs(iot_client.attach_principal_policy, policy_identity_pairs)
+
+
+def detach_policies(policy_identity_pairs):
+    logging.info(f"Detaching {len(policy_identity_pairs)} policy identity pairs...")
+    return run_policy_pairs(iot_client.detach_principal_policy, policy_identity_pairs)
+
+
+def get_policy_identity_pairs(event):
+    # accepts a batch of pairs, one policy with several identities, or the original single pair
+    if event.get("pairs"):
+        return [(pair["policy_name"], pair["user_identity"]) for pair in event["pairs"]]
+
+    policy_name = event.get("policy_name", "")
+    user_identities = event.get("user_identities") or [event.get("user_identity", "")]
+    return [(policy_name, user_identity) for user_identity in user_identities]
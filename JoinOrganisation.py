@@ -10,6 +10,7 @@ import re
 import random
 import string
 import zanolambdashelper
+import IoTPolicies
 
 database_details = zanolambdashelper.helpers.get_db_details()
 
@@ -22,12 +23,9 @@ rds_region = database_details['rds_region']
 database_dict = zanolambdashelper.helpers.get_database_dict()
 
 rds_client = zanolambdashelper.helpers.create_client('rds')
-lambda_client = zanolambdashelper.helpers.create_client('lambda')
 
 zanolambdashelper.helpers.set_logging('INFO')
 
-policy_attach_lambda = "AttachPolicy"
-
 
 def get_user_and_hub_id_by_email(cursor,
                                  user_email):  # not using helper get id function because this one also requires hubid for join logic
@@ -94,22 +92,13 @@ def attach_policy(cursor, org_uuid, user_identity):
     result = cursor.fetchone()
     policy_name = result[0]
 
-    # Run policy attach lambda
-    response = lambda_client.invoke(
-        FunctionName=policy_attach_lambda,
-        InvocationType='RequestResponse',
-        LogType='Tail',
-        Payload=json.dumps({"policy_name": policy_name, "user_identity": user_identity})
-    )
+    # Attach in process rather than invoking the AttachPolicy lambda
+    failed = IoTPolicies.attach_policies([(policy_name, user_identity)])
+    if failed:
+        logging.error(f"Policy attach failed: {failed}")
+        raise Exception(failed[0]['error'])
     logging.info("Policy attached")
 
-    response_payload = response['Payload'].read().decode('utf-8')
-    logging.info(response_payload)
-
-    if response['StatusCode'] != 200 or 'errorMessage' in response_payload:
-        logging.error(f"Lambda invocation failed, ResponsePayload: {response_payload}")
-        raise Exception(response_payload)
-
 
 def append_user_to_all_pools(cursor, org_uuid, user_uuid):
     logging.info("Executing SQL query to append user to all org pools...")
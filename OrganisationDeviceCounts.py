@@ -0,0 +1,47 @@
+import logging
+
+# the per organisation hub and device counters, shared by the lambdas that add and remove hubs and devices which are
+# deployed in the same package. ReconcileOrganisationDeviceCounts recounts them from scratch
+
+organisation_device_counts_table = 'organisation_device_counts'
+
+hub_device_type_id = 1
+device_count_columns = {
+    1: 'hub_count',
+    2: 'dimmable_light_count',
+    3: 'encoder_count',
+    4: 'pir_count',
+    5: 'emergency_light_count',
+}
+
+
+def lock_org_device_count(cursor, schema, org_uuid):
+    logging.info("Locking org device count...")
+
+    # every lambda that changes the counts takes this row lock first, so their reads and adjustments are serialised
+    sql = f"SELECT device_count FROM {schema}.{organisation_device_counts_table} WHERE organisationUUID = %s FOR UPDATE"
+    cursor.execute(sql, (org_uuid,))
+    result = cursor.fetchone()
+
+    if result:
+        device_count, = result
+        return device_count
+    else:
+        return 0
+
+
+def adjust_org_device_counts(cursor, schema, org_uuid, type_deltas):
+    logging.info("Updating organisation device counts...")
+
+    # hubs aren't counted towards the org device total
+    columns = [device_count_columns[device_type_id] for device_type_id in type_deltas] + ['device_count']
+    deltas = list(type_deltas.values()) + [
+        sum(delta for device_type_id, delta in type_deltas.items() if device_type_id != hub_device_type_id)]
+
+    sql = f"""
+        INSERT INTO {schema}.{organisation_device_counts_table} (organisationUUID, {', '.join(columns)})
+        VALUES (%s, {', '.join(['GREATEST(%s, 0)'] * len(columns))})
+        ON DUPLICATE KEY UPDATE
+            {', '.join(f'{column} = GREATEST({column} + %s, 0)' for column in columns)}
+    """
+    cursor.execute(sql, (org_uuid, *deltas, *deltas))
@@ -0,0 +1,236 @@
+import boto3
+import json
+from datetime import datetime
+import mysql.connector
+import os
+import base64
+import logging
+import traceback
+import re
+import random
+import string
+import zanolambdashelper
+import StripeInvoices
+import StripeSubscriptionItems
+
+database_details = zanolambdashelper.helpers.get_db_details()
+
+rds_host = database_details['rds_host']
+rds_port = database_details['rds_port']
+rds_db = database_details['rds_db']
+rds_user = database_details['rds_user']
+rds_region = database_details['rds_region']
+
+database_dict = zanolambdashelper.helpers.get_database_dict()
+
+rds_client = zanolambdashelper.helpers.create_client('rds')
+
+zanolambdashelper.helpers.set_logging('INFO')
+
+stripe_webhook_events_table = 'stripe_webhook_events'
+
+invoice_events = ["invoice.created", "invoice.finalized", "invoice.paid", "invoice.updated", "invoice.voided",
+                  "invoice.marked_uncollectible"]
+
+# events are applied oldest first in batches, one processor at a time so they stay in order
+event_batch_size = 100
+processor_lock_name = 'stripe_webhook_processor'
+# an event still failing after this many attempts is set aside so it doesn't hold up the queue
+max_event_attempts = 5
+min_remaining_time_ms = 30 * 1000
+
+
+def update_org_stripe_sub_id(cursor, org_uuid, sub_id):
+    logging.info("Setting org subID...")
+
+    # Step 1: Update the org entry to include the stripe sub ID
+    sql = f"""
+        UPDATE {database_dict['schema']}.{database_dict['organisations_table']} 
+        SET stripe_sub_id = %s 
+        WHERE organisationUUID = %s
+    """
+    cursor.execute(sql, (sub_id, org_uuid))
+
+
+def get_pending_events(cursor, limit):
+    logging.info("Getting pending webhook events...")
+
+    sql = f"""
+        SELECT event_id, payload, attempts
+        FROM {database_dict['schema']}.{stripe_webhook_events_table}
+        WHERE processed_at IS NULL
+        ORDER BY event_created, received_at, event_id
+        LIMIT %s
+    """
+    cursor.execute(sql, (limit,))
+    return cursor.fetchall()
+
+
+def mark_events_processed(cursor, event_ids):
+    if not event_ids:
+        return
+
+    sql = f"""
+        UPDATE {database_dict['schema']}.{stripe_webhook_events_table}
+        SET processed_at = CURRENT_TIMESTAMP
+        WHERE event_id IN ({','.join(['%s'] * len(event_ids))})
+    """
+    cursor.execute(sql, tuple(event_ids))
+
+
+def record_event_failure(cursor, event_id, attempts, error, set_aside=False):
+    # after the last attempt, or straight away for an event that can never apply, the event is marked processed
+    # with its error kept for investigation
+    set_aside = set_aside or attempts >= max_event_attempts
+
+    sql = f"""
+        UPDATE {database_dict['schema']}.{stripe_webhook_events_table}
+        SET attempts = %s, last_error = %s,
+            processed_at = IF(%s, CURRENT_TIMESTAMP, NULL)
+        WHERE event_id = %s
+    """
+    cursor.execute(sql, (attempts, str(error)[:1000], set_aside, event_id))
+
+
+def apply_event(cursor, stripe_event):
+    org_uuid = None
+    subscription = None
+    deleted_sub_id = None
+    invoice = None
+    data_object = stripe_event["data"]["object"]
+
+    # Process only relevant events
+    if stripe_event["type"] in ["checkout.session.completed", "customer.subscription.created"]:
+
+        # If checkout session, get subscription from it
+        if stripe_event["type"] == "checkout.session.completed":
+            sub_id = data_object.get("subscription")
+            org_uuid = data_object.get("metadata", {}).get("org_uuid")
+        else:
+            # Direct subscription event
+            sub_id = data_object.get("id")
+            org_uuid = data_object.get("metadata", {}).get("org_uuid")
+            subscription = data_object
+
+        if not sub_id or not org_uuid:
+            # retrying can't fix the payload, a 422 sets the event aside straight away
+            logging.error("Missing sub_id or org_uuid in webhook payload.")
+            raise Exception(422, "Missing sub_id or org_uuid in webhook payload.")
+
+    elif stripe_event["type"] == "customer.subscription.updated":
+        subscription = data_object
+
+    elif stripe_event["type"] == "customer.subscription.deleted":
+        deleted_sub_id = data_object.get("id")
+
+    elif stripe_event["type"] in invoice_events:
+        # subscription invoices are indexed locally so listing them doesn't go to Stripe
+        if StripeInvoices.get_invoice_subscription_id(data_object):
+            invoice = data_object
+
+    if org_uuid:
+        update_org_stripe_sub_id(cursor, org_uuid, sub_id)
+    if subscription:
+        StripeSubscriptionItems.set_subscription_items(cursor, database_dict['schema'], subscription["id"],
+                                                       subscription["customer"],
+                                                       StripeSubscriptionItems.get_subscription_item_pairs(subscription))
+    if deleted_sub_id:
+        StripeSubscriptionItems.delete_subscription_items(cursor, database_dict['schema'], deleted_sub_id)
+    if invoice:
+        StripeInvoices.set_invoice(cursor, database_dict['schema'], invoice)
+
+
+def process_pending_events(conn, cursor, context):
+    processed_count = 0
+
+    while context is None or context.get_remaining_time_in_millis() >= min_remaining_time_ms:
+        events = get_pending_events(cursor, event_batch_size)
+        if not events:
+            break
+
+        applied = []
+        for event_id, payload, attempts in events:
+            cursor.execute("SAVEPOINT webhook_event")
+            try:
+                apply_event(cursor, json.loads(payload))
+            except Exception as e:
+                logging.error(f"Failed to apply webhook event {event_id}: {e}")
+                traceback.print_exc()
+                cursor.execute("ROLLBACK TO SAVEPOINT webhook_event")
+
+                if len(e.args) >= 2 and e.args[0] == 422:
+                    # an invalid event is set aside on its first attempt and the batch carries on past it
+                    record_event_failure(cursor, event_id, attempts + 1, e.args[1], set_aside=True)
+                    continue
+
+                # keep what applied before the failure, later events wait so they aren't applied out of order
+                mark_events_processed(cursor, applied)
+                record_event_failure(cursor, event_id, attempts + 1, e)
+                conn.commit()
+                return processed_count + len(applied), False
+
+            applied.append(event_id)
+
+        mark_events_processed(cursor, applied)
+        conn.commit()
+        processed_count += len(applied)
+        logging.info(f"Applied {processed_count} webhook events.")
+
+    return processed_count, True
+
+
+def lambda_handler(event, context):
+    try:
+        database_token = zanolambdashelper.helpers.generate_database_token(rds_client, rds_user, rds_host, rds_port,
+                                                                           rds_region)
+
+        conn = zanolambdashelper.helpers.initialise_connection(rds_user, database_token, rds_db, rds_host, rds_port)
+        conn.autocommit = False
+
+        with conn.cursor() as cursor:
+
+            # invoked after each webhook and on a schedule, a run that finds another in progress leaves it to that one
+            cursor.execute("SELECT GET_LOCK(%s, 0)", (processor_lock_name,))
+            locked, = cursor.fetchone()
+            if not locked:
+                logging.info("Webhook events are already being processed.")
+                return {
+                    'statusCode': 200,
+                    'body': 'Webhook events already being processed'
+                }
+
+            try:
+                processed_count, completed = process_pending_events(conn, cursor, context)
+            finally:
+                cursor.execute("SELECT RELEASE_LOCK(%s)", (processor_lock_name,))
+                cursor.fetchone()
+
+            if not completed:
+                raise Exception(f"Stopped after {processed_count} webhook events on a failed event")
+
+    except Exception as e:
+        logging.error(f"Internal Server Error: {e}")
+        traceback.print_exc()
+        status_value = 500
+        body_value = 'Unable to process webhook events'
+        if len(e.args) >= 2 and isinstance(e.args[0], int):
+            status_value = e.args[0]
+            if status_value == 422:  # if 422 then validation error
+                body_value = e.args[1]
+        error_response = {
+            'statusCode': status_value,
+            'body': body_value,
+        }
+        return error_response
+
+    finally:
+        try:
+            cursor.close()
+            conn.close()
+        except NameError:  # catch potential error before cursor or conn is defined
+            pass
+
+    return {
+        'statusCode': 200,
+        'body': 'Webhook Events Processed Successfully'
+    }
@@ -0,0 +1,105 @@
+import boto3
+import json
+from datetime import datetime
+import mysql.connector
+import os
+import base64
+import logging
+import traceback
+import re
+import random
+import string
+import zanolambdashelper
+import OrganisationDeviceCounts
+
+database_details = zanolambdashelper.helpers.get_db_details()
+
+rds_host = database_details['rds_host']
+rds_port = database_details['rds_port']
+rds_db = database_details['rds_db']
+rds_user = database_details['rds_user']
+rds_region = database_details['rds_region']
+
+database_dict = zanolambdashelper.helpers.get_database_dict()
+
+rds_client = zanolambdashelper.helpers.create_client('rds')
+
+zanolambdashelper.helpers.set_logging('INFO')
+
+
+
+def reconcile_device_counts(cursor):
+    logging.info("Recounting hubs and devices per organisation...")
+
+    # full recount, also used to backfill the table, the lambdas keep it current between runs
+    sql = f"""
+        INSERT INTO {database_dict['schema']}.{OrganisationDeviceCounts.organisation_device_counts_table}
+        (organisationUUID, hub_count, dimmable_light_count, encoder_count, pir_count, emergency_light_count, device_count)
+        WITH cte as (
+            SELECT organisationUUID, device_type_ID from {database_dict['schema']}.{database_dict['hubs_table']}
+            UNION ALL
+            SELECT organisationUUID, device_type_ID from {database_dict['schema']}.{database_dict['devices_table']}
+            )
+        SELECT a.organisationUUID,
+        CAST(SUM(CASE WHEN device_type_ID = 1 THEN 1 ELSE 0 END) AS UNSIGNED) AS hub_count,
+        CAST(SUM(CASE WHEN device_type_ID = 2 THEN 1 ELSE 0 END) AS UNSIGNED) AS dimmable_light_count,
+        CAST(SUM(CASE WHEN device_type_ID = 3 THEN 1 ELSE 0 END) AS UNSIGNED) AS encoder_count,
+        CAST(SUM(CASE WHEN device_type_ID = 4 THEN 1 ELSE 0 END) AS UNSIGNED) AS pir_count,
+        CAST(SUM(CASE WHEN device_type_ID = 5 THEN 1 ELSE 0 END) AS UNSIGNED) AS emergency_light_count,
+        CAST(SUM(CASE WHEN device_type_ID != 1 THEN 1 ELSE 0 END) AS UNSIGNED) AS device_count
+        FROM {database_dict['schema']}.{database_dict['organisations_table']} a LEFT JOIN cte b on a.organisationUUID = b.organisationUUID
+        GROUP BY a.organisationUUID
+        ON DUPLICATE KEY UPDATE
+            hub_count = VALUES(hub_count),
+            dimmable_light_count = VALUES(dimmable_light_count),
+            encoder_count = VALUES(encoder_count),
+            pir_count = VALUES(pir_count),
+            emergency_light_count = VALUES(emergency_light_count),
+            device_count = VALUES(device_count)
+    """
+    cursor.execute(sql)
+
+    # MySQL reports 1 per inserted row and 2 per updated row, unchanged rows count 0
+    logging.info(f"Reconciled organisation device counts, {cursor.rowcount} affected rows.")
+
+
+def lambda_handler(event, context):
+    try:
+        database_token = zanolambdashelper.helpers.generate_database_token(rds_client, rds_user, rds_host, rds_port,
+                                                                           rds_region)
+
+        conn = zanolambdashelper.helpers.initialise_connection(rds_user, database_token, rds_db, rds_host, rds_port)
+        conn.autocommit = False
+
+        with conn.cursor() as cursor:
+
+            reconcile_device_counts(cursor)
+
+            conn.commit()
+
+    except Exception as e:
+        logging.error(f"Internal Server Error: {e}")
+        traceback.print_exc()
+        status_value = 500
+        body_value = 'Unable to reconcile organisation device counts'
+        if len(e.args) >= 2 and isinstance(e.args[0], int):
+            status_value = e.args[0]
+            if status_value == 422:  # if 422 then validation error
+                body_value = e.args[1]
+        error_response = {
+            'statusCode': status_value,
+            'body': body_value,
+        }
+        return error_response
+
+    finally:
+        try:
+            cursor.close()
+            conn.close()
+        except NameError:  # catch potential error before cursor or conn is defined
+            pass
+
+    return {
+        'statusCode': 200,
+        'body': 'Organisation Device Counts Reconciled Successfully'
+    }
@@ -10,6 +10,7 @@ import re
 import random
 import string
 import zanolambdashelper
+import OrganisationDeviceCounts
 
 database_details = zanolambdashelper.helpers.get_db_details()
 
@@ -48,16 +49,6 @@ def generate_unique_short_address(cursor, org_uuid):
             raise Exception("Unable to generate a unique short address after many attempts.")
 
 
-def get_org_device_count(cursor, org_uuid):
-    logging.info("Fetching org device count...")
-
-    sql = f"SELECT COUNT(DISTINCT deviceUUID) FROM {database_dict['schema']}.{database_dict['devices_table']} WHERE organisationUUID = %s"
-    cursor.execute(sql, (org_uuid,))
-    device_uuid, = cursor.fetchone()
-
-    return device_uuid
-
-
 def get_default_pool_id(cursor, org_uuid):
     logging.info("Fetching default pool UUID...")
 
@@ -147,7 +138,8 @@ def lambda_handler(event, context):
                                                         database_dict['users_organisations_table'], user_uuid,
                                                         org_uuid)
 
-            org_device_count = get_org_device_count(cursor, org_uuid)
+            # locks the org's count row so concurrent registrations can't both pass the limit check
+            org_device_count = OrganisationDeviceCounts.lock_org_device_count(cursor, database_dict['schema'], org_uuid)
             if org_device_count + 1 > max_org_devices:  # if device count with new device is greater max then raise custom exception
                 logging.error("Org is at device limit...")
                 raise Exception(403, f"You have reached your organisations device limit of {max_org_devices}")
@@ -157,6 +149,7 @@ def lambda_handler(event, context):
                                         device_name, org_uuid, user_uuid)
             pool_uuid = get_default_pool_id(cursor, org_uuid)
             add_device_to_default_pool(cursor, pool_uuid, device_uuid, org_uuid, user_uuid)
+            OrganisationDeviceCounts.adjust_org_device_counts(cursor, database_dict['schema'], org_uuid, {int(device_type_id): 1})
             device_topic = device_uuid
             conn.commit()
 
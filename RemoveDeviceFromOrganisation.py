@@ -10,6 +10,7 @@ import re
 import random
 import string
 import zanolambdashelper
+import OrganisationDeviceCounts
 
 database_details = zanolambdashelper.helpers.get_db_details()
 
@@ -27,6 +28,13 @@ rds_client = zanolambdashelper.helpers.create_client('rds')
 def delete_device_from_organisation(cursor, device_uuid, org_uuid, user_uuid):
     logging.info("Deleting device from organisation...")
 
+    # count row first, the same lock order as RegisterDevice and RemoveHubFromOrganisation
+    OrganisationDeviceCounts.lock_org_device_count(cursor, database_dict['schema'], org_uuid)
+
+    sql = f"SELECT device_type_ID FROM {database_dict['schema']}.{database_dict['devices_table']} WHERE deviceUUID = %s AND organisationUUID = %s FOR UPDATE"
+    cursor.execute(sql, (device_uuid, org_uuid))
+    result = cursor.fetchone()
+
     sql = f"""  
         DELETE d
         FROM {database_dict['devices_table']} d
@@ -34,6 +42,10 @@ def delete_device_from_organisation(cursor, device_uuid, org_uuid, user_uuid):
     """
     cursor.execute(sql, (device_uuid, org_uuid))
 
+    if result and cursor.rowcount:
+        device_type_id, = result
+        OrganisationDeviceCounts.adjust_org_device_counts(cursor, database_dict['schema'], org_uuid, {device_type_id: -1})
+
 
 def lambda_handler(event, context):
     try:
@@ -10,6 +10,7 @@ import re
 import random
 import string
 import zanolambdashelper
+import OrganisationDeviceCounts
 
 database_details = zanolambdashelper.helpers.get_db_details()
 
@@ -27,6 +28,20 @@ rds_client = zanolambdashelper.helpers.create_client('rds')
 def delete_hub_from_organisation(cursor, hub_uuid, org_uuid, user_uuid):
     logging.info("Deleting hub from organisation...")
 
+    # the count row lock holds off registrations and removals in the org until this commits
+    OrganisationDeviceCounts.lock_org_device_count(cursor, database_dict['schema'], org_uuid)
+
+    # the hub's devices are removed with it by the cascade so are taken off the counts too
+    sql = f"""
+        SELECT device_type_ID, COUNT(*)
+        FROM {database_dict['schema']}.{database_dict['devices_table']}
+        WHERE associated_hub = %s AND organisationUUID = %s
+        GROUP BY device_type_ID
+        FOR UPDATE
+    """
+    cursor.execute(sql, (hub_uuid, org_uuid))
+    type_deltas = {device_type_id: -count for device_type_id, count in cursor.fetchall()}
+
     sql = f"""  
         DELETE d
         FROM {database_dict['hubs_table']} d
@@ -34,6 +49,10 @@ def delete_hub_from_organisation(cursor, hub_uuid, org_uuid, user_uuid):
     """
     cursor.execute(sql, (hub_uuid, org_uuid))
 
+    if cursor.rowcount:
+        type_deltas[OrganisationDeviceCounts.hub_device_type_id] = -1
+        OrganisationDeviceCounts.adjust_org_device_counts(cursor, database_dict['schema'], org_uuid, type_deltas)
+
 
 def lambda_handler(event, context):
     try:
@@ -10,6 +10,7 @@ import re
 import random
 import string
 import zanolambdashelper
+import OrganisationDeviceCounts
 
 database_details = zanolambdashelper.helpers.get_db_details()
 
@@ -28,16 +29,21 @@ zanolambdashelper.helpers.set_logging('INFO')
 max_org_devices = 500
 
 
+
 def get_org_device_count(cursor, org_uuid):
     logging.info("Fetching org device count...")
 
-    sql = f"SELECT COUNT(DISTINCT deviceUUID) FROM {database_dict['schema']}.{database_dict['devices_table']} WHERE organisationUUID = %s"
+    sql = f"SELECT device_count FROM {database_dict['schema']}.{OrganisationDeviceCounts.organisation_device_counts_table} WHERE organisationUUID = %s"
 
     cursor.execute(sql, (org_uuid,))
 
-    count, = cursor.fetchone()
+    result = cursor.fetchone()
 
-    return count
+    if result:
+        count, = result
+        return count
+    else:
+        return 0
 
 
 def update_device(cursor, long_address, associated_hub, user_email, device_uuid,
@@ -47,6 +53,10 @@ def update_device(cursor, long_address, associated_hub, user_email, device_uuid,
     sql = f"UPDATE {database_dict['schema']}.{database_dict['devices_table']} SET long_address = %s, associated_hub = %s, registrant = %s  WHERE organisationUUID = %s AND deviceUUID = %s "
     cursor.execute(sql, (long_address, associated_hub, user_email, org_uuid, device_uuid,))
 
+    # keep the hub stored against the device's test schedule in step so the hub's next tests follow the device
+    sql = f"UPDATE {database_dict['schema']}.{database_dict['emergency_test_schedule_table']} SET associated_hub = %s WHERE organisationUUID = %s AND deviceUUID = %s "
+    cursor.execute(sql, (associated_hub, org_uuid, device_uuid,))
+
 
 def lambda_handler(event, context):
     try:
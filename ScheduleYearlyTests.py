@@ -1,3 +1,4 @@
+import heapq
 import math
 
 import boto3
@@ -14,6 +15,7 @@ import string
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 import zanolambdashelper
+import EmergencyTestScheduling
 
 database_details = zanolambdashelper.helpers.get_db_details()
 
@@ -35,36 +37,65 @@ test_type_id = 2
 
 now = datetime.now()
 
-def set_new_schedule(cursor, device_schedules):
+emergency_schedule_watermark_table = 'emergency_schedule_watermark'
+emergency_test_latest_table = 'emergency_test_latest'
+
+# slots of the nightly test window that tests on a busy hub are staggered into
+test_slot_length = timedelta(minutes=60)
+test_window_slots = 8
+# schedules are upserted in chunks, stopping early and continuing in a new invocation if time runs short
+schedule_batch_size = 500
+min_remaining_time_ms = 60 * 1000
+
+# fleets at least this size use the numpy path in calculate_test_times
+vectorise_threshold = 1000
+
+
+def set_new_schedule(conn, cursor, device_schedules, batch_size=schedule_batch_size, context=None):
     logging.info("Setting new emergency device test schedules...")
 
     if not device_schedules:
         logging.info("No schedules to update.")
-        return
-
-    #if schedule doesnt exist then insert else update the test_time value
-    sql = f"""
-        INSERT INTO {database_dict['schema']}.{database_dict['emergency_test_schedule_table']}
-        (organisationUUID, deviceUUID, test_type_id, test_time)
-        VALUES (%s, %s, %s, %s)
-        ON DUPLICATE KEY UPDATE
-            test_time = VALUES(test_time)
-    """
+        return True
 
-    # Prepare the values as a list of tuples matching the %s order in SQL
-    values = [
+    # Prepare the values as a list of tuples matching the %s order in SQL, ordered so reruns walk the same chunks
+    values = sorted(
         (
             row["organisationUUID"],
             row["deviceUUID"],
             row["test_type_id"],
-            row["test_time"]
+            row["test_time"],
+            row["associated_hub"]
         )
         for row in device_schedules
-    ]
+    )
 
+    for i in range(0, len(values), batch_size):
 
-    cursor.executemany(sql, values)
-    logging.info(f"Updated {len(values)} emergency device test schedules.")
+        if context is not None and context.get_remaining_time_in_millis() < min_remaining_time_ms:
+            logging.info(f"Running out of time after {i} of {len(values)} schedules...")
+            return False
+
+        chunk = values[i:i + batch_size]
+
+        #if schedule doesnt exist then insert else update the test_time value
+        sql = f"""
+            INSERT INTO {database_dict['schema']}.{database_dict['emergency_test_schedule_table']}
+            (organisationUUID, deviceUUID, test_type_id, test_time, associated_hub)
+            VALUES {','.join(['(%s, %s, %s, %s, %s)'] * len(chunk))}
+            ON DUPLICATE KEY UPDATE
+                test_time = VALUES(test_time),
+                associated_hub = VALUES(associated_hub)
+        """
+
+        cursor.execute(sql, tuple(value for row in chunk for value in row))
+
+        # commit per chunk so locks on the schedule table are only held briefly, committed chunks act as the
+        # checkpoint as a rerun sees their stored time already matches and skips them
+        conn.commit()
+        logging.info(f"Updated {i + len(chunk)} of {len(values)} emergency device test schedules.")
+
+    return True
 
 def tonight_at(preferred_time):
     today = now.date()
@@ -83,37 +114,90 @@ def at_preferred_time(date, preferred_time):
 
 
 
-def get_emergency_devices(cursor):
-    logging.info("Fetching emergency devices and their most recent test result...")
+def get_schedule_watermark(cursor):
+    logging.info("Fetching last schedule run watermark...")
+
+    sql = f"""
+        SELECT last_result_id, last_run
+        FROM {database_dict['schema']}.{emergency_schedule_watermark_table}
+        WHERE test_type_id = %s
+    """
+    cursor.execute(sql, (test_type_id,))
+    return cursor.fetchone()
+
+
+def get_latest_result_id(cursor):
+    sql = f"SELECT COALESCE(MAX(test_ID), 0) FROM {database_dict['schema']}.{database_dict['emergency_discharge_test_result_table']}"
+    cursor.execute(sql)
+    latest_result_id, = cursor.fetchone()
+    return latest_result_id
+
+
+def set_schedule_watermark(cursor, last_result_id, last_run):
+    logging.info("Updating schedule run watermark...")
 
     sql = f"""
+        INSERT INTO {database_dict['schema']}.{emergency_schedule_watermark_table}
+        (test_type_id, last_result_id, last_run)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            last_result_id = VALUES(last_result_id),
+            last_run = VALUES(last_run)
+    """
+    cursor.execute(sql, (test_type_id, last_result_id, last_run))
 
-            with ranked_results as (
-                SELECT 
-                    organisationUUID,
-                    deviceUUID,
-                    discharge_time,
-                    result_timestamp,
-                    ROW_NUMBER() OVER (
-                        PARTITION BY organisationUUID, deviceUUID
-                        ORDER BY result_timestamp DESC
-                    ) AS rn
+
+def get_changed_orgs(cursor, last_result_id, last_run):
+    logging.info("Fetching organisations with schedule inputs changed since last run...")
+
+    # new devices, new results (by id so late submitted results are caught), changed preferred times and tests that have come due
+    sql = f"""
+        SELECT DISTINCT a.organisationUUID
+        FROM {database_dict['schema']}.{database_dict['devices_table']} a
+        INNER JOIN {database_dict['schema']}.{database_dict['organisations_table']} b on a.organisationUUID = b.organisationUUID
+        LEFT JOIN {database_dict['schema']}.{database_dict['emergency_test_schedule_table']} c  ON a.deviceUUID = c.deviceUUID AND a.organisationUUID = c.organisationUUID AND c.test_type_id = %s
+        WHERE a.device_type_ID = %s
+        AND (
+            c.test_time IS NULL
+            OR c.test_time < %s
+            OR b.preferred_test_time_updated_at >= %s
+            OR a.deviceUUID IN (
+                SELECT deviceUUID
                 FROM {database_dict['schema']}.{database_dict['emergency_discharge_test_result_table']}
+                WHERE test_ID > %s
             )
-            SELECT DISTINCT a.deviceUUID, a.organisationUUID, b.preferred_test_time, c.test_time, d.result_timestamp
+        )
+    """
+    cursor.execute(sql, (test_type_id, emergency_light_device_id, now, last_run, last_result_id))
+    return [org_uuid for org_uuid, in cursor.fetchall()]
+
+
+def get_emergency_devices(cursor, org_uuids=None):
+    logging.info("Fetching emergency devices and their most recent test result...")
+
+    sql = f"""
+
+            SELECT DISTINCT a.deviceUUID, a.organisationUUID, b.preferred_test_time, c.test_time, d.last_timestamp AS result_timestamp, a.associated_hub, c.associated_hub AS scheduled_hub
             FROM {database_dict['schema']}.{database_dict['devices_table']} a
             INNER JOIN {database_dict['schema']}.{database_dict['organisations_table']} b on a.organisationUUID = b.organisationUUID
             LEFT JOIN {database_dict['schema']}.{database_dict['emergency_test_schedule_table']} c  ON a.deviceUUID = c.deviceUUID AND a.organisationUUID = c.organisationUUID AND c.test_type_id = %s
-            LEFT JOIN ranked_results d ON a.organisationUUID = d.organisationUUID AND a.deviceUUID = d.deviceUUID AND d.rn = 1
+            LEFT JOIN {database_dict['schema']}.{emergency_test_latest_table} d ON a.organisationUUID = d.organisationUUID AND a.deviceUUID = d.deviceUUID AND d.test_type_id = %s
             WHERE a.device_type_ID = %s 
     """
-    cursor.execute(sql,(test_type_id, emergency_light_device_id))
+    params = [test_type_id, test_type_id, emergency_light_device_id]
+
+    if org_uuids is not None:
+        placeholders = ','.join(['%s'] * len(org_uuids))
+        sql += f" AND a.organisationUUID IN ({placeholders})"
+        params.extend(org_uuids)
+
+    cursor.execute(sql, tuple(params))
     result = cursor.fetchall()
     return result
 
 
 
-def calculate_test_times(test_data):
+def calculate_test_times_scalar(test_data):
     rows = []
 
     for row in test_data:
@@ -123,6 +207,8 @@ def calculate_test_times(test_data):
         preferred_time = row[2]
         test_time = row[3]
         result = row[4]
+        associated_hub = row[5]
+        scheduled_hub = row[6]
 
         new_test_time = None
 
@@ -152,13 +238,17 @@ def calculate_test_times(test_data):
                 new_test_time = one_year_after_result
 
             else:
-                new_test_time = test_time
+                # keep the current day, a staggered slot may have pushed the time past midnight
+                new_test_time = test_time - preferred_time
 
         rows.append({
             "deviceUUID": deviceUUID,
             "organisationUUID": orgUUID,
             "test_type_id": 2,
             "test_time": at_preferred_time(new_test_time, preferred_time),
+            "previous_test_time": test_time,
+            "associated_hub": associated_hub,
+            "previous_associated_hub": scheduled_hub,
             "pref_test_time": preferred_time,
             "result_timestamp": result
         })
@@ -166,6 +256,36 @@ def calculate_test_times(test_data):
     return rows
 
 
+def calculate_test_times_vectorised(test_data):
+    if EmergencyTestScheduling.has_timezone_aware_times(test_data):
+        return calculate_test_times_scalar(test_data)
+
+    scheduled_times = EmergencyTestScheduling.calculate_test_times_vectorised(test_data, now, 12)
+
+    rows = []
+    for row, scheduled_time in zip(test_data, scheduled_times):
+        rows.append({
+            "deviceUUID": row[0],
+            "organisationUUID": row[1],
+            "test_type_id": 2,
+            "test_time": scheduled_time,
+            "previous_test_time": row[3],
+            "associated_hub": row[5],
+            "previous_associated_hub": row[6],
+            "pref_test_time": row[2],
+            "result_timestamp": row[4]
+        })
+
+    return rows
+
+
+def calculate_test_times(test_data):
+    if len(test_data) >= vectorise_threshold:
+        return calculate_test_times_vectorised(test_data)
+
+    return calculate_test_times_scalar(test_data)
+
+
 def balance_schedule(rows):
 
     org_groups = {}
@@ -191,6 +311,12 @@ def balance_schedule(rows):
             day = now.date() + timedelta(days=i)
             day_map.setdefault(day, [])
 
+        day_counts = {day: len(day_devices) for day, day_devices in day_map.items()}
+
+        # min-heap of days with spare capacity, days only ever fill up so a day leaves the heap once full
+        free_days = [day for day, count in day_counts.items() if count < max_per_day]
+        heapq.heapify(free_days)
+
         # loop through days and find ones with associated devices over capacity
         for day, day_devices in day_map.items():
 
@@ -213,31 +339,32 @@ def balance_schedule(rows):
                 result = device["result_timestamp"] #get devices last test and calc the last date the test could possibly be run and still be compliant
                 max_date = result + timedelta(days=364) #(364 days because worried day balancer logic further below might move device test a few hours over the year limit )
 
-                moved = False
+                # the earliest free day is the only candidate, if it is past the compliance limit every other free day is too
+                if not free_days or free_days[0] > max_date.date():
+                    continue
 
-                # loop through all potential days and device test on said day
-                for candidate_day, candidate_devices in [(day, devices) for day, devices in sorted(day_map.items()) if len(devices) < max_per_day]:
+                candidate_day = free_days[0]
 
-                    if candidate_day > max_date.date(): #if adding the overflowed device to candidate day would put it over the 364 day limit then skip
-                        continue
+                device["test_time"] = datetime.combine( #set test time to the new date at the original hour
+                    candidate_day,
+                    device["test_time"].time()
+                )
 
-                    device["test_time"] = datetime.combine( #else set test time to the new date at the original hour
-                        candidate_day,
-                        device["test_time"].time()
-                    )
+                day_counts[candidate_day] += 1
+                day_counts[day] -= 1
 
-                    candidate_devices.append(device) #add device to the day list (updates count for next itteration)
-                    day_devices.remove(device) #remove the device from origional day list it was associated with
+                if day_counts[candidate_day] >= max_per_day: #day is now full so stop offering it
+                    heapq.heappop(free_days)
 
-                    moved = True
-                    break
+    return rows
 
-                if not moved: #if no test has been moved
-                    continue
 
-    return rows
 
 
+def get_changed_schedules(rows):
+    # only write schedules whose test time has actually moved or whose device has moved to another hub
+    return [row for row in rows
+            if row["test_time"] != row["previous_test_time"] or row["associated_hub"] != row["previous_associated_hub"]]
 
 
 def lambda_handler(event, context):
@@ -250,10 +377,37 @@ def lambda_handler(event, context):
 
         with conn.cursor() as cursor:
 
-            emergency_devices = get_emergency_devices(cursor)
+            # capture the latest result before reading devices so results submitted mid run are picked up next time
+            latest_result_id = get_latest_result_id(cursor)
+            watermark = None if event.get('full_reschedule') else get_schedule_watermark(cursor)
+
+            if watermark:
+                # incremental run, only reschedule organisations whose inputs changed since the last run
+                last_result_id, last_run = watermark
+                changed_orgs = get_changed_orgs(cursor, last_result_id, last_run)
+                emergency_devices = get_emergency_devices(cursor, changed_orgs) if changed_orgs else []
+            else:
+                emergency_devices = get_emergency_devices(cursor)
+
             devices_test_time = calculate_test_times(emergency_devices)
             spreaded_tests = balance_schedule(devices_test_time)
-            set_new_schedule(cursor, spreaded_tests)
+            staggered_tests = EmergencyTestScheduling.spread_hub_load(spreaded_tests, test_slot_length, test_window_slots)
+            completed = set_new_schedule(conn, cursor, get_changed_schedules(staggered_tests),
+                                         event.get('batch_size', schedule_batch_size), context)
+
+            if not completed:
+                # leave the watermark so the continuation reschedules the same organisations
+                lambda_client.invoke(
+                    FunctionName=context.function_name,
+                    InvocationType='Event',
+                    Payload=json.dumps(event)
+                )
+                return {
+                    'statusCode': 202,
+                    'body': 'Schedule update continuing in new invocation'
+                }
+
+            set_schedule_watermark(cursor, latest_result_id, now)
             conn.commit()
 
     except Exception as e:
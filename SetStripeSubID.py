@@ -1,6 +1,6 @@
 import boto3
 import json
-from datetime import datetime
+from datetime import datetime, timezone
 import mysql.connector
 import os
 import base64
@@ -27,20 +27,58 @@ STRIPE_WEBHOOK_SECRET = stripe_secrets['webhook_secret']
 database_dict = zanolambdashelper.helpers.get_database_dict()
 
 rds_client = zanolambdashelper.helpers.create_client('rds')
+lambda_client = zanolambdashelper.helpers.create_client('lambda')
 
 zanolambdashelper.helpers.set_logging('INFO')
 
+stripe_webhook_events_table = 'stripe_webhook_events'
+webhook_event_processor_lambda = "ProcessStripeWebhookEvents"
 
-def update_org_stripe_sub_id(cursor, org_uuid, sub_id):
-    logging.info("Setting org subID...")
+# events applied by ProcessStripeWebhookEvents, anything else is acknowledged and dropped
+handled_events = ["checkout.session.completed", "customer.subscription.created", "customer.subscription.updated",
+                  "customer.subscription.deleted", "invoice.created", "invoice.finalized", "invoice.paid",
+                  "invoice.updated", "invoice.voided", "invoice.marked_uncollectible"]
 
-    # Step 1: Update the org entry to include the stripe sub ID
+
+def store_webhook_event(cursor, stripe_event, raw_body):
+    logging.info(f"Storing webhook event {stripe_event['id']}...")
+
+    # Stripe retries deliveries, the event id keeps each event stored once
     sql = f"""
-        UPDATE {database_dict['schema']}.{database_dict['organisations_table']} 
-        SET stripe_sub_id = %s 
-        WHERE organisationUUID = %s
+        INSERT IGNORE INTO {database_dict['schema']}.{stripe_webhook_events_table}
+        (event_id, event_type, event_created, payload)
+        VALUES (%s, %s, %s, %s)
     """
-    cursor.execute(sql, (sub_id, org_uuid))
+    cursor.execute(sql, (stripe_event["id"], stripe_event["type"],
+                         datetime.fromtimestamp(stripe_event["created"], tz=timezone.utc), raw_body))
+
+    return cursor.rowcount == 1
+
+
+def is_webhook_event_pending(cursor, event_id):
+    sql = f"""
+        SELECT processed_at IS NULL
+        FROM {database_dict['schema']}.{stripe_webhook_events_table}
+        WHERE event_id = %s
+    """
+    cursor.execute(sql, (event_id,))
+    result = cursor.fetchone()
+
+    return result is not None and bool(result[0])
+
+
+def start_event_processor():
+    logging.info("Starting webhook event processor...")
+
+    # the event is already stored, if the processor can't be started now the scheduled run applies it
+    try:
+        lambda_client.invoke(
+            FunctionName=webhook_event_processor_lambda,
+            InvocationType='Event',
+            Payload=json.dumps({})
+        )
+    except Exception as e:
+        logging.error(f"Unable to start webhook event processor: {e}")
 
 
 def lambda_handler(event, context):
@@ -67,32 +105,22 @@ def lambda_handler(event, context):
             logging.error(e)
             raise Exception(400, f"{e}")
 
-        # Process only relevant events
-        if stripe_event["type"] in ["checkout.session.completed", "customer.subscription.created"]:
-            data_object = stripe_event["data"]["object"]
-
-            # If checkout session, get subscription from it
-            if stripe_event["type"] == "checkout.session.completed":
-                sub_id = data_object.get("subscription")
-                org_uuid = data_object.get("metadata", {}).get("org_uuid")
-            else:
-                # Direct subscription event
-                sub_id = data_object.get("id")
-                org_uuid = data_object.get("metadata", {}).get("org_uuid")
-
-            if not sub_id or not org_uuid:
-                logging.error("Missing sub_id or org_uuid in webhook payload.")
-                raise Exception("Missing sub_id or org_uuid in webhook payload.")
-
         database_token = zanolambdashelper.helpers.generate_database_token(rds_client, rds_user, rds_host, rds_port,
                                                                            rds_region)
 
         conn = zanolambdashelper.helpers.initialise_connection(rds_user, database_token, rds_db, rds_host, rds_port)
         conn.autocommit = False
 
+        # acknowledge quickly, events are applied in order by the processor lambda
         with conn.cursor() as cursor:
-            update_org_stripe_sub_id(cursor, org_uuid, sub_id)
-            conn.commit()
+            if stripe_event["type"] in handled_events:
+                if not store_webhook_event(cursor, stripe_event, raw_body):
+                    logging.info(f"Webhook event {stripe_event['id']} already received.")
+
+                # a redelivered event that still hasn't been applied starts the processor again
+                if is_webhook_event_pending(cursor, stripe_event["id"]):
+                    conn.commit()
+                    start_event_processor()
 
     except Exception as e:
         logging.error(f"Internal Server Error: {e}")
@@ -118,6 +146,6 @@ def lambda_handler(event, context):
 
     return {
         'statusCode': 200,
-        'body': 'Subscription Added Successfully'
+        'body': 'Webhook Event Received Successfully'
     }
 
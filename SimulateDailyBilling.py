@@ -0,0 +1,213 @@
+import argparse
+import io
+import json
+import logging
+import random
+import time
+from collections import Counter
+
+# Local harness for the daily billing run. Runs StripeDailyBiling against an in-memory organisations table and a fake
+# UpdateStripeSubscriptions that always fails some subscriptions, following each continuation the handler invokes
+# until the run finishes. Checks every subscription is submitted once per run and that the run ends.
+#
+#   python SimulateDailyBilling.py --orgs 5000 --failing 50
+
+import check_helper
+import fake_helper
+
+# the billing lambda also needs a connection and the organisations table, the connection is set per run
+helpers = fake_helper.install_helpers_stand_in(
+    get_database_dict=lambda: {'schema': 'simulation', 'organisations_table': 'organisations'},
+    generate_database_token=lambda *args: None,
+)
+
+import StripeDailyBiling
+import StripeSubscriptionItems
+
+# a runaway run is stopped after this many invocations
+max_invocations = 100
+
+
+class InMemoryBillingStore:
+    """Stands in for the organisations, device counts, billing run and subscription items tables"""
+
+    def __init__(self, org_count, seed):
+        rng = random.Random(seed)
+        self.orgs = sorted(
+            (f"org-{i:06d}", f"sub_{i:06d}", rng.randint(1, 3), rng.randint(0, 40), 0, rng.randint(0, 10),
+             rng.randint(5, 200))
+            for i in range(org_count)
+        )
+        self.billed = set()  # (run_id, sub id)
+        self.items = {}  # sub id -> (customer id, [[item id, price id]])
+
+    def execute(self, sql, params):
+        if f"JOIN simulation.{StripeDailyBiling.stripe_billing_run_subscriptions_table}" in sql:
+            run_id, after_org_uuid, limit = params
+            rows = [org for org in self.orgs if org[0] > after_org_uuid and (run_id, org[1]) not in self.billed]
+            return rows[:limit], ["organisationUUID", "stripe_sub_id", "hub_count", "dimmable_light_count",
+                                  "encoder_count", "pir_count", "emergency_light_count"]
+
+        if sql.lstrip().startswith("SELECT stripe_sub_id, stripe_customer_id"):
+            return [(sub_id, self.items[sub_id][0], item_id, price_id)
+                    for sub_id in params if sub_id in self.items
+                    for item_id, price_id in self.items[sub_id][1]], None
+
+        if f"INTO simulation.{StripeDailyBiling.stripe_billing_run_subscriptions_table}" in sql:
+            self.billed.update(zip(params[::2], params[1::2]))
+        elif f"DELETE FROM simulation.{StripeSubscriptionItems.stripe_subscription_items_table}" in sql:
+            self.items.pop(params[0], None)
+        elif f"INTO simulation.{StripeSubscriptionItems.stripe_subscription_items_table}" in sql:
+            sub_id, customer_id = params[0], params[2]
+            self.items[sub_id] = (customer_id, [list(params[i + 1:i + 4:2]) for i in range(0, len(params), 4)])
+        else:
+            raise ValueError(f"Unexpected query: {sql}")
+
+        return [], None
+
+
+class FakeCursor:
+    def __init__(self, store):
+        self.store = store
+        self.rows = []
+        self.description = None
+
+    def execute(self, sql, params=()):
+        self.rows, columns = self.store.execute(sql, params)
+        self.description = [(column,) for column in columns] if columns else None
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class FakeConnection:
+    def __init__(self, store):
+        self.store = store
+        self.autocommit = True
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self.store)
+
+    def commit(self):
+        self.commits += 1
+
+    def close(self):
+        pass
+
+
+class FakeLambdaClient:
+    """Answers the UpdateStripeSubscriptions shard invokes and queues the billing lambda's continuations"""
+
+    def __init__(self, failing, clock, shard_ms):
+        self.failing = failing
+        self.clock = clock
+        self.shard_ms = shard_ms
+        self.submitted = Counter()  # sub id -> times sent to UpdateStripeSubscriptions
+        self.continuations = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        event = json.loads(Payload)
+
+        if InvocationType == 'Event':
+            self.continuations.append(event)
+            return {'StatusCode': 202}
+
+        # shards run in parallel in the lambda, the simulated clock charges each one in full
+        self.clock.advance(self.shard_ms)
+        subscriptions = event["subscriptions"]
+        self.submitted.update(list(subscriptions))
+        failed = {sub_id: "Rate limited" for sub_id in subscriptions if sub_id in self.failing}
+        response = {
+            'statusCode': 500 if failed else 200,
+            'succeeded': [sub_id for sub_id in subscriptions if sub_id not in failed],
+            'failed': failed,
+            'refreshed_subscriptions': {
+                sub_id: {"customer": f"cus_{sub_id}", "items": [[f"si_{sub_id}", "price_1RqFmm7u40gohPr0ckFt40IX"]]}
+                for sub_id, org_data in subscriptions.items() if "subscription_items" not in org_data
+            }
+        }
+        return {'StatusCode': 200, 'Payload': io.BytesIO(json.dumps(response).encode('utf-8'))}
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.elapsed_ms = 0
+
+    def advance(self, ms):
+        self.elapsed_ms += ms
+
+
+class FakeContext:
+    function_name = "StripeDailyBiling"
+
+    def __init__(self, clock, timeout_ms):
+        self.clock = clock
+        self.deadline_ms = clock.elapsed_ms + timeout_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.deadline_ms - self.clock.elapsed_ms
+
+
+def run_billing(store, lambda_client, clock, timeout_ms, run_id):
+    StripeDailyBiling.lambda_client = lambda_client
+    helpers.initialise_connection = lambda *args: FakeConnection(store)
+
+    lambda_client.continuations.append({"run_id": run_id})
+    responses = []
+
+    while lambda_client.continuations and len(responses) < max_invocations:
+        event = lambda_client.continuations.pop(0)
+        responses.append(StripeDailyBiling.lambda_handler(event, FakeContext(clock, timeout_ms)))
+
+    return responses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a daily billing run across continuations")
+    parser.add_argument("--orgs", type=int, default=5000)
+    parser.add_argument("--failing", type=int, default=50, help="subscriptions that fail every time they're sent")
+    parser.add_argument("--shard-seconds", type=int, default=60,
+                        help="simulated time per UpdateStripeSubscriptions call")
+    parser.add_argument("--timeout-seconds", type=int, default=900)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    store = InMemoryBillingStore(args.orgs, args.seed)
+    sub_ids = [org[1] for org in store.orgs]
+    failing = set(random.Random(args.seed).sample(sub_ids, args.failing))
+    clock = SimulatedClock()
+    lambda_client = FakeLambdaClient(failing, clock, args.shard_seconds * 1000)
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    started = time.perf_counter()
+    responses = run_billing(store, lambda_client, clock, args.timeout_seconds * 1000, "1735689600")
+    seconds = time.perf_counter() - started
+
+    print(f"{args.orgs} orgs, {args.failing} failing: {len(responses)} invocations, "
+          f"{clock.elapsed_ms / 60000:.0f} simulated minutes, {seconds:.2f}s")
+    check_helper.exit_with_results([
+        check_helper.check(not lambda_client.continuations, f"run finished within {max_invocations} invocations"),
+        check_helper.check(set(lambda_client.submitted) == set(sub_ids) and max(lambda_client.submitted.values()) == 1,
+                           "every subscription submitted exactly once, failing ones weren't retried by continuations"),
+        check_helper.check({sub_id for run_id, sub_id in store.billed} == set(sub_ids) - failing,
+                           "every subscription except the failing ones recorded as billed"),
+        check_helper.check(all(response['statusCode'] == 202 for response in responses[:-1])
+                           and responses[-1]['statusCode'] == (500 if failing else 200),
+                           f"continuations handed over and the last invocation reported the failures, "
+                           f"status {responses[-1]['statusCode']}"),
+        check_helper.check(set(store.items) == set(sub_ids), "refreshed subscription items cached"),
+    ])
+
+
+if __name__ == "__main__":
+    main()
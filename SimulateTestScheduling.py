@@ -0,0 +1,199 @@
+import argparse
+import logging
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+import fake_helper
+
+# Local simulator for the emergency test schedulers. Generates a synthetic fleet, runs the monthly and yearly
+# scheduling logic once per simulated day against an in-memory store and reports runtime, load and compliance.
+#
+#   python SimulateTestScheduling.py --orgs 50 --devices-per-org 20 200 --days 365
+
+# the schedulers read db details and create aws clients at import time, none of that is needed to simulate
+fake_helper.install_helpers_stand_in()
+
+import EmergencyTestScheduling
+import ScheduleMonthlyTests
+import ScheduleYearlyTests
+
+monthly_test_type_id = 1
+yearly_test_type_id = 2
+
+scheduler_modules = {
+    monthly_test_type_id: ScheduleMonthlyTests,
+    yearly_test_type_id: ScheduleYearlyTests,
+}
+
+compliance_limits = {
+    monthly_test_type_id: relativedelta(months=1),
+    yearly_test_type_id: relativedelta(years=1),
+}
+
+# time of day the nightly scheduler jobs run
+scheduler_run_time = timedelta(hours=12)
+
+
+class InMemorySchedulingStore:
+    """Stands in for the devices, organisations, emergency_test_schedule and emergency_test_latest tables"""
+
+    def __init__(self):
+        self.orgs = {}  # organisationUUID -> preferred_test_time
+        self.devices = {}  # deviceUUID -> (organisationUUID, associated_hub)
+        self.schedule = {}  # (deviceUUID, test_type_id) -> test_time
+        self.schedule_hubs = {}  # (deviceUUID, test_type_id) -> associated_hub stored with the schedule
+        self.latest_results = {}  # (deviceUUID, test_type_id) -> result timestamp
+
+    def get_emergency_devices(self, test_type_id):
+        # same row shape as the schedulers' get_emergency_devices query
+        return [
+            (device_uuid, org_uuid, self.orgs[org_uuid], self.schedule.get((device_uuid, test_type_id)),
+             self.latest_results.get((device_uuid, test_type_id)), hub_uuid,
+             self.schedule_hubs.get((device_uuid, test_type_id)))
+            for device_uuid, (org_uuid, hub_uuid) in self.devices.items()
+        ]
+
+    def set_new_schedule(self, rows):
+        for row in rows:
+            self.schedule[(row["deviceUUID"], row["test_type_id"])] = row["test_time"]
+            self.schedule_hubs[(row["deviceUUID"], row["test_type_id"])] = row["associated_hub"]
+
+    def add_result(self, device_uuid, test_type_id, result_timestamp):
+        key = (device_uuid, test_type_id)
+        if key not in self.latest_results or result_timestamp >= self.latest_results[key]:
+            self.latest_results[key] = result_timestamp
+
+
+def generate_fleet(store, org_count, min_devices, max_devices, hubs_per_org, start, seed):
+    rng = random.Random(seed)
+
+    for _ in range(org_count):
+        org_uuid = str(uuid.UUID(int=rng.getrandbits(128)))
+        store.orgs[org_uuid] = timedelta(hours=rng.choice([20, 21, 22, 23]), minutes=rng.choice([0, 30]))
+        hubs = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(hubs_per_org)]
+
+        for _ in range(rng.randint(min_devices, max_devices)):
+            device_uuid = str(uuid.UUID(int=rng.getrandbits(128)))
+            store.devices[device_uuid] = (org_uuid, rng.choice(hubs))
+
+            # a mix of never tested, recently tested and overdue devices
+            if rng.random() < 0.9:
+                store.add_result(device_uuid, monthly_test_type_id,
+                                 start - timedelta(days=rng.randint(0, 40), minutes=rng.randint(0, 1439)))
+            if rng.random() < 0.8:
+                store.add_result(device_uuid, yearly_test_type_id,
+                                 start - timedelta(days=rng.randint(0, 400), minutes=rng.randint(0, 1439)))
+
+
+def run_scheduler(store, test_type_id, run_at):
+    module = scheduler_modules[test_type_id]
+    module.now = run_at
+
+    rows = module.calculate_test_times(store.get_emergency_devices(test_type_id))
+    if test_type_id == yearly_test_type_id:
+        rows = module.balance_schedule(rows)
+    rows = EmergencyTestScheduling.spread_hub_load(rows, module.test_slot_length, module.test_window_slots)
+
+    store.set_new_schedule(module.get_changed_schedules(rows))
+
+
+def run_due_tests(store, day_start, day_end, stats):
+    for (device_uuid, test_type_id), test_time in store.schedule.items():
+        if not day_start <= test_time < day_end:
+            continue
+
+        org_uuid, hub_uuid = store.devices[device_uuid]
+        store.add_result(device_uuid, test_type_id, test_time)
+
+        day_key = (test_type_id, org_uuid, test_time.date())
+        stats["org_day_tests"][day_key] = stats["org_day_tests"].get(day_key, 0) + 1
+
+        slot_key = (test_type_id, hub_uuid, test_time)
+        stats["hub_slot_tests"][slot_key] = stats["hub_slot_tests"].get(slot_key, 0) + 1
+
+
+def count_violations(store, at):
+    violations = {monthly_test_type_id: 0, yearly_test_type_id: 0}
+
+    for device_uuid in store.devices:
+        for test_type_id, limit in compliance_limits.items():
+            last_result = store.latest_results.get((device_uuid, test_type_id))
+            if last_result is None or last_result + limit < at:
+                violations[test_type_id] += 1
+
+    return violations
+
+
+def simulate(org_count, min_devices, max_devices, hubs_per_org, days, seed):
+    start = datetime.combine(datetime.now().date(), datetime.min.time())
+
+    store = InMemorySchedulingStore()
+    generate_fleet(store, org_count, min_devices, max_devices, hubs_per_org, start, seed)
+    logging.info(f"Simulating {len(store.devices)} devices across {len(store.orgs)} orgs for {days} days...")
+
+    stats = {
+        "scheduler_seconds": {monthly_test_type_id: 0.0, yearly_test_type_id: 0.0},
+        "org_day_tests": {},
+        "hub_slot_tests": {},
+        "violation_device_days": {monthly_test_type_id: 0, yearly_test_type_id: 0},
+        "first_day_violations": None,
+    }
+
+    for day in range(days):
+        day_start = start + timedelta(days=day)
+
+        for test_type_id in scheduler_modules:
+            started = time.perf_counter()
+            run_scheduler(store, test_type_id, day_start + scheduler_run_time)
+            stats["scheduler_seconds"][test_type_id] += time.perf_counter() - started
+
+        # hubs run everything due from the scheduler run until the next one
+        run_due_tests(store, day_start + scheduler_run_time, day_start + timedelta(days=1) + scheduler_run_time, stats)
+
+        violations = count_violations(store, day_start + timedelta(days=1))
+        if stats["first_day_violations"] is None:
+            # devices that are already out of compliance when the simulation starts
+            stats["first_day_violations"] = violations
+        for test_type_id, count in violations.items():
+            stats["violation_device_days"][test_type_id] += count
+
+    return store, stats
+
+
+def print_report(store, stats, days):
+    print(f"Devices: {len(store.devices)}  Orgs: {len(store.orgs)}  Days: {days}")
+
+    for test_type_id, name in ((monthly_test_type_id, "Monthly"), (yearly_test_type_id, "Yearly")):
+        org_day_counts = [count for (type_id, _, _), count in stats["org_day_tests"].items() if type_id == test_type_id]
+        hub_slot_counts = [count for (type_id, _, _), count in stats["hub_slot_tests"].items() if type_id == test_type_id]
+        scheduler_seconds = stats["scheduler_seconds"][test_type_id]
+
+        print(f"{name} scheduler")
+        print(f"  runtime total {scheduler_seconds:.2f}s, per run {scheduler_seconds / days * 1000:.1f}ms")
+        print(f"  tests run {sum(org_day_counts)}")
+        print(f"  max tests per org per day {max(org_day_counts, default=0)}")
+        print(f"  max tests starting together per hub {max(hub_slot_counts, default=0)}")
+        print(f"  non compliant devices after day 1 {stats['first_day_violations'][test_type_id]}")
+        print(f"  non compliant device days {stats['violation_device_days'][test_type_id]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the emergency test schedulers over a synthetic fleet")
+    parser.add_argument("--orgs", type=int, default=50)
+    parser.add_argument("--devices-per-org", type=int, nargs=2, default=[20, 200], metavar=("MIN", "MAX"))
+    parser.add_argument("--hubs-per-org", type=int, default=3)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    store, stats = simulate(args.orgs, args.devices_per_org[0], args.devices_per_org[1], args.hubs_per_org,
+                            args.days, args.seed)
+    print_report(store, stats, args.days)
+
+
+if __name__ == "__main__":
+    main()
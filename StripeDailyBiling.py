@@ -9,8 +9,12 @@ import traceback
 import re
 import random
 import string
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import stripe
 import zanolambdashelper
+import OrganisationDeviceCounts
+import StripeSubscriptionItems
 
 database_details = zanolambdashelper.helpers.get_db_details()
 
@@ -28,28 +32,38 @@ lambda_client = zanolambdashelper.helpers.create_client('lambda')
 zanolambdashelper.helpers.set_logging('INFO')
 
 stripe_sub_update_lambda = "UpdateStripeSubscriptions"
+stripe_billing_run_subscriptions_table = 'stripe_billing_run_subscriptions'
 
+# orgs are paged through and each page fanned out in shards so no single invoke payload grows with the customer base
+billing_page_size = 1000
+billing_shard_size = 200
+max_shard_workers = 4
 
-def get_valid_org_subs(cursor):
-    logging.info("Getting all org subscriptions and device counts...")
+# stop taking new pages when less than this is left and hand over to a fresh invocation
+min_remaining_time_ms = 120 * 1000
 
+
+def get_valid_org_subs(cursor, run_id, after_org_uuid, limit):
+    logging.info("Getting page of org subscriptions and device counts...")
+
+    # subscriptions already billed in this run are skipped so a rerun doesn't bill them twice
     sql = f"""
-            WITH cte as (
-                SELECT organisationUUID, device_type_ID from {database_dict['schema']}.{database_dict['hubs_table']}  
-                UNION ALL 
-                SELECT organisationUUID, device_type_ID from {database_dict['schema']}.{database_dict['devices_table']}
-                )
             SELECT a.organisationUUID, a.stripe_sub_id,
-            CAST(SUM(CASE WHEN device_type_ID = 1 THEN 1 ELSE 0 END) AS UNSIGNED) AS hub_count,
-            CAST(SUM(CASE WHEN device_type_ID = 2 THEN 1 ELSE 0 END) AS UNSIGNED) AS dimmable_light_count,
-            CAST(SUM(CASE WHEN device_type_ID = 3 THEN 1 ELSE 0 END) AS UNSIGNED) AS encoder_count,
-            CAST(SUM(CASE WHEN device_type_ID = 4 THEN 1 ELSE 0 END) AS UNSIGNED) AS pir_count,
-            CAST(SUM(CASE WHEN device_type_ID = 5 THEN 1 ELSE 0 END) AS UNSIGNED) AS emergency_light_count
-            FROM {database_dict['schema']}.{database_dict['organisations_table']}  a LEFT JOIN cte b on a.organisationUUID = b.organisationUUID
-            WHERE stripe_sub_id IS NOT NULL
-            GROUP BY a.organisationUUID, a.stripe_sub_id
+            COALESCE(c.hub_count, 0) AS hub_count,
+            COALESCE(c.dimmable_light_count, 0) AS dimmable_light_count,
+            COALESCE(c.encoder_count, 0) AS encoder_count,
+            COALESCE(c.pir_count, 0) AS pir_count,
+            COALESCE(c.emergency_light_count, 0) AS emergency_light_count
+            FROM {database_dict['schema']}.{database_dict['organisations_table']} a
+            LEFT JOIN {database_dict['schema']}.{OrganisationDeviceCounts.organisation_device_counts_table} c
+                ON a.organisationUUID = c.organisationUUID
+            LEFT JOIN {database_dict['schema']}.{stripe_billing_run_subscriptions_table} r
+                ON r.run_id = %s AND r.stripe_sub_id = a.stripe_sub_id
+            WHERE a.stripe_sub_id IS NOT NULL AND r.stripe_sub_id IS NULL AND a.organisationUUID > %s
+            ORDER BY a.organisationUUID
+            LIMIT %s
     """
-    cursor.execute(sql)
+    cursor.execute(sql, (run_id, after_org_uuid, limit))
 
     org_sub_result = cursor.fetchall()
 
@@ -60,13 +74,24 @@ def get_valid_org_subs(cursor):
         return {}
 
 
-def update_stripe_sub(org_subs):
-    logging.info("Logging subscription usage...")
+def record_billed_subscriptions(cursor, run_id, sub_ids):
+    if not sub_ids:
+        return
+
+    sql = f"""
+        INSERT IGNORE INTO {database_dict['schema']}.{stripe_billing_run_subscriptions_table} (run_id, stripe_sub_id)
+        VALUES {','.join(['(%s, %s)'] * len(sub_ids))}
+    """
+    cursor.execute(sql, tuple(value for sub_id in sub_ids for value in (run_id, sub_id)))
+
+
+def update_stripe_sub(run_id, org_subs):
+    logging.info(f"Logging subscription usage for {len(org_subs)} subscriptions...")
 
     response = lambda_client.invoke(
         FunctionName=stripe_sub_update_lambda,
         InvocationType="RequestResponse",
-        Payload=json.dumps(org_subs)
+        Payload=json.dumps({"run_id": run_id, "subscriptions": org_subs})
     )
 
     response_payload_str = response['Payload'].read().decode('utf-8')
@@ -76,15 +101,60 @@ def update_stripe_sub(org_subs):
     except json.JSONDecodeError:
         response_payload = {}
 
-    if response['StatusCode'] != 200 or response_payload.get(
-            'statusCode') != 200 or 'errorMessage' in response_payload:
-        logging.error(f"Lambda invocation failed, ResponsePayload: {response_payload}")
-        traceback.print_exc()
-        raise Exception(response_payload)
+    return response['StatusCode'], response_payload
+
+
+def bill_page(cursor, run_id, org_subs):
+    # meter events are sent from the cached items, subscriptions missing from the cache are retrieved
+    for sub_id, cached in StripeSubscriptionItems.get_subscription_items(cursor, database_dict['schema'],
+                                                                       list(org_subs)).items():
+        org_subs[sub_id]["subscription_items"] = cached
+
+    sub_ids = list(org_subs)
+    shards = [{sub_id: org_subs[sub_id] for sub_id in sub_ids[i:i + billing_shard_size]}
+              for i in range(0, len(sub_ids), billing_shard_size)]
+
+    failed = {}
+
+    with ThreadPoolExecutor(max_workers=max_shard_workers) as executor:
+        futures = {executor.submit(update_stripe_sub, run_id, shard): shard for shard in shards}
+
+        # results are written back on this thread as each shard completes, the cursor isn't shared with the workers
+        for future in as_completed(futures):
+            shard = futures[future]
+            try:
+                status_code, response_payload = future.result()
+            except Exception as e:
+                logging.error(f"Shard invocation failed: {e}")
+                failed.update({sub_id: str(e) for sub_id in shard})
+                continue
+
+            for sub_id, refreshed in response_payload.get('refreshed_subscriptions', {}).items():
+                StripeSubscriptionItems.set_subscription_items(cursor, database_dict['schema'], sub_id,
+                                                               refreshed["customer"], refreshed["items"])
+
+            if status_code != 200 or 'errorMessage' in response_payload or 'succeeded' not in response_payload:
+                logging.error(f"Lambda invocation failed, ResponsePayload: {response_payload}")
+                failed.update({sub_id: response_payload.get('body', 'Shard failed') for sub_id in shard})
+                continue
+
+            record_billed_subscriptions(cursor, run_id, response_payload['succeeded'])
+            failed.update(response_payload.get('failed', {}))
+
+    return failed
 
 
 def lambda_handler(event, context):
     try:
+        # the run id doubles as the meter event idempotency key, reruns for the same day pass the same one
+        run_id = event.get("run_id") or str(int(datetime.now().replace(hour=0, minute=0, second=0,
+                                                                       microsecond=0).timestamp()))
+
+        # a continuation carries on after the last org the previous invocation reached, so subscriptions that failed
+        # earlier in the run aren't picked up again until the run is rerun
+        after_org_uuid = event.get("after_org_uuid", '')
+        previous_failed_count = event.get("failed_count", 0)
+
         database_token = zanolambdashelper.helpers.generate_database_token(rds_client, rds_user, rds_host, rds_port,
                                                                            rds_region)
 
@@ -93,11 +163,44 @@ def lambda_handler(event, context):
 
         with conn.cursor() as cursor:
 
-            org_subs = get_valid_org_subs(cursor)
-            print(org_subs)
-            if org_subs:
-                update_stripe_sub(org_subs)
-            conn.commit()
+            failed = {}
+            billed_count = 0
+
+            while True:
+
+                if context.get_remaining_time_in_millis() < min_remaining_time_ms:
+                    logging.info(f"Running out of time, continuing after org {after_org_uuid} in a new invocation...")
+                    if failed:
+                        logging.error(f"Failed subscriptions for run {run_id}: {failed}")
+                    lambda_client.invoke(
+                        FunctionName=context.function_name,
+                        InvocationType='Event',
+                        Payload=json.dumps({"run_id": run_id, "after_org_uuid": after_org_uuid,
+                                            "failed_count": previous_failed_count + len(failed)})
+                    )
+                    return {
+                        'statusCode': 202,
+                        'body': f"Processed {billed_count} subscriptions, continuing in a new invocation"
+                    }
+
+                org_subs = get_valid_org_subs(cursor, run_id, after_org_uuid, billing_page_size)
+                if not org_subs:
+                    break
+
+                failed.update(bill_page(cursor, run_id, org_subs))
+                billed_count += len(org_subs)
+                after_org_uuid = max(org_sub["organisationUUID"] for org_sub in org_subs.values())
+
+                # commit per page so billed subscriptions are recorded before the next page starts
+                conn.commit()
+                logging.info(f"Processed {billed_count} subscriptions for run {run_id}, {len(failed)} failed.")
+
+            if failed:
+                logging.error(f"Failed subscriptions for run {run_id}: {failed}")
+
+            failed_count = previous_failed_count + len(failed)
+            if failed_count:
+                raise Exception(f"{failed_count} subscriptions failed to bill for run {run_id}")
 
     except Exception as e:
         logging.error(f"Internal Server Error: {e}")
@@ -0,0 +1,53 @@
+import logging
+from datetime import datetime, timezone
+
+# the local Stripe invoice index, shared by the webhook processor, the backfill and the invoice lambdas which are
+# deployed in the same package. set_invoice is the only writer of the index
+
+stripe_invoices_table = 'stripe_invoices'
+
+# paid invoice PDFs are cached in the emergency test reports bucket under their own prefix, reusing that bucket
+# rather than keeping one just for invoices
+invoice_bucket = "scytale-prod-emergency-test-reports-423623864387-eu-west-2-an"
+invoice_prefix = "stripe-invoices"
+presigned_url_expiry = 300  # 5 minutes
+
+
+def get_invoice_subscription_id(invoice):
+    # newer API versions move the subscription under the invoice's parent
+    parent = invoice.get("parent") or {}
+    subscription_details = parent.get("subscription_details") or {}
+    return invoice.get("subscription") or subscription_details.get("subscription")
+
+
+def set_invoice(cursor, schema, invoice, pdf_s3_key=None):
+    logging.info(f"Indexing invoice {invoice['id']}...")
+
+    # a PDF already copied to S3 is kept when the invoice is indexed again without one
+    sql = f"""
+        INSERT INTO {schema}.{stripe_invoices_table}
+        (stripe_invoice_id, stripe_sub_id, status, invoice_number, amount_paid, currency, invoice_created, pdf_s3_key)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            stripe_sub_id = VALUES(stripe_sub_id),
+            status = VALUES(status),
+            invoice_number = VALUES(invoice_number),
+            amount_paid = VALUES(amount_paid),
+            currency = VALUES(currency),
+            pdf_s3_key = COALESCE(VALUES(pdf_s3_key), pdf_s3_key)
+    """
+    cursor.execute(sql, (invoice["id"], get_invoice_subscription_id(invoice), invoice["status"],
+                         invoice.get("number"), invoice.get("amount_paid"), invoice.get("currency"),
+                         datetime.fromtimestamp(invoice["created"], tz=timezone.utc), pdf_s3_key))
+
+
+def get_invoice_pdf_key(invoice_id):
+    return f"{invoice_prefix}/{invoice_id}.pdf"
+
+
+def get_invoice_pdf_url(s3, pdf_s3_key):
+    return s3.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': invoice_bucket, 'Key': pdf_s3_key},
+        ExpiresIn=presigned_url_expiry
+    )
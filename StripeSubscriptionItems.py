@@ -0,0 +1,60 @@
+import logging
+
+# the local cache of Stripe subscription items daily billing emits meter events from, shared by the webhook
+# processor and daily billing which are deployed in the same package. set_subscription_items is the only writer.
+# the cache is only as fresh as the subscription webhooks, meter events don't validate the item id they're sent
+# for so billing can't tell a stale entry from a current one
+
+stripe_subscription_items_table = 'stripe_subscription_items'
+
+
+def get_subscription_items(cursor, schema, sub_ids):
+    logging.info("Getting cached subscription items...")
+
+    placeholders = ','.join(['%s'] * len(sub_ids))
+    sql = f"""
+        SELECT stripe_sub_id, stripe_customer_id, stripe_item_id, price_id
+        FROM {schema}.{stripe_subscription_items_table}
+        WHERE stripe_sub_id IN ({placeholders})
+    """
+    cursor.execute(sql, tuple(sub_ids))
+
+    subscription_items = {}
+    for sub_id, customer_id, item_id, price_id in cursor.fetchall():
+        cached = subscription_items.setdefault(sub_id, {"customer": customer_id, "items": []})
+        cached["items"].append([item_id, price_id])
+
+    return subscription_items
+
+
+def get_subscription_item_pairs(subscription):
+    # [item id, price id] for each item of a Stripe subscription, the shape the cache and billing payloads use
+    return [[item["id"], item["price"]["id"]] for item in subscription["items"]["data"]]
+
+
+def delete_subscription_items(cursor, schema, sub_id):
+    logging.info("Removing cached subscription items...")
+
+    sql = f"""
+        DELETE FROM {schema}.{stripe_subscription_items_table}
+        WHERE stripe_sub_id = %s
+    """
+    cursor.execute(sql, (sub_id,))
+
+
+def set_subscription_items(cursor, schema, sub_id, customer_id, items):
+    logging.info(f"Caching items for subscription {sub_id}...")
+
+    # replaces whatever was cached for the subscription
+    delete_subscription_items(cursor, schema, sub_id)
+
+    if not items:
+        return
+
+    sql = f"""
+        INSERT INTO {schema}.{stripe_subscription_items_table}
+        (stripe_sub_id, stripe_item_id, stripe_customer_id, price_id)
+        VALUES {','.join(['(%s, %s, %s, %s)'] * len(items))}
+    """
+    cursor.execute(sql, tuple(value for item_id, price_id in items
+                              for value in (sub_id, item_id, customer_id, price_id)))
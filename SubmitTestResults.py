@@ -25,6 +25,8 @@ rds_client = zanolambdashelper.helpers.create_client('rds')
 
 zanolambdashelper.helpers.set_logging('INFO')
 
+emergency_test_latest_table = 'emergency_test_latest'
+
 def add_monthly_test_result(cursor, org_uuid, device_uuid, result, result_time_since_epoch):
     logging.info("Inserting monthly test result...")
 
@@ -43,6 +45,22 @@ def add_yearly_test_result(cursor, org_uuid, device_uuid, result, result_time_si
     """
     cursor.execute(sql, (org_uuid, device_uuid, result, datetime.fromtimestamp(result_time_since_epoch, tz=timezone.utc)))
 
+def update_latest_test_result(cursor, org_uuid, device_uuid, test_type_id, result, result_time_since_epoch):
+    logging.info("Updating latest test result...")
+
+    # keep one row per device and test type, only replaced by a result at least as recent (assignments apply in order).
+    # the row is keyed to the devices table, a late result for a device that has since been removed only goes to history
+    sql = f"""INSERT INTO {database_dict['schema']}.{emergency_test_latest_table} (deviceUUID, test_type_id, organisationUUID, last_result, last_timestamp) 
+            SELECT deviceUUID, %s, organisationUUID, %s, %s
+            FROM {database_dict['schema']}.{database_dict['devices_table']}
+            WHERE deviceUUID = %s AND organisationUUID = %s
+            ON DUPLICATE KEY UPDATE
+                organisationUUID = IF(VALUES(last_timestamp) >= last_timestamp, VALUES(organisationUUID), organisationUUID),
+                last_result = IF(VALUES(last_timestamp) >= last_timestamp, VALUES(last_result), last_result),
+                last_timestamp = GREATEST(last_timestamp, VALUES(last_timestamp))
+    """
+    cursor.execute(sql, (test_type_id, result, datetime.fromtimestamp(result_time_since_epoch, tz=timezone.utc), device_uuid, org_uuid))
+
 def lambda_handler(event, context):
     try:
         database_token = zanolambdashelper.helpers.generate_database_token(rds_client, rds_user, rds_host, rds_port,
@@ -97,6 +115,8 @@ def lambda_handler(event, context):
             else:
                 raise Exception("Invalid test type id")
 
+            update_latest_test_result(cursor, org_uuid, device_uuid, int(test_type_id), result, result_time_since_epoch)
+
 
 
             conn.commit()
@@ -30,7 +30,8 @@ def update_preferred_time(cursor, pref_time, org_uuid):
     logging.info("Updating Org preferred time...")
     print(pref_time)
 
-    sql = f"UPDATE {database_dict['schema']}.{database_dict['organisations_table']} SET preferred_test_time = %s WHERE organisationUUID = %s "
+    # the change timestamp lets the schedulers pick up the organisation on their next incremental run
+    sql = f"UPDATE {database_dict['schema']}.{database_dict['organisations_table']} SET preferred_test_time = %s, preferred_test_time_updated_at = CURRENT_TIMESTAMP WHERE organisationUUID = %s "
 
     cursor.execute(sql, (pref_time, org_uuid))
 
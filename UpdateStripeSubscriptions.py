@@ -1,19 +1,33 @@
 import boto3
 import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import stripe
 import zanolambdashelper
+import StripeSubscriptionItems
 
 zanolambdashelper.helpers.set_logging('INFO')
 
-today_midnight = int(datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
-
 stripe_secrets = zanolambdashelper.helpers.get_stripe_api_secrets()
 
 STRIPE_API_KEY_SECRET = stripe_secrets['api_key']
 
 stripe.api_key = STRIPE_API_KEY_SECRET
 
+# allows runs against a local fake Stripe server such as stripe-mock
+stripe.api_base = os.environ.get('STRIPE_API_BASE', stripe.api_base)
+
+# subscriptions are submitted in parallel, kept well under Stripe's per second request limit
+max_submit_workers = 8
+# rate limited calls back off exponentially up to this many attempts
+max_rate_limit_attempts = 5
+rate_limit_base_delay = 0.5
+# subscriptions that still failed are retried this many more times, only the failed ones
+retry_rounds = 2
+
 # Map price IDs to your internal counters AND give each a meter event name
 prices = {
     "price_1RqFmm7u40gohPr0ckFt40IX": ("hub_count", "testmonthlymeter"),
@@ -23,42 +37,122 @@ prices = {
     "price_1RyJL57u40gohPr0NwLd1i1q": ("encoder_count", "encodermeter")
 }
 
-def lambda_handler(event, context):
-    try:
-        for sub_id, org_data in event.items():
-            logging.info(f"Logging usage for subscription: {sub_id}")
 
-            subscription = stripe.Subscription.retrieve(sub_id)
-            customer_id = subscription['customer']
+def call_with_backoff(func, **kwargs):
+    for attempt in range(max_rate_limit_attempts):
+        try:
+            return func(**kwargs)
+        except stripe.error.RateLimitError:
+            if attempt == max_rate_limit_attempts - 1:
+                raise
+            delay = rate_limit_base_delay * (2 ** attempt) + random.uniform(0, rate_limit_base_delay)
+            logging.info(f"Stripe rate limit hit, retrying in {delay:.2f}s...")
+            time.sleep(delay)
+
+
+def retrieve_subscription_items(sub_id):
+    logging.info(f"Retrieving items for subscription: {sub_id}")
+
+    subscription = call_with_backoff(stripe.Subscription.retrieve, id=sub_id)
+
+    return {
+        "customer": subscription['customer'],
+        "items": StripeSubscriptionItems.get_subscription_item_pairs(subscription)
+    }
+
+
+def emit_meter_events(run_id, customer_id, items, org_data, submitted_items):
+    for item_id, price_id in items:
+        mapping = prices.get(price_id)
+
+        if not mapping or item_id in submitted_items:
+            continue
+
+        field_name, event_name = mapping
+        count = org_data.get(field_name, 0)
+
+        if count <= 0:
+            continue
+
+        logging.info(
+            f"Sending meter event: {event_name}, count={count}, "
+            f"customer={customer_id}, sub_item={item_id}"
+        )
 
-            for item in subscription['items']['data']:
-                price_id = item['price']['id']
-                mapping = prices.get(price_id)
+        meter_event = call_with_backoff(
+            stripe.billing.MeterEvent.create,
+            event_name=event_name,
+            identifier=f"{item_id}_{run_id}",  # unique per subscription item and billing run
+            payload={
+                "value": str(count),
+                "stripe_customer_id": customer_id
+            }
+        )
 
-                if not mapping:
-                    continue
+        # a retried subscription only resends the items that did not go through
+        submitted_items.add(item_id)
+        logging.info(f"Meter event created: {meter_event}")
 
-                field_name, event_name = mapping
-                count = org_data.get(field_name, 0)
 
-                if count <= 0:
-                    continue
+def submit_subscription_usage(run_id, sub_id, org_data, submitted_items, refreshed):
+    logging.info(f"Logging usage for subscription: {sub_id}")
 
-                logging.info(
-                    f"Sending meter event: {event_name}, count={count}, "
-                    f"customer={customer_id}, sub_item={item['id']}"
-                )
+    # items cached by the caller save a retrieve per subscription. they're refreshed from Stripe on a miss or when
+    # Stripe rejects the request, e.g. a deleted customer. meter events don't validate the item id so a stale item
+    # list isn't detected here, the cache relies on the subscription webhooks to stay current
+    cached = org_data.get('subscription_items')
+    if cached:
+        try:
+            emit_meter_events(run_id, cached["customer"], cached["items"], org_data, submitted_items)
+            return
+        except stripe.error.InvalidRequestError as e:
+            logging.info(f"Cached items for subscription {sub_id} rejected, refreshing: {e}")
 
-                meter_event = stripe.billing.MeterEvent.create(
-                    event_name=event_name,
-                    identifier=f"{item['id']}_{today_midnight}",  # unique per subscription item
-                    payload={
-                        "value": str(count),
-                        "stripe_customer_id": customer_id
-                    }
-                )
+    subscription_items = retrieve_subscription_items(sub_id)
+    refreshed[sub_id] = subscription_items
+    emit_meter_events(run_id, subscription_items["customer"], subscription_items["items"], org_data,
+                      submitted_items)
 
-                logging.info(f"Meter event created: {meter_event}")
+
+def submit_all_subscription_usage(run_id, org_subs):
+    submitted_items = set()
+    refreshed = {}
+    pending = dict(org_subs)
+    failed = {}
+
+    for attempt in range(retry_rounds + 1):
+        if not pending:
+            break
+
+        if attempt:
+            logging.info(f"Retrying {len(pending)} failed subscriptions...")
+
+        with ThreadPoolExecutor(max_workers=max_submit_workers) as executor:
+            futures = {
+                sub_id: executor.submit(submit_subscription_usage, run_id, sub_id, org_data, submitted_items,
+                                         refreshed)
+                for sub_id, org_data in pending.items()
+            }
+
+        failed = {}
+        for sub_id, future in futures.items():
+            error = future.exception()
+            if error is not None:
+                logging.error(f"Error logging usage for subscription {sub_id}: {error}")
+                failed[sub_id] = str(error)
+
+        pending = {sub_id: pending[sub_id] for sub_id in failed}
+
+    succeeded = [sub_id for sub_id in org_subs if sub_id not in failed]
+    return succeeded, failed, refreshed
+
+
+def lambda_handler(event, context):
+    try:
+        run_id = event['run_id']
+        org_subs = event['subscriptions']
+
+        succeeded, failed, refreshed = submit_all_subscription_usage(run_id, org_subs)
 
     except Exception as e:
         logging.error(f"Error updating stripe subscriptions: {e}", exc_info=True)
@@ -67,7 +161,18 @@ def lambda_handler(event, context):
             'body': f"Error updating stripe subscriptions: {e}"
         }
 
+    if failed:
+        return {
+            'statusCode': 500,
+            'body': f"Error updating {len(failed)} of {len(org_subs)} stripe subscriptions",
+            'succeeded': succeeded,
+            'failed': failed,
+            'refreshed_subscriptions': refreshed
+        }
+
     return {
         'statusCode': 200,
-        'body': 'Stripe meter events logged successfully'
+        'body': 'Stripe meter events logged successfully',
+        'succeeded': succeeded,
+        'refreshed_subscriptions': refreshed
     }
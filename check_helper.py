@@ -0,0 +1,17 @@
+import sys
+
+# Reporting shared by the local check scripts. Each check prints a line, the script exits non zero if any failed.
+#
+#   check_helper.exit_with_results([
+#       check_helper.check(deleted == expected, "every orphaned thing deleted"),
+#   ])
+
+
+def check(condition, message):
+    print(f"  {'ok' if condition else 'FAIL'}  {message}")
+    return condition
+
+
+def exit_with_results(results):
+    # every check has printed by the time the list is built, so one failure doesn't hide the rest
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,25 @@
+import logging
+import sys
+import types
+
+# Stand in for zanolambdashelper used by the local simulators, benchmarks and checks. The lambdas read db details and
+# secrets and create aws clients at import time, none of which is available or needed when running them locally.
+#
+#   import fake_helper
+#   fake_helper.install_helpers_stand_in()
+#   import ScheduleMonthlyTests
+
+helpers = types.SimpleNamespace(
+    get_db_details=lambda: {'rds_host': None, 'rds_port': None, 'rds_db': None, 'rds_user': None,
+                            'rds_region': None},
+    get_database_dict=lambda: {'schema': 'simulation'},
+    create_client=lambda service: None,
+    set_logging=lambda level: logging.basicConfig(level=level),
+)
+
+
+def install_helpers_stand_in(**overrides):
+    # called before the lambdas are imported, overrides add or replace the helpers a script's lambdas need
+    vars(helpers).update(overrides)
+    sys.modules['zanolambdashelper'] = types.SimpleNamespace(helpers=helpers)
+    return helpers